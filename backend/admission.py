@@ -0,0 +1,326 @@
+"""
+Admission Control for ShifaAI
+Per-client rate limiting, per-endpoint-class concurrency caps and load shedding
+"""
+import asyncio
+import json
+import math
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from fastapi.responses import JSONResponse
+
+from .utils import logger, Config, is_emergency_query
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at ``rate`` tokens per second"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, amount: float = 1.0) -> float:
+        """Take tokens; returns 0 on success or the seconds to wait otherwise"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+class EndpointClass:
+    """Concurrency limiter with a bounded FIFO wait queue for one class of endpoints"""
+
+    def __init__(self, name: str, max_in_flight: int, max_queue: int, queue_timeout: float,
+                 rate_per_second: float, burst: int, fast_lane: bool = False):
+        self.name = name
+        self.fast_lane = fast_lane
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.admitted = 0
+        self.rate_limited = 0
+        self.shed = 0
+        self.timed_out = 0
+        self.fast_lane_in_flight = 0
+        self.fast_lane_admitted = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        """Acquire an in-flight slot; False means the request should be shed"""
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+        if len(self._waiters) >= self.max_queue:
+            self.shed += 1
+            return False
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            return False
+        except asyncio.CancelledError:
+            # The slot may have been handed over just before cancellation
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            if waiter.cancelled() and waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+        self.admitted += 1
+        return True
+
+    def release(self):
+        """Release a slot, handing it directly to the next live waiter"""
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(True)
+                return
+        self.in_flight -= 1
+
+    def enter_fast_lane(self):
+        """Admit a priority request without a slot: it is answered locally, so the LLM caps do not apply"""
+        self.fast_lane_in_flight += 1
+        self.fast_lane_admitted += 1
+
+    def leave_fast_lane(self):
+        self.fast_lane_in_flight -= 1
+
+    def partition(self, workers: int):
+        """Take this worker's share of the class limits when ``workers`` processes each enforce them"""
+        self.max_in_flight = max(1, math.ceil(self.max_in_flight / workers))
+        self.max_queue = math.ceil(self.max_queue / workers)
+        self.rate_per_second /= workers
+        self.burst = max(1, math.ceil(self.burst / workers))
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "max_in_flight": self.max_in_flight,
+            "queue_depth": self.queue_depth,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rate_limited": self.rate_limited,
+            "shed": self.shed,
+            "timed_out": self.timed_out,
+            "fast_lane_in_flight": self.fast_lane_in_flight,
+            "fast_lane_admitted": self.fast_lane_admitted
+        }
+
+class AdmissionController:
+    """Maps requests to endpoint classes and keeps per-client token buckets"""
+
+    def __init__(self, endpoint_classes: Dict[str, EndpointClass],
+                 routes: Tuple[Tuple[str, str], ...], max_buckets: int = Config.ADMISSION_MAX_BUCKETS,
+                 priority_check: Optional[Callable[[bytes], bool]] = None):
+        self.endpoint_classes = endpoint_classes
+        self.routes = routes
+        self.priority_check = priority_check
+        self.max_buckets = max_buckets
+        self._buckets: "OrderedDict[Tuple[str, str], TokenBucket]" = OrderedDict()
+
+    def classify(self, path: str) -> Optional[EndpointClass]:
+        """Get the endpoint class for a path, or None if it is not admission controlled"""
+        for prefix, class_name in self.routes:
+            if path == prefix or path.startswith(prefix + "/"):
+                return self.endpoint_classes[class_name]
+        return None
+
+    def is_priority(self, body: bytes) -> bool:
+        """Check whether a request body qualifies for the fast lane"""
+        return self.priority_check is not None and self.priority_check(body)
+
+    def check_rate(self, endpoint_class: EndpointClass, client_key: str) -> float:
+        """Consume one token for the client; returns seconds to wait if limited"""
+        key = (endpoint_class.name, client_key)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(endpoint_class.rate_per_second, endpoint_class.burst)
+            self._buckets[key] = bucket
+            if len(self._buckets) > self.max_buckets:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+
+        retry_after = bucket.consume()
+        if retry_after:
+            endpoint_class.rate_limited += 1
+        return retry_after
+
+    def partition(self, workers: int):
+        """Split every class's limits between ``workers`` processes so the configured values hold in total
+        
+        Each worker keeps its own buckets and counters; with the kernel spreading
+        connections across workers, a client's requests are split roughly evenly.
+        """
+        for endpoint_class in self.endpoint_classes.values():
+            endpoint_class.partition(workers)
+        self._buckets.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get admission control statistics"""
+        return {
+            "tracked_clients": len(self._buckets),
+            "endpoint_classes": {name: cls.get_stats() for name, cls in self.endpoint_classes.items()}
+        }
+
+class AdmissionControlMiddleware:
+    """ASGI middleware that rate limits, caps concurrency and sheds load early"""
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        endpoint_class = self.controller.classify(scope["path"])
+        if endpoint_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        if endpoint_class.fast_lane:
+            body, receive = await _buffer_body(receive)
+            if self.controller.is_priority(body):
+                # Emergencies get the local safety response: never throttled, queued or shed
+                endpoint_class.enter_fast_lane()
+                try:
+                    await self.app(scope, receive, send)
+                finally:
+                    endpoint_class.leave_fast_lane()
+                return
+
+        retry_after = self.controller.check_rate(endpoint_class, _client_key(scope))
+        if retry_after:
+            response = _reject(429, "Too many requests. Please slow down and try again shortly.", retry_after)
+            await response(scope, receive, send)
+            return
+
+        if not await endpoint_class.acquire():
+            logger.warning(f"Shedding request to {scope['path']} ({endpoint_class.name} class saturated)")
+            response = _reject(503, "Server is busy. Please try again shortly.", endpoint_class.queue_timeout)
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            endpoint_class.release()
+
+def _client_key(scope) -> str:
+    """Identify the caller by peer IP
+    
+    Client-supplied identifiers such as X-User-ID are not used: a caller could
+    send a new one with every request and get a fresh burst each time. Behind
+    a reverse proxy, set FORWARDED_ALLOW_IPS to the proxy's address so uvicorn
+    reports the original client as the peer.
+    """
+    client = scope.get("client")
+    return "ip:" + (client[0] if client else "unknown")
+
+async def _buffer_body(receive, limit: int = 65536) -> Tuple[bytes, Callable]:
+    """Read up to ``limit`` bytes of the request body and return a receive callable that replays it"""
+    chunks = []
+    size = 0
+    more_body = True
+    pending = []
+    while more_body and size < limit:
+        message = await receive()
+        if message["type"] != "http.request":
+            # Client went away before sending the body; let the app see the disconnect
+            pending.append(message)
+            more_body = False
+            break
+        chunk = message.get("body", b"")
+        chunks.append(chunk)
+        size += len(chunk)
+        more_body = message.get("more_body", False)
+
+    body = b"".join(chunks)
+    replayed = False
+
+    async def replay_receive():
+        nonlocal replayed
+        if not replayed:
+            replayed = True
+            return {"type": "http.request", "body": body, "more_body": more_body}
+        if pending:
+            return pending.pop()
+        return await receive()
+
+    return body, replay_receive
+
+def _is_emergency_body(body: bytes) -> bool:
+    """Only the question counts; other fields (user_id, padding) must not buy priority"""
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return False
+    question = payload.get("question") if isinstance(payload, dict) else None
+    return isinstance(question, str) and is_emergency_query(question)
+
+def _reject(status_code: int, error: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code,
+        content={
+            "success": False,
+            "error": error,
+            "timestamp": datetime.now().isoformat()
+        },
+        headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+    )
+
+# Global instance: expensive LLM routes are isolated from cheap catalog routes,
+# and emergency questions on LLM routes bypass their rate limits and caps
+admission_controller = AdmissionController(
+    endpoint_classes={
+        "llm": EndpointClass(
+            "llm",
+            max_in_flight=Config.ADMISSION_LLM_MAX_IN_FLIGHT,
+            max_queue=Config.ADMISSION_LLM_MAX_QUEUE,
+            queue_timeout=Config.ADMISSION_LLM_QUEUE_TIMEOUT,
+            rate_per_second=Config.ADMISSION_LLM_RATE_PER_SECOND,
+            burst=Config.ADMISSION_LLM_BURST,
+            fast_lane=True
+        ),
+        "catalog": EndpointClass(
+            "catalog",
+            max_in_flight=Config.ADMISSION_CATALOG_MAX_IN_FLIGHT,
+            max_queue=Config.ADMISSION_CATALOG_MAX_QUEUE,
+            queue_timeout=Config.ADMISSION_CATALOG_QUEUE_TIMEOUT,
+            rate_per_second=Config.ADMISSION_CATALOG_RATE_PER_SECOND,
+            burst=Config.ADMISSION_CATALOG_BURST
+        )
+    },
+    routes=(
+        ("/ask", "llm"),
+        ("/cbt", "catalog"),
+        ("/shifa", "catalog"),
+        ("/knowledge", "catalog")
+    ),
+    priority_check=_is_emergency_body
+)
@@ -2,22 +2,38 @@
 Main FastAPI Application for ShifaAI
 Orchestrates all modules: Medical Q&A, CBT, Shifa guidance
 """
-from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 from typing import Dict, List, Optional, Any
 import asyncio
+import hmac
+import json
+import time
 from datetime import datetime
 import uvicorn
 
 # Import our modules
-from .utils import logger, settings, validate_input, ResponseFormatter, Config
+from .utils import (logger, settings, validate_input, ResponseFormatter, Config, is_emergency_query, get_request_id,
+                    encode_cursor, decode_cursor)
 from .scraper import initialize_knowledge_base, knowledge_base, medical_scraper
 from .gpt_router import process_medical_query, gpt_router
 from .cbt import cbt_engine
 from .shifa import get_shifa_guidance, shifa_engine
+from .memory import conversation_store
+from .admission import AdmissionControlMiddleware, admission_controller
+from .cache import response_cache, TieredCache
+from .ingest import FAQIngestor, iter_ndjson_lines
+from .profiling import ProfilingMiddleware, request_profiler, collect_stages
+from .tracing import TracingMiddleware, InMemorySpanExporter, FileSpanExporter, tracer
+from .hedging import DeadlineMiddleware, llm_hedger
+from .routing import model_router
+from .usage import usage_accountant
+from .warmup import load_answer_store
+from .prefetch import followup_prefetcher
+from .querylog import query_log, build_entry
 
 # Pydantic models for API requests
 class HealthQuery(BaseModel):
@@ -39,7 +55,7 @@ class HealthResponse(BaseModel):
     data: Optional[Dict[str, Any]] = None
     error: Optional[str] = None
     timestamp: str
-    request_id: Optional[str] = None
+    request_id: Optional[str] = Field(default_factory=get_request_id)
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -50,6 +66,9 @@ app = FastAPI(
     redoc_url="/redoc"
 )
 
+# Admission control (added before CORS so rejections still carry CORS headers)
+app.add_middleware(AdmissionControlMiddleware, controller=admission_controller)
+
 # CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -59,6 +78,16 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# On-demand profiling is only wired in when an admin token is configured, so it costs nothing otherwise
+if request_profiler.enabled:
+    app.add_middleware(ProfilingMiddleware, profiler=request_profiler)
+
+# The deadline starts before admission queueing, which counts against it
+app.add_middleware(DeadlineMiddleware)
+
+# Tracing is outermost so every response, including rejections, carries a request ID
+app.add_middleware(TracingMiddleware, tracer=tracer)
+
 # Mount static files for web interface
 try:
     app.mount("/static", StaticFiles(directory="static"), name="static")
@@ -66,27 +95,78 @@ except RuntimeError:
     # Directory doesn't exist yet, will be created later
     logger.info("Static directory not found, will serve without static files for now")
 
+_engines_loaded = False
+
+def load_engines():
+    """Load the knowledge base and build the indexes requests use, once per process tree
+    
+    The production launcher (backend/server.py) calls this in the master
+    before forking workers, so workers share the loaded data copy-on-write
+    and skip it at startup.
+    """
+    global _engines_loaded
+    if _engines_loaded:
+        return
+    initialize_knowledge_base()
+    if gpt_router.knowledge_short_circuit["enabled"] and gpt_router.knowledge_short_circuit["mode"] == "dense":
+        knowledge_base.get_dense_index()
+    knowledge_base.get_suggestion_index()
+    if Config.SPELLING_CORRECTION_ENABLED:
+        knowledge_base.get_spelling_corrector()
+    _engines_loaded = True
+
 # Startup event
 @app.on_event("startup")
 async def startup_event():
     """Initialize application on startup"""
     logger.info("Starting ShifaAI application...")
     
-    # Initialize knowledge base
+    # Initialize knowledge base (already done if the launcher preloaded it)
     try:
-        initialize_knowledge_base()
+        load_engines()
         logger.info("Knowledge base initialized successfully")
     except Exception as e:
         logger.error(f"Failed to initialize knowledge base: {str(e)}")
     
+    # Start with the answers pre-generated by the cache warming job
+    if Config.WARMUP_ANSWERS_FILE:
+        try:
+            loaded = load_answer_store(Config.WARMUP_ANSWERS_FILE)
+            logger.info(f"Loaded {loaded} warmed answers from {Config.WARMUP_ANSWERS_FILE}")
+        except FileNotFoundError:
+            logger.warning(f"Warmed answer file {Config.WARMUP_ANSWERS_FILE} not found")
+        except Exception as e:
+            logger.error(f"Failed to load warmed answers: {str(e)}")
+    
     # Verify OpenAI API key
     if not settings.openai_api_key:
         logger.warning("OpenAI API key not found. AI responses will use fallback mode.")
     else:
         logger.info("OpenAI API key configured successfully")
     
+    # Periodically persist LLM usage totals, and write the query log in batches
+    if usage_accountant.flush_interval > 0:
+        app.state.usage_flusher = asyncio.create_task(usage_accountant.run_periodic_flush())
+    if query_log.enabled:
+        app.state.query_log_writer = asyncio.create_task(query_log.run())
+    
     logger.info("ShifaAI application startup complete")
 
+# Shutdown event
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Persist state that is only flushed periodically"""
+    for task_name in ("usage_flusher", "query_log_writer"):
+        task = getattr(app.state, task_name, None)
+        if task is not None:
+            task.cancel()
+    followup_prefetcher.cancel()
+    await asyncio.to_thread(usage_accountant.flush)
+    if query_log.enabled:
+        await asyncio.to_thread(query_log.flush)
+    if isinstance(tracer.exporter, FileSpanExporter):
+        await asyncio.to_thread(tracer.exporter.flush)
+
 # Health check endpoint
 @app.get("/health", response_model=Dict[str, Any])
 async def health_check():
@@ -123,7 +203,7 @@ async def health_check():
 
 # Main medical query endpoint
 @app.post("/ask", response_model=HealthResponse)
-async def ask_health_question(query: HealthQuery, background_tasks: BackgroundTasks):
+async def ask_health_question(query: HealthQuery):
     """
     Main endpoint for health questions with optional CBT and Shifa guidance
     """
@@ -133,19 +213,31 @@ async def ask_health_question(query: HealthQuery, background_tasks: BackgroundTa
             raise HTTPException(status_code=400, detail="Invalid question format")
         
         logger.info(f"Processing health query: {query.question[:50]}...")
+        knowledge_base.record_question(query.question)
+        followup_prefetcher.record_question(query.question)
         
-        # Process the medical query
-        response_data = await process_medical_query(
-            query=query.question,
-            enable_cbt=query.include_cbt,
-            enable_shifa=query.include_shifa
-        )
+        # Process the medical query, charging its LLM usage to this endpoint and user
+        start = time.perf_counter()
+        with usage_accountant.attribute("/ask", query.user_id) as request_usage, collect_stages() as stages:
+            response_data = await process_medical_query(
+                query=query.question,
+                enable_cbt=query.include_cbt,
+                enable_shifa=query.include_shifa,
+                user_id=query.user_id
+            )
+        if query_log.enabled:
+            query_log.record(build_entry("/ask", query, response_data, stages, time.perf_counter() - start))
+        
+        # Answer the suggested follow-ups in the background so clicking one is served from cache
+        followup_prefetcher.schedule(response_data.get("medical_response", {}))
         
         # Add request metadata
         response_data["request_metadata"] = {
             "include_cbt": query.include_cbt,
             "include_shifa": query.include_shifa,
             "user_id": query.user_id,
+            "fast_lane": response_data.get("medical_response", {}).get("fast_lane", False),
+            "llm_usage": request_usage.to_dict(),
             "processed_at": datetime.now().isoformat()
         }
         
@@ -165,6 +257,34 @@ async def ask_health_question(query: HealthQuery, background_tasks: BackgroundTa
             timestamp=datetime.now().isoformat()
         )
 
+@app.post("/ask/stream")
+async def ask_health_question_stream(query: HealthQuery):
+    """
+    Stream the answer to a health question as NDJSON events.
+    Emergency questions get the local safety response as the first event,
+    followed by the LLM elaboration.
+    """
+    if not validate_input(query.question):
+        raise HTTPException(status_code=400, detail="Invalid question format")
+    
+    async def event_stream():
+        if is_emergency_query(query.question):
+            safety_response = gpt_router.get_emergency_response(query.question)
+            yield json.dumps({"type": "safety", "data": safety_response}) + "\n"
+        
+        try:
+            context = conversation_store.get_context(query.user_id)
+            with usage_accountant.attribute("/ask/stream", query.user_id):
+                async for delta in gpt_router.stream_medical_response(query.question, context):
+                    yield json.dumps({"type": "delta", "content": delta}) + "\n"
+        except Exception as e:
+            logger.error(f"Error streaming health query: {str(e)}")
+            yield json.dumps({"type": "error", "error": "Unable to stream a detailed answer right now."}) + "\n"
+        
+        yield json.dumps({"type": "done", "timestamp": datetime.now().isoformat()}) + "\n"
+    
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
 # CBT-specific endpoints
 @app.post("/cbt/recommendation", response_model=HealthResponse)
 async def get_cbt_recommendation_endpoint(request: CBTRequest):
@@ -317,24 +437,58 @@ async def get_prophetic_medicine(condition: Optional[str] = None):
 
 # Knowledge base endpoints
 @app.get("/knowledge/search", response_model=HealthResponse)
-async def search_knowledge_base(q: str, category: Optional[str] = None, limit: int = 5):
-    """Search the medical knowledge base"""
+async def search_knowledge_base(q: str, category: Optional[str] = None, limit: int = 5, mode: str = "keyword",
+                                cursor: Optional[str] = None):
+    """
+    Search the medical knowledge base (keyword or dense vector retrieval).
+    Results are paginated: pass the returned next_cursor to get the following page.
+    """
     try:
         if not validate_input(q):
             raise HTTPException(status_code=400, detail="Invalid search query")
+        if mode not in knowledge_base.SEARCH_MODES:
+            raise HTTPException(status_code=400, detail=f"Invalid search mode. Available modes: {list(knowledge_base.SEARCH_MODES)}")
+        if limit < 1:
+            raise HTTPException(status_code=400, detail="Limit must be positive")
+        limit = min(limit, Config.KNOWLEDGE_SEARCH_MAX_LIMIT)
+        
+        # The cursor pins the query and corpus version so pages never silently shift
+        search_key = TieredCache.make_key("knowledge_search", q, category, mode)
+        offset = 0
+        if cursor is not None:
+            state = decode_cursor(cursor)
+            offset = state.get("offset") if state is not None else None
+            if state is None or state.get("key") != search_key or not isinstance(offset, int) or \
+                    isinstance(offset, bool) or not 0 <= offset <= Config.KNOWLEDGE_SEARCH_MAX_OFFSET:
+                raise HTTPException(status_code=400, detail="Invalid cursor")
+            if state.get("version") != knowledge_base.version:
+                raise HTTPException(status_code=410, detail="Knowledge base changed since this cursor was issued; restart the search")
         
-        results = knowledge_base.search_faqs(q, category, limit)
+        # One extra result tells whether another page exists
+        results = knowledge_base.search_faqs(q, category, offset + limit + 1, mode=mode)[offset:]
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            # Paging stops at KNOWLEDGE_SEARCH_MAX_OFFSET; deeper results need a narrower query
+            if offset + limit <= Config.KNOWLEDGE_SEARCH_MAX_OFFSET:
+                next_cursor = encode_cursor({"key": search_key, "offset": offset + limit,
+                                             "version": knowledge_base.version})
         
         return HealthResponse(
             success=True,
             data={
                 "query": q,
+                "mode": mode,
                 "results": results,
-                "total_found": len(results)
+                "total_found": len(results),
+                "limit": limit,
+                "next_cursor": next_cursor
             },
             timestamp=datetime.now().isoformat()
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error searching knowledge base: {str(e)}")
         return HealthResponse(
@@ -343,6 +497,58 @@ async def search_knowledge_base(q: str, category: Optional[str] = None, limit: i
             timestamp=datetime.now().isoformat()
         )
 
+@app.get("/knowledge/suggest", response_model=HealthResponse)
+async def suggest_questions(q: str, limit: int = 8):
+    """Autocomplete a partially typed question from knowledge base questions and medical keywords"""
+    try:
+        if limit < 1:
+            raise HTTPException(status_code=400, detail="Limit must be positive")
+        
+        suggestions = knowledge_base.get_suggestion_index().suggest(q, min(limit, Config.SUGGEST_MAX_LIMIT))
+        
+        return HealthResponse(
+            success=True,
+            data={
+                "query": q,
+                "suggestions": suggestions
+            },
+            timestamp=datetime.now().isoformat()
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting question suggestions: {str(e)}")
+        return HealthResponse(
+            success=False,
+            error="Unable to get suggestions. Please try again later.",
+            timestamp=datetime.now().isoformat()
+        )
+
+@app.get("/knowledge/export")
+async def export_knowledge_base(category: Optional[str] = None):
+    """
+    Stream the knowledge base as NDJSON, one FAQ per line.
+    Reads a snapshot of the live corpus in chunks, so memory use does not grow with corpus size.
+    """
+    faqs = knowledge_base.get_category_faqs(category) if category else knowledge_base.faqs
+    
+    def ndjson_chunks():
+        lines = []
+        for faq in faqs:
+            lines.append(json.dumps(faq, ensure_ascii=False))
+            if len(lines) >= Config.KNOWLEDGE_EXPORT_CHUNK_SIZE:
+                yield "\n".join(lines) + "\n"
+                lines = []
+        if lines:
+            yield "\n".join(lines) + "\n"
+    
+    return StreamingResponse(
+        ndjson_chunks(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": "attachment; filename=medical_faqs.ndjson"}
+    )
+
 @app.get("/knowledge/categories", response_model=HealthResponse)
 async def get_knowledge_categories():
     """Get available knowledge base categories"""
@@ -647,6 +853,19 @@ async def get_web_interface():
     </html>
     """
 
+async def require_admin_token(x_admin_token: Optional[str] = Header(default=None)):
+    """Guard admin endpoints that change the knowledge base or how it answers
+    
+    The X-Admin-Token header is checked against ADMIN_TOKEN in constant time;
+    with no ADMIN_TOKEN configured these endpoints refuse every request.
+    """
+    if not x_admin_token:
+        raise HTTPException(status_code=401, detail="Admin token required")
+    if not Config.ADMIN_TOKEN or not hmac.compare_digest(x_admin_token.encode("utf-8"),
+                                                         Config.ADMIN_TOKEN.encode("utf-8")):
+        logger.warning("Rejected admin token")
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
 # Admin endpoints (basic)
 @app.get("/admin/stats", response_model=HealthResponse)
 async def get_admin_stats():
@@ -656,7 +875,18 @@ async def get_admin_stats():
             "knowledge_base": knowledge_base.get_stats(),
             "cbt_exercises": len(cbt_engine.exercises),
             "shifa_duas": len(shifa_engine.duas),
-            "prophetic_medicines": len(shifa_engine.prophetic_remedies)
+            "prophetic_medicines": len(shifa_engine.prophetic_remedies),
+            "conversations": conversation_store.get_stats(),
+            "admission_control": admission_controller.get_stats(),
+            "response_cache": response_cache.get_stats(),
+            "knowledge_short_circuit": gpt_router.get_short_circuit_stats(),
+            "llm_hedging": llm_hedger.get_stats(),
+            "model_routes": model_router.get_stats(),
+            "llm_usage": usage_accountant.get_stats(),
+            "followup_prefetch": followup_prefetcher.get_stats(),
+            "query_log": query_log.get_stats(),
+            "profiling": request_profiler.get_stats(),
+            "tracing": tracer.get_stats()
         }
         
         return HealthResponse(
@@ -673,6 +903,96 @@ async def get_admin_stats():
             timestamp=datetime.now().isoformat()
         )
 
+@app.post("/admin/knowledge/ingest", response_model=HealthResponse, dependencies=[Depends(require_admin_token)])
+async def ingest_knowledge(request: Request, batch_size: int = Config.INGEST_BATCH_SIZE, persist: bool = False):
+    """
+    Bulk-ingest FAQs streamed as NDJSON, one {"question", "answer", "source", "category"} object per line.
+    Records are cleaned like scraped content and added to the live knowledge base in batches.
+    """
+    if not 1 <= batch_size <= Config.INGEST_MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"batch_size must be between 1 and {Config.INGEST_MAX_BATCH_SIZE}")
+    
+    try:
+        ingestor = FAQIngestor(knowledge_base, medical_scraper, batch_size)
+        async for line_number, line in iter_ndjson_lines(request.stream()):
+            await ingestor.feed(line_number, line)
+        report = await ingestor.finish()
+        
+        if persist and report["added"]:
+            await asyncio.to_thread(medical_scraper.save_faqs_to_file, knowledge_base.faqs)
+        
+        return HealthResponse(
+            success=True,
+            data=report,
+            timestamp=datetime.now().isoformat()
+        )
+        
+    except Exception as e:
+        logger.error(f"Error ingesting knowledge base records: {str(e)}")
+        return HealthResponse(
+            success=False,
+            error="Unable to ingest knowledge base records",
+            timestamp=datetime.now().isoformat()
+        )
+
+@app.post("/admin/knowledge/reload", response_model=HealthResponse, dependencies=[Depends(require_admin_token)])
+async def reload_knowledge_category(category: str):
+    """
+    Reload one category of the knowledge base from the FAQ file.
+    Only that category's shard is rebuilt; the other shards are kept as they are.
+    """
+    try:
+        loaded = await asyncio.to_thread(knowledge_base.load_category, category)
+        
+        return HealthResponse(
+            success=True,
+            data={"category": category, "loaded": loaded, "version": knowledge_base.version},
+            timestamp=datetime.now().isoformat()
+        )
+        
+    except Exception as e:
+        logger.error(f"Error reloading knowledge base category {category}: {str(e)}")
+        return HealthResponse(
+            success=False,
+            error="Unable to reload knowledge base category",
+            timestamp=datetime.now().isoformat()
+        )
+
+@app.post("/admin/knowledge-short-circuit", response_model=HealthResponse, dependencies=[Depends(require_admin_token)])
+async def tune_knowledge_short_circuit(threshold: Optional[float] = None, enabled: Optional[bool] = None):
+    """Tune the knowledge base short-circuit threshold at runtime"""
+    if threshold is not None:
+        if not 0 < threshold <= 1:
+            raise HTTPException(status_code=400, detail="Threshold must be greater than 0 and at most 1")
+        gpt_router.knowledge_short_circuit["threshold"] = threshold
+    if enabled is not None:
+        gpt_router.knowledge_short_circuit["enabled"] = enabled
+    
+    return HealthResponse(
+        success=True,
+        data=gpt_router.get_short_circuit_stats(),
+        timestamp=datetime.now().isoformat()
+    )
+
+@app.get("/admin/traces/{request_id}", response_model=HealthResponse)
+async def get_request_trace(request_id: str):
+    """Get the recorded spans of a request, slowest first"""
+    if not isinstance(tracer.exporter, InMemorySpanExporter):
+        raise HTTPException(status_code=404, detail="Trace lookup requires TRACING_EXPORTER=memory")
+    
+    spans = tracer.exporter.get_spans(request_id)
+    if not spans:
+        raise HTTPException(status_code=404, detail="No spans recorded for this request")
+    
+    return HealthResponse(
+        success=True,
+        data={
+            "request_id": request_id,
+            "spans": [span.to_dict() for span in sorted(spans, key=lambda span: span.duration_ms, reverse=True)]
+        },
+        timestamp=datetime.now().isoformat()
+    )
+
 # Error handlers
 @app.exception_handler(404)
 async def not_found_handler(request, exc):
@@ -698,10 +1018,15 @@ async def internal_error_handler(request, exc):
     )
 
 if __name__ == "__main__":
-    uvicorn.run(
-        "backend.app:app",
-        host=settings.host,
-        port=settings.port,
-        reload=settings.debug,
-        log_level="info"
-    ) 
\ No newline at end of file
+    if settings.debug:
+        # Single auto-reloading process for development
+        uvicorn.run(
+            "backend.app:app",
+            host=settings.host,
+            port=settings.port,
+            reload=True,
+            log_level="info"
+        )
+    else:
+        from .server import main
+        main() 
\ No newline at end of file
@@ -0,0 +1,352 @@
+"""
+Two-tier Cache for ShifaAI
+Bounded per-process L1 in front of a shared L2 (Redis, or a local stand-in)
+"""
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from .utils import logger, settings, Config
+
+try:
+    import redis
+except ImportError:  # Optional dependency; the local backend is used instead
+    redis = None
+
+# Marks an L1 miss (None is a cacheable value)
+_MISSING = object()
+
+class LocalBackend:
+    """In-process stand-in for the shared L2 tier (tests and single-worker dev)
+
+    Entries are evicted least recently used past ``max_entries``, and expired
+    ones are swept every ``sweep_interval`` seconds. Counters (namespace
+    versions) are kept apart and never evicted, since losing one would make
+    entries of an older version current again.
+    """
+
+    # Calls return without I/O, so async callers need not move them off the event loop
+    blocking = False
+
+    def __init__(self, max_entries: int = Config.CACHE_LOCAL_MAX_ENTRIES, sweep_interval: float = 60.0):
+        self.max_entries = max_entries
+        self.sweep_interval = sweep_interval
+        self._data: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._counters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._swept_at = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key in self._counters:
+                return str(self._counters[key])
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at and expires_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: int):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl if ttl else 0)
+            self._data.move_to_end(key)
+            if time.monotonic() - self._swept_at >= self.sweep_interval:
+                self._sweep()
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+            self._counters.pop(key, None)
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            value = self._counters.get(key, 0) + 1
+            self._counters[key] = value
+            return value
+
+    def _sweep(self):
+        """Drop expired entries (callers hold the lock)"""
+        now = time.time()
+        for key in [key for key, (_, expires_at) in self._data.items() if expires_at and expires_at < now]:
+            del self._data[key]
+        self._swept_at = time.monotonic()
+
+class RedisBackend:
+    """Shared L2 tier backed by Redis, shared by every worker on the host"""
+
+    # Calls are network round trips; async callers run them in a thread
+    blocking = True
+
+    def __init__(self, url: str):
+        self.client = redis.Redis.from_url(url, socket_timeout=0.05, socket_connect_timeout=0.2,
+                                           decode_responses=True)
+
+    def get(self, key: str) -> Optional[str]:
+        return self.client.get(key)
+
+    def set(self, key: str, value: str, ttl: int):
+        self.client.set(key, value, ex=ttl or None)
+
+    def delete(self, key: str):
+        self.client.delete(key)
+
+    def incr(self, key: str) -> int:
+        return int(self.client.incr(key))
+
+class TieredCache:
+    """Bounded LRU L1 per process, shared L2 across workers, versioned namespaces
+
+    Keys are hashed from their normalized parts, so every worker computes the
+    same key. ``invalidate()`` bumps the namespace version in L2; other
+    workers pick up the new version within ``version_check_interval`` seconds
+    and stop serving older entries from both tiers. Code on the event loop
+    uses ``aget``/``aset``, which run L2 round trips to a blocking backend in
+    a thread.
+    """
+
+    def __init__(self, namespace: str, backend, l1_max_entries: int = Config.CACHE_L1_MAX_ENTRIES,
+                 l1_ttl: int = Config.CACHE_L1_TTL_SECONDS, l2_ttl: int = Config.CACHE_L2_TTL_SECONDS,
+                 version_check_interval: float = Config.CACHE_VERSION_CHECK_SECONDS):
+        self.namespace = namespace
+        self.backend = backend
+        self.l1_max_entries = l1_max_entries
+        self.l1_ttl = l1_ttl
+        self.l2_ttl = l2_ttl
+        self.version_check_interval = version_check_interval
+        self._l1: "OrderedDict[str, Tuple[int, float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._version = 0
+        self._version_checked_at = 0.0
+        self._stats = {"l1_hits": 0, "l2_hits": 0, "misses": 0, "sets": 0, "l2_errors": 0, "invalidations": 0}
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """Hash normalized key parts into a stable, worker-independent digest"""
+        normalized = json.dumps(
+            [part.strip().lower() if isinstance(part, str) else part for part in parts],
+            sort_keys=True, separators=(",", ":"), default=str
+        )
+        return hashlib.blake2b(normalized.encode("utf-8"), digest_size=16).hexdigest()
+
+    @property
+    def version(self) -> int:
+        """Current namespace version, refreshed from L2 at most every check interval"""
+        now = time.monotonic()
+        if now - self._version_checked_at >= self.version_check_interval:
+            self._version_checked_at = now
+            try:
+                shared = self.backend.get(self._version_key())
+                self._version = int(shared) if shared else 0
+            except Exception as e:
+                self._stats["l2_errors"] += 1
+                logger.warning(f"Cache L2 version check failed for {self.namespace}: {str(e)}")
+        return self._version
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Look a key up in L1, then L2 (promoting hits into L1)"""
+        version = self.version
+        value = self._l1_get(key, version)
+        if value is not _MISSING:
+            return value
+
+        raw = self._l2_get(self._l2_key(key, version))
+        if raw is not None:
+            value = json.loads(raw)
+            self._l1_put(key, version, value)
+            self._stats["l2_hits"] += 1
+            return value
+
+        self._stats["misses"] += 1
+        return default
+
+    def set(self, key: str, value: Any):
+        """Store a JSON-serializable value in both tiers"""
+        version = self.version
+        self._l1_put(key, version, value)
+        self._stats["sets"] += 1
+        try:
+            self.backend.set(self._l2_key(key, version), json.dumps(value), self.l2_ttl)
+        except Exception as e:
+            self._stats["l2_errors"] += 1
+            logger.warning(f"Cache L2 write failed for {self.namespace}: {str(e)}")
+
+    async def aget(self, key: str, default: Any = None) -> Any:
+        """``get`` for the event loop: L1 hits are served inline, L2 round trips run in a thread"""
+        if not self.backend.blocking:
+            return self.get(key, default)
+        if time.monotonic() - self._version_checked_at < self.version_check_interval:
+            value = self._l1_get(key, self._version)
+            if value is not _MISSING:
+                return value
+        return await asyncio.to_thread(self.get, key, default)
+
+    async def aset(self, key: str, value: Any):
+        """``set`` for the event loop"""
+        if not self.backend.blocking:
+            self.set(key, value)
+        else:
+            await asyncio.to_thread(self.set, key, value)
+
+    def sync_data_version(self, data_version: str) -> bool:
+        """Invalidate the namespace unless its entries were computed from ``data_version``; True if it did
+
+        Called whenever the data the cached values derive from changes, so a
+        restart over unchanged data keeps the shared tier warm.
+        """
+        key = f"shifa:{self.namespace}:data"
+        try:
+            current = self.backend.get(key)
+        except Exception as e:
+            self._stats["l2_errors"] += 1
+            logger.warning(f"Cache L2 data version check failed for {self.namespace}: {str(e)}")
+            current = None
+        if current == data_version:
+            return False
+        self.invalidate()
+        try:
+            self.backend.set(key, data_version, 0)
+        except Exception as e:
+            self._stats["l2_errors"] += 1
+            logger.warning(f"Cache L2 data version write failed for {self.namespace}: {str(e)}")
+        return True
+
+    def invalidate(self) -> int:
+        """Invalidate the whole namespace across all workers by bumping its version"""
+        try:
+            self._version = self.backend.incr(self._version_key())
+        except Exception as e:
+            self._stats["l2_errors"] += 1
+            self._version += 1
+            logger.warning(f"Cache L2 invalidation failed for {self.namespace}: {str(e)}")
+        self._version_checked_at = time.monotonic()
+        with self._lock:
+            self._l1.clear()
+        self._stats["invalidations"] += 1
+        return self._version
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get hit/miss statistics for this cache"""
+        lookups = self._stats["l1_hits"] + self._stats["l2_hits"] + self._stats["misses"]
+        hits = self._stats["l1_hits"] + self._stats["l2_hits"]
+        return {
+            **self._stats,
+            "version": self._version,
+            "l1_entries": len(self._l1),
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0
+        }
+
+    def _l1_get(self, key: str, version: int) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._l1.get(key)
+            if entry is not None:
+                entry_version, expires_at, value = entry
+                if entry_version == version and expires_at > now:
+                    self._l1.move_to_end(key)
+                    self._stats["l1_hits"] += 1
+                    return value
+                del self._l1[key]
+        return _MISSING
+
+    def _l1_put(self, key: str, version: int, value: Any):
+        with self._lock:
+            self._l1[key] = (version, time.monotonic() + self.l1_ttl, value)
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_max_entries:
+                self._l1.popitem(last=False)
+
+    def _l2_get(self, l2_key: str) -> Optional[str]:
+        try:
+            return self.backend.get(l2_key)
+        except Exception as e:
+            self._stats["l2_errors"] += 1
+            logger.warning(f"Cache L2 read failed for {self.namespace}: {str(e)}")
+            return None
+
+    def _l2_key(self, key: str, version: int) -> str:
+        return f"shifa:{self.namespace}:v{version}:{key}"
+
+    def _version_key(self) -> str:
+        return f"shifa:{self.namespace}:version"
+
+class VersionedLRUCache:
+    """Bounded per-process LRU whose entries are tagged with a data version
+
+    Lookups made with a newer version than an entry was stored under treat
+    it as stale and drop it, so results computed over an older corpus are
+    never served even if ``clear()`` is not called.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Any, Tuple[int, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "clears": 0}
+
+    def get(self, key: Any, version: int, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] == version:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return entry[1]
+                del self._entries[key]
+                self._stats["stale"] += 1
+            self._stats["misses"] += 1
+            return default
+
+    def set(self, key: Any, version: int, value: Any):
+        with self._lock:
+            self._entries[key] = (version, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats["clears"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get hit/miss statistics for this cache"""
+        lookups = self._stats["hits"] + self._stats["misses"]
+        return {
+            **self._stats,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hit_ratio": round(self._stats["hits"] / lookups, 4) if lookups else 0.0
+        }
+
+def create_shared_backend():
+    """Create the shared L2 backend configured by CACHE_BACKEND"""
+    if Config.CACHE_BACKEND == "redis":
+        if redis is None:
+            logger.warning("CACHE_BACKEND=redis but the redis package is not installed; using local cache")
+        else:
+            try:
+                backend = RedisBackend(settings.redis_url)
+                backend.client.ping()
+                logger.info("Using Redis as the shared cache tier")
+                return backend
+            except Exception as e:
+                logger.warning(f"Redis unavailable at {settings.redis_url}, using local cache: {str(e)}")
+    return LocalBackend()
+
+# Global instances
+shared_backend = create_shared_backend()
+response_cache = TieredCache("responses", shared_backend)
@@ -3,12 +3,15 @@ CBT (Cognitive Behavioral Therapy) Module for ShifaAI
 Provides therapeutic exercises and mental health support
 """
 import random
-from typing import Dict, List, Optional, Any
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
 import logging
 from datetime import datetime
 from enum import Enum
 
 from .utils import logger, clean_text, ResponseFormatter, extract_keywords
+from .records import CatalogRecord, RecordView
+from .tracing import tracer
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +45,15 @@ class CognitiveDistortion(Enum):
     LABELING = "labeling"
     PERSONALIZATION = "personalization"
 
+@dataclass(frozen=True, slots=True)
+class CBTExercise(CatalogRecord):
+    """Immutable CBT exercise catalog entry"""
+    name: str
+    description: str
+    steps: Tuple[str, ...]
+    duration: str
+    best_for: Tuple[str, ...]
+
 class CBTEngine:
     """Cognitive Behavioral Therapy exercise and coaching module"""
     
@@ -49,9 +61,9 @@ class CBTEngine:
         self.exercises = self._load_cbt_exercises()
         self.cognitive_distortions = self._load_cognitive_distortions()
         
-    def _load_cbt_exercises(self) -> Dict[str, Dict[str, Any]]:
+    def _load_cbt_exercises(self) -> Dict[str, CBTExercise]:
         """Load CBT exercises database"""
-        return {
+        exercises = {
             "breathing": {
                 "name": "4-7-8 Breathing Technique",
                 "description": "A calming breathing exercise to reduce anxiety and stress",
@@ -122,6 +134,7 @@ class CBTEngine:
                 "best_for": ["depression", "low_motivation", "isolation", "anhedonia"]
             }
         }
+        return {exercise_id: CBTExercise.from_dict(data) for exercise_id, data in exercises.items()}
     
     def _load_cognitive_distortions(self) -> Dict[str, str]:
         """Load cognitive distortions reference"""
@@ -138,7 +151,8 @@ class CBTEngine:
             "personalization": "Blaming yourself for things outside your control"
         }
     
-    def recommend_exercise(self, symptoms: List[str], mood_rating: int = None) -> Dict[str, Any]:
+    @tracer.traced("cbt.recommend_exercise")
+    def recommend_exercise(self, symptoms: List[str], mood_rating: int = None) -> RecordView:
         """Recommend CBT exercise based on symptoms and mood"""
         try:
             # Convert symptoms to lowercase for matching
@@ -149,10 +163,10 @@ class CBTEngine:
             for exercise_id, exercise in self.exercises.items():
                 score = 0
                 for symptom in symptoms_lower:
-                    if symptom in exercise["best_for"]:
+                    if symptom in exercise.best_for:
                         score += 2
                     # Partial matches
-                    for condition in exercise["best_for"]:
+                    for condition in exercise.best_for:
                         if symptom in condition or condition in symptom:
                             score += 1
                 exercise_scores[exercise_id] = score
@@ -160,19 +174,19 @@ class CBTEngine:
             # Get best matching exercise
             if exercise_scores:
                 best_exercise_id = max(exercise_scores, key=exercise_scores.get)
-                recommended_exercise = self.exercises[best_exercise_id].copy()
-                recommended_exercise["id"] = best_exercise_id
-                recommended_exercise["match_score"] = exercise_scores[best_exercise_id]
+                match_score = exercise_scores[best_exercise_id]
             else:
                 # Default to breathing exercise
-                recommended_exercise = self.exercises["breathing"].copy()
-                recommended_exercise["id"] = "breathing"
-                recommended_exercise["match_score"] = 1
-            
-            # Add personalized encouragement
-            recommended_exercise["encouragement"] = self._get_encouragement(symptoms_lower, mood_rating)
+                best_exercise_id = "breathing"
+                match_score = 1
             
-            return recommended_exercise
+            # Wrap the shared catalog entry with the request-specific fields
+            return RecordView(
+                self.exercises[best_exercise_id],
+                id=best_exercise_id,
+                match_score=match_score,
+                encouragement=self._get_encouragement(symptoms_lower, mood_rating)
+            )
             
         except Exception as e:
             logger.error(f"Error recommending CBT exercise: {str(e)}")
@@ -196,12 +210,13 @@ class CBTEngine:
         
         return random.choice(encouragements)
     
-    def _get_default_exercise(self) -> Dict[str, Any]:
+    def _get_default_exercise(self) -> RecordView:
         """Return default exercise when recommendation fails"""
-        exercise = self.exercises["breathing"].copy()
-        exercise["id"] = "breathing"
-        exercise["encouragement"] = "Take a moment to breathe and center yourself. You deserve care and compassion."
-        return exercise
+        return RecordView(
+            self.exercises["breathing"],
+            id="breathing",
+            encouragement="Take a moment to breathe and center yourself. You deserve care and compassion."
+        )
     
     def get_daily_cbt_tip(self) -> str:
         """Get a daily CBT tip or insight"""
@@ -273,7 +288,8 @@ class CBTEngine:
 # Global instance
 cbt_engine = CBTEngine()
 
-def get_cbt_recommendation(query: str, category: str = None, mood_rating: int = None) -> Dict[str, Any]:
+@tracer.traced("cbt")
+def get_cbt_recommendation(query: str, category: str = None, mood_rating: int = None) -> RecordView:
     """Get CBT recommendation - wrapper function for the CBTEngine.recommend_exercise method"""
     try:
         # Extract symptoms/keywords from query
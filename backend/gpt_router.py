@@ -3,12 +3,19 @@ GPT-4 Router for ShifaAI
 Handles OpenAI API integration and intelligent query routing
 """
 import openai
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, AsyncIterator, Tuple
 from enum import Enum
 import json
 import asyncio
-from .utils import logger, settings, categorize_medical_query, ResponseFormatter, Config, categorize_question, extract_keywords
-from .scraper import knowledge_base
+import time
+from .utils import logger, settings, categorize_medical_query, ResponseFormatter, Config, categorize_question, extract_keywords, is_emergency_query, estimate_tokens, truncate_to_tokens
+from .scraper import knowledge_base, question_overlap
+from .memory import conversation_store
+from .cache import response_cache
+from .tracing import tracer
+from .hedging import llm_hedger
+from .routing import model_router
+from .usage import usage_accountant
 
 # Initialize OpenAI client
 openai.api_key = settings.openai_api_key
@@ -30,6 +37,14 @@ class GPTRouter:
     def __init__(self):
         openai.api_key = Config.OPENAI_API_KEY
         self.client = openai.OpenAI(api_key=Config.OPENAI_API_KEY)
+        self.knowledge_short_circuit = {
+            "enabled": Config.KB_SHORT_CIRCUIT_ENABLED,
+            "mode": Config.KB_SHORT_CIRCUIT_MODE,
+            "threshold": Config.KB_SHORT_CIRCUIT_THRESHOLD,
+            "lookups": 0,
+            "hits": 0,
+            "best_score_histogram": {}
+        }
         
     def get_medical_system_prompt(self, category: str = "general_health") -> str:
         """Get system prompt based on question category"""
@@ -61,36 +76,125 @@ Remember: You are providing health education and support, not medical diagnosis
         
         return base_prompt + category_specific.get(category, "")
     
+    def retrieve_passages(self, question: str) -> List[Dict[str, Any]]:
+        """Retrieve the top-k knowledge base passages for retrieval-augmented prompting"""
+        if not Config.RAG_ENABLED:
+            return []
+        
+        matches = knowledge_base.search_faqs(question, limit=Config.RAG_TOP_K, mode=Config.RAG_SEARCH_MODE)
+        return [match for match in matches if match["relevance_score"] >= Config.RAG_MIN_SCORE]
+    
+    def build_rag_context(self, passages: List[Dict[str, Any]],
+                          token_budget: int = Config.RAG_CONTEXT_TOKENS) -> Tuple[str, int]:
+        """Render retrieved passages as reference material trimmed to a token budget"""
+        lines = []
+        used_tokens = 0
+        for number, passage in enumerate(passages, 1):
+            remaining = token_budget - used_tokens
+            if remaining <= 20:
+                break
+            line = truncate_to_tokens(
+                f"[{number}] Q: {passage['question']} A: {passage['answer']} (Source: {passage.get('source', 'Unknown')})",
+                remaining
+            )
+            lines.append(line)
+            used_tokens += estimate_tokens(line)
+        
+        return "\n".join(lines), used_tokens
+    
+    def get_max_tokens(self, rag_context_tokens: int = 0, limit: int = 800) -> int:
+        """Completion budget: grounded answers only need to restate and adapt the references"""
+        if not rag_context_tokens:
+            return limit
+        return min(limit, Config.RAG_BASE_COMPLETION_TOKENS + rag_context_tokens // 2)
+    
+    def build_messages(self, question: str, category: str, context: Dict[str, Any] = None,
+                       rag_context: str = "") -> List[Dict[str, str]]:
+        """Build the chat messages for a question, including any conversation and retrieved context"""
+        # Get appropriate system prompt
+        system_prompt = self.get_medical_system_prompt(category)
+        
+        # Prepare the conversation
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": question}
+        ]
+        
+        # Ground the answer in retrieved knowledge base passages
+        if rag_context:
+            grounding_msg = (
+                "Reference material from the ShifaAI medical knowledge base:\n"
+                f"{rag_context}\n\n"
+                "Answer concisely (a short paragraph or a few bullet points), grounded in the reference "
+                "material above. If it does not cover the question, say so briefly and give general guidance."
+            )
+            messages.insert(1, {"role": "system", "content": grounding_msg})
+        
+        # Add context if provided
+        if context and context.get("previous_responses"):
+            context_msg = f"Previous conversation context: {context['previous_responses'][-1]}"
+            messages.insert(-1, {"role": "assistant", "content": context_msg})
+        
+        # Add bounded server-side conversation memory
+        if context and context.get("conversation_summary"):
+            summary_msg = f"Summary of earlier conversation with this user: {context['conversation_summary']}"
+            messages.insert(-1, {"role": "system", "content": summary_msg})
+        for turn in (context or {}).get("conversation_turns", []):
+            messages.insert(-1, {"role": "user", "content": turn["question"]})
+            messages.insert(-1, {"role": "assistant", "content": turn["answer"]})
+        
+        return messages
+    
     async def generate_medical_response(self, question: str, context: Dict[str, Any] = None) -> Dict[str, Any]:
         """Generate empathetic medical response using GPT-4"""
         try:
-            # Categorize the question
+            # Categorize the question as asked; the vocabulary is medical, so correcting
+            # it would rewrite ordinary words ("never" -> "fever"). Searches that find
+            # nothing retry with corrected terms on their own.
             category = categorize_question(question)
             keywords = extract_keywords(question)
             
-            # Get appropriate system prompt
-            system_prompt = self.get_medical_system_prompt(category)
+            with tracer.span("retrieval"):
+                passages = self.retrieve_passages(question)
+                rag_context, rag_tokens = self.build_rag_context(passages)
+            messages = self.build_messages(question, category, context, rag_context)
             
-            # Prepare the conversation
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": question}
-            ]
+            # Generate response with the category's model (hedged if slow, timed out at the request deadline)
+            route = model_router.route(category)
+            max_tokens = self.get_max_tokens(rag_tokens, route.max_tokens)
             
-            # Add context if provided
-            if context and context.get("previous_responses"):
-                context_msg = f"Previous conversation context: {context['previous_responses'][-1]}"
-                messages.insert(-1, {"role": "assistant", "content": context_msg})
+            def record_discarded(discarded_response, seconds: float):
+                # Losing hedges and calls that outlived the deadline are still billed
+                usage = getattr(discarded_response, "usage", None)
+                if isinstance(getattr(usage, "prompt_tokens", None), int):
+                    usage_accountant.record(route.model, category, usage.prompt_tokens, usage.completion_tokens,
+                                            seconds)
             
-            # Generate response
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=messages,
-                max_tokens=800,
-                temperature=0.7,
-                presence_penalty=0.1,
-                frequency_penalty=0.1
-            )
+            with tracer.span("llm", model=route.model, max_tokens=max_tokens) as llm_span:
+                start = time.perf_counter()
+                try:
+                    response = await llm_hedger.call(
+                        self.client.chat.completions.create,
+                        timeout_argument="timeout",
+                        on_discarded=record_discarded,
+                        model=route.model,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=route.temperature,
+                        presence_penalty=0.1,
+                        frequency_penalty=0.1
+                    )
+                except Exception:
+                    model_router.record(category, time.perf_counter() - start, error=True)
+                    raise
+                seconds = time.perf_counter() - start
+                usage = getattr(response, "usage", None)
+                model_router.record(category, seconds, usage)
+                if isinstance(getattr(usage, "prompt_tokens", None), int):
+                    usage_accountant.record(route.model, category, usage.prompt_tokens, usage.completion_tokens,
+                                            seconds)
+                if usage is not None:
+                    llm_span.set_attribute("total_tokens", usage.total_tokens)
             
             medical_response = response.choices[0].message.content
             
@@ -103,7 +207,11 @@ Remember: You are providing health education and support, not medical diagnosis
                 "keywords": keywords,
                 "follow_up_questions": follow_up_questions,
                 "confidence": "high",  # In a real system, this would be calculated
-                "sources_recommended": self.get_recommended_sources(category)
+                "sources_recommended": self.get_recommended_sources(category),
+                "grounding": [
+                    {"question": p["question"], "source": p.get("source", "Unknown"), "score": p["relevance_score"]}
+                    for p in passages
+                ]
             }
             
         except Exception as e:
@@ -117,6 +225,141 @@ Remember: You are providing health education and support, not medical diagnosis
                 "sources_recommended": []
             }
     
+    def answer_from_knowledge_base(self, question: str, record_stats: bool = True) -> Optional[Dict[str, Any]]:
+        """Serve a knowledge base FAQ answer directly when the match clears the threshold
+        
+        In keyword mode the score is the word overlap between the question and
+        the best keyword match's FAQ question, so only near-verbatim questions
+        are answered. Background callers (cache warming, prefetch) pass
+        ``record_stats=False`` so the reported hit rate reflects user traffic only.
+        """
+        if not self.short_circuit_available():
+            return None
+        
+        stats = self.knowledge_short_circuit
+        if record_stats:
+            stats["lookups"] += 1
+        
+        if stats["mode"] == "dense":
+            matches = knowledge_base.search_faqs(question, limit=1, mode="dense")
+            faq = matches[0] if matches else None
+            best_score = faq["relevance_score"] if faq else 0.0
+        else:
+            scored = [(question_overlap(question, match["question"]), match)
+                      for match in knowledge_base.search_faqs(question, limit=5, mode="keyword")]
+            best_score, faq = max(scored, key=lambda item: item[0], default=(0.0, None))
+            best_score = round(best_score, 4)
+        if record_stats:
+            bucket = f"{min(int(best_score * 10), 10) / 10:.1f}"
+            stats["best_score_histogram"][bucket] = stats["best_score_histogram"].get(bucket, 0) + 1
+        
+        if faq is None or best_score < stats["threshold"]:
+            return None
+        
+        if record_stats:
+            stats["hits"] += 1
+        category = faq.get("category") or categorize_question(question)
+        keywords = extract_keywords(question)
+        
+        return {
+            "response": ResponseFormatter.medical_response(faq["answer"]),
+            "category": category,
+            "keywords": keywords,
+            "follow_up_questions": self.generate_follow_up_questions(category, keywords),
+            "confidence": "high",
+            "sources_recommended": self.get_recommended_sources(category),
+            "knowledge_match": {
+                "question": faq["question"],
+                "source": faq.get("source", "Unknown"),
+                "score": best_score
+            }
+        }
+    
+    def short_circuit_available(self) -> bool:
+        """Whether the short circuit is enabled and its scores can tell a match from a near miss
+        
+        Dense mode is refused without the dense index (search would fall back
+        to keyword scores, which clear any cosine threshold) and on corpora
+        too small for the SVD to separate topics, where unrelated questions
+        score above the threshold.
+        """
+        stats = self.knowledge_short_circuit
+        if not stats["enabled"]:
+            return False
+        if stats["mode"] != "dense":
+            return True
+        index = knowledge_base.get_dense_index()
+        if index is None:
+            return False
+        index_stats = index.get_stats()
+        return index_stats["documents"] >= Config.KB_SHORT_CIRCUIT_DENSE_MIN_DOCS and \
+            index_stats["dimensions"] >= Config.KB_SHORT_CIRCUIT_DENSE_MIN_DIMENSIONS
+    
+    def get_short_circuit_stats(self) -> Dict[str, Any]:
+        """Get knowledge base short-circuit hit rate and threshold for tuning"""
+        stats = self.knowledge_short_circuit
+        return {
+            **stats,
+            "available": self.short_circuit_available(),
+            "hit_rate": round(stats["hits"] / stats["lookups"], 4) if stats["lookups"] else 0.0
+        }
+    
+    def get_emergency_response(self, question: str) -> Dict[str, Any]:
+        """Render an immediate local safety response for emergency warning signs (no LLM call)"""
+        content = (
+            "The symptoms you describe can be signs of a medical emergency.\n\n"
+            "**Please act now:**\n"
+            "• Call your local emergency number (911 / 112 / 999) or go to the nearest emergency department\n"
+            "• Do not drive yourself - ask someone nearby to help or wait for emergency services\n"
+            "• Stay on the line with the dispatcher and follow their instructions\n"
+            "• If you have been prescribed emergency medication (for example an inhaler or nitroglycerin), use it as directed\n\n"
+            "You are not overreacting by seeking help - it is always better to be checked quickly."
+        )
+        
+        return {
+            "response": ResponseFormatter.medical_response(content),
+            "category": "emergency",
+            "keywords": extract_keywords(question),
+            "follow_up_questions": [],
+            "confidence": "high",
+            "sources_recommended": ["Local emergency services", "Your nearest emergency department"],
+            "fast_lane": True
+        }
+    
+    async def stream_medical_response(self, question: str, context: Dict[str, Any] = None) -> AsyncIterator[str]:
+        """Stream the medical response from the LLM as text chunks"""
+        category = categorize_question(question)
+        rag_context, rag_tokens = self.build_rag_context(self.retrieve_passages(question))
+        messages = self.build_messages(question, category, context, rag_context)
+        route = model_router.route(category)
+        start = time.perf_counter()
+        
+        stream = await asyncio.to_thread(
+            self.client.chat.completions.create,
+            model=route.model,
+            messages=messages,
+            max_tokens=self.get_max_tokens(rag_tokens, route.max_tokens),
+            temperature=route.temperature,
+            presence_penalty=0.1,
+            frequency_penalty=0.1,
+            stream=True
+        )
+        
+        chunks = iter(stream)
+        completion_tokens = 0
+        while True:
+            chunk = await asyncio.to_thread(next, chunks, None)
+            if chunk is None:
+                break
+            if chunk.choices and chunk.choices[0].delta.content:
+                completion_tokens += estimate_tokens(chunk.choices[0].delta.content)
+                yield chunk.choices[0].delta.content
+        
+        # Streamed completions carry no usage block, so tokens are estimated from the text
+        prompt_tokens = sum(estimate_tokens(message["content"]) for message in messages)
+        usage_accountant.record(route.model, category, prompt_tokens, completion_tokens,
+                                time.perf_counter() - start, estimated=True)
+    
     def generate_follow_up_questions(self, category: str, keywords: List[str]) -> List[str]:
         """Generate relevant follow-up questions based on category and keywords"""
         follow_ups = {
@@ -184,7 +427,7 @@ Remember: You are providing health education and support, not medical diagnosis
 gpt_router = GPTRouter()
 
 async def process_medical_query(query: str, enable_cbt: bool = False, 
-                              enable_shifa: bool = False) -> Dict[str, Any]:
+                              enable_shifa: bool = False, user_id: Optional[str] = None) -> Dict[str, Any]:
     """
     Main function to process medical queries
     
@@ -192,14 +435,37 @@ async def process_medical_query(query: str, enable_cbt: bool = False,
         query: User's medical question
         enable_cbt: Whether to include CBT recommendations
         enable_shifa: Whether to include Islamic healing guidance
+        user_id: Optional user identifier for server-side conversation memory
     
     Returns:
         Complete response with medical info, CBT, and/or Shifa guidance
     """
     
     try:
-        # Get primary medical response
-        medical_response = await gpt_router.generate_medical_response(query)
+        with tracer.span("triage"):
+            # Emergencies get an immediate local safety response instead of waiting on the LLM
+            if is_emergency_query(query):
+                medical_response = gpt_router.get_emergency_response(query)
+            else:
+                # Textbook questions already answered in the knowledge base skip the LLM
+                medical_response = gpt_router.answer_from_knowledge_base(query)
+        
+        if medical_response is None:
+            # Get primary medical response, with the user's bounded conversation context
+            context = conversation_store.get_context(user_id)
+            medical_response = None
+            if context is None:
+                # Context-free answers are shared across users and workers
+                with tracer.span("cache"):
+                    cache_key = response_cache.make_key("medical_response", query)
+                    medical_response = await response_cache.aget(cache_key)
+            if medical_response is None:
+                medical_response = await gpt_router.generate_medical_response(query, context)
+                if context is None and medical_response["category"] != "error":
+                    await response_cache.aset(cache_key, medical_response)
+        
+        if user_id and medical_response["category"] != "error":
+            conversation_store.add_turn(user_id, query, medical_response["response"])
         
         result = {
             "medical_response": medical_response,
@@ -0,0 +1,218 @@
+"""
+Hedged Upstream Requests for ShifaAI
+Per-request deadlines and hedging of slow LLM calls against an adaptive latency threshold
+"""
+import asyncio
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, Iterator, Optional, Set
+
+from .utils import Config
+
+# Monotonic time by which the current request must be answered; None means no deadline
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+class DeadlineExceeded(Exception):
+    """The request's deadline passed before the upstream call finished"""
+
+@contextmanager
+def deadline(seconds: float, detached: bool = False) -> Iterator[float]:
+    """Bound the enclosed work to ``seconds`` from now
+
+    An outer deadline is never extended, unless ``detached`` (for background
+    work that outlives the request that started it).
+    """
+    outer = None if detached else _deadline.get()
+    deadline_at = time.monotonic() + seconds
+    if outer is not None:
+        deadline_at = min(deadline_at, outer)
+    token = _deadline.set(deadline_at)
+    try:
+        yield deadline_at
+    finally:
+        _deadline.reset(token)
+
+def get_remaining_time() -> Optional[float]:
+    """Seconds left until the current request's deadline, or None without one"""
+    deadline_at = _deadline.get()
+    return None if deadline_at is None else deadline_at - time.monotonic()
+
+class LatencyTracker:
+    """Rolling window of recent upstream latencies"""
+
+    def __init__(self, window: int = Config.LLM_LATENCY_WINDOW, min_samples: int = Config.LLM_LATENCY_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Latency at the given fraction of the window, or None until enough calls have been seen"""
+        if len(self._samples) < self.min_samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+class RequestHedger:
+    """Runs blocking upstream calls in threads, hedging the ones slower than usual
+
+    If the first attempt has not returned by the hedge delay (the rolling
+    ``percentile`` latency, or ``initial_delay`` until enough calls have been
+    seen) an identical second attempt is started and whichever succeeds first
+    wins. Hedges are capped at ``budget`` of all calls so a slow upstream is
+    never hit with double the load. Waiting stops at the request deadline with
+    ``DeadlineExceeded``.
+
+    A thread cannot be cancelled, so an attempt that loses or outlives the
+    deadline keeps running (and is billed) until the upstream answers. Pass
+    ``timeout_argument`` to have each attempt give the upstream call the time
+    left until the deadline, and ``on_discarded`` to account for the results
+    nobody waited for.
+    """
+
+    def __init__(self, enabled: bool = Config.LLM_HEDGING_ENABLED, budget: float = Config.LLM_HEDGE_BUDGET,
+                 percentile: float = Config.LLM_HEDGE_PERCENTILE, initial_delay: float = Config.LLM_HEDGE_INITIAL_DELAY,
+                 min_delay: float = Config.LLM_HEDGE_MIN_DELAY, tracker: Optional[LatencyTracker] = None):
+        self.enabled = enabled
+        self.budget = budget
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.tracker = tracker or LatencyTracker()
+        self._stats = {"calls": 0, "hedged": 0, "hedge_wins": 0, "budget_exhausted": 0, "deadline_exceeded": 0,
+                       "discarded": 0}
+        # Attempts still running after their call returned (kept referenced until they finish)
+        self._discarded: Set[asyncio.Task] = set()
+
+    def hedge_delay(self) -> float:
+        """Seconds to wait for the first attempt before hedging"""
+        observed = self.tracker.percentile(self.percentile)
+        return self.initial_delay if observed is None else max(self.min_delay, observed)
+
+    async def call(self, func: Callable[..., Any], *args: Any, timeout_argument: Optional[str] = None,
+                   on_discarded: Optional[Callable[[Any, float], None]] = None, **kwargs: Any) -> Any:
+        """Call a blocking function within the request deadline, hedging it if it is slow
+
+        ``timeout_argument`` names the keyword of ``func`` that takes a timeout
+        in seconds; ``on_discarded(result, seconds)`` is called for attempts
+        that succeed after the call has already returned or given up.
+        """
+        deadline_at = _deadline.get()
+        if deadline_at is not None and deadline_at <= time.monotonic():
+            self._stats["deadline_exceeded"] += 1
+            raise DeadlineExceeded("Request deadline passed before the upstream call started")
+
+        self._stats["calls"] += 1
+        hedges = set()
+        pending = {self._attempt(func, args, kwargs, deadline_at, timeout_argument)}
+        hedge_at = time.monotonic() + self.hedge_delay() if self.enabled else None
+        error = None
+        try:
+            while pending:
+                wake_times = [t for t in (hedge_at, deadline_at) if t is not None]
+                timeout = max(0.0, min(wake_times) - time.monotonic()) if wake_times else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                for task in done:
+                    if task.exception() is None:
+                        if task in hedges:
+                            self._stats["hedge_wins"] += 1
+                        # An attempt finishing alongside the winner is discarded like a pending one
+                        pending |= done - {task}
+                        return task.result()[0]
+                    error = task.exception()
+
+                now = time.monotonic()
+                if deadline_at is not None and now >= deadline_at and pending:
+                    self._stats["deadline_exceeded"] += 1
+                    raise DeadlineExceeded("Request deadline passed while waiting for the upstream call")
+                if hedge_at is not None and now >= hedge_at and pending:
+                    hedge_at = None
+                    if self._stats["hedged"] < self.budget * self._stats["calls"]:
+                        self._stats["hedged"] += 1
+                        hedge = self._attempt(func, args, kwargs, deadline_at, timeout_argument)
+                        hedges.add(hedge)
+                        pending.add(hedge)
+                    else:
+                        self._stats["budget_exhausted"] += 1
+            raise error
+        finally:
+            for task in pending:
+                self._discard(task, on_discarded)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "budget": self.budget,
+            "hedge_delay_ms": round(self.hedge_delay() * 1000, 1),
+            "latency_samples": len(self.tracker),
+            "running_discarded": len(self._discarded),
+            **self._stats
+        }
+
+    def _attempt(self, func: Callable[..., Any], args: tuple, kwargs: dict, deadline_at: Optional[float],
+                 timeout_argument: Optional[str]) -> asyncio.Task:
+        if timeout_argument is not None and deadline_at is not None:
+            kwargs = {**kwargs, timeout_argument: max(0.001, deadline_at - time.monotonic())}
+
+        async def run():
+            start = time.monotonic()
+            try:
+                return await asyncio.to_thread(func, *args, **kwargs), time.monotonic() - start
+            finally:
+                # Recorded even when the attempt is cancelled, so the slow tail still shows in the window
+                self.tracker.record(time.monotonic() - start)
+        return asyncio.ensure_future(run())
+
+    def _discard(self, task: asyncio.Task, on_discarded: Optional[Callable[[Any, float], None]]):
+        """Let an attempt nobody waits for finish in the background and report its result"""
+        self._discarded.add(task)
+
+        def finished(task: asyncio.Task):
+            self._discarded.discard(task)
+            if task.cancelled() or task.exception() is not None:
+                return
+            self._stats["discarded"] += 1
+            if on_discarded is not None:
+                result, seconds = task.result()
+                on_discarded(result, seconds)
+        task.add_done_callback(finished)
+
+class DeadlineMiddleware:
+    """ASGI middleware that gives each request a deadline
+
+    Clients can shorten the default with an ``X-Request-Timeout`` header in
+    seconds; it is capped at ``max_seconds``.
+    """
+
+    def __init__(self, app, max_seconds: float = Config.REQUEST_DEADLINE_SECONDS):
+        self.app = app
+        self.max_seconds = max_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        seconds = self.max_seconds
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-timeout":
+                try:
+                    requested = float(value.decode("latin-1"))
+                except ValueError:
+                    break
+                if requested > 0:
+                    seconds = min(seconds, requested)
+                break
+
+        with deadline(seconds):
+            await self.app(scope, receive, send)
+
+# Global instance
+llm_hedger = RequestHedger()
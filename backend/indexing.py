@@ -0,0 +1,223 @@
+"""
+Keyword Text Index for ShifaAI
+Inverted index over the FAQ corpus, built across a process pool for large corpora and cached on disk
+"""
+import hashlib
+import os
+import pickle
+import time
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+from .utils import logger, Config
+
+# Bump when the index layout changes so stale cache files are ignored
+INDEX_FORMAT_VERSION = 2
+
+# Above this share of candidate documents, scanning the corpus is cheaper than gathering them
+FULL_SCAN_FRACTION = 0.5
+
+# (first document id, [(question, answer, keywords), ...])
+Shard = Tuple[int, List[Tuple[str, str, List[str]]]]
+
+class TextIndex:
+    """Postings of every lowercase whitespace token and FAQ keyword
+
+    Keyword search scores substring matches, and a query word without
+    whitespace can only occur inside a single token of a document, so the
+    FAQs holding a token that contains the word (plus those whose keywords
+    occur in the query) are the only ones that can score. Searching just
+    those gives exactly the results of scanning the whole corpus.
+    """
+
+    def __init__(self, tokens: Dict[str, array], keywords: Dict[str, array], doc_count: int):
+        self.tokens = tokens
+        self.keywords = keywords
+        self.doc_count = doc_count
+        self.build_seconds = 0.0
+        self.source = "built"
+        self._vocabulary: Optional[Tuple[List[str], str, List[int]]] = None
+
+    def candidates(self, query: str) -> Optional[List[int]]:
+        """Ascending ids of the documents that can match a lowercase query
+
+        None means a full scan is cheaper (no words, or most documents can match).
+        """
+        words = query.split()
+        if not words:
+            return None
+
+        ids: Set[int] = set()
+        # A whole-query match in the question contains its longest word; other words only count from 4 chars
+        for word in {max(words, key=len)} | {word for word in words if len(word) > 3}:
+            for token in self._tokens_containing(word):
+                ids.update(self.tokens[token])
+        for keyword, postings in self.keywords.items():
+            if keyword in query:
+                ids.update(postings)
+        if len(ids) > self.doc_count * FULL_SCAN_FRACTION:
+            return None
+        return sorted(ids)
+
+    def extended(self, docs: Sequence[Dict]) -> "TextIndex":
+        """A copy with documents appended (shares the postings it does not change)"""
+        tokens, keywords = _index_shard((self.doc_count, _shard_fields(docs)))
+        extended = TextIndex(dict(self.tokens), dict(self.keywords), self.doc_count + len(docs))
+        for target, additions in ((extended.tokens, tokens), (extended.keywords, keywords)):
+            for term, ids in additions.items():
+                postings = target.get(term)
+                target[term] = array("I", ids) if postings is None else postings + array("I", ids)
+        extended.build_seconds = self.build_seconds
+        extended.source = self.source
+        return extended
+
+    def _tokens_containing(self, word: str) -> List[str]:
+        """Vocabulary tokens that contain ``word``, found with substring search over the joined vocabulary"""
+        if self._vocabulary is None:
+            terms = list(self.tokens)
+            starts, offset = [], 0
+            for term in terms:
+                starts.append(offset)
+                offset += len(term) + 1
+            self._vocabulary = (terms, "\n".join(terms), starts)
+        terms, text, starts = self._vocabulary
+
+        matches = []
+        position = text.find(word)
+        while position != -1:
+            term_index = bisect_right(starts, position) - 1
+            matches.append(terms[term_index])
+            if term_index + 1 == len(starts):
+                break
+            position = text.find(word, starts[term_index + 1])
+        return matches
+
+    def __getstate__(self) -> Dict:
+        # The joined vocabulary is rebuilt on first search rather than cached on disk
+        return {**self.__dict__, "_vocabulary": None}
+
+    def get_stats(self) -> Dict:
+        return {
+            "documents": self.doc_count,
+            "terms": len(self.tokens),
+            "keywords": len(self.keywords),
+            "postings": sum(len(postings) for postings in self.tokens.values()),
+            "build_seconds": round(self.build_seconds, 3),
+            "source": self.source
+        }
+
+def _shard_fields(faqs: Sequence[Dict]) -> List[Tuple[str, str, List[str]]]:
+    return [(faq.get("question", ""), faq.get("answer", ""), faq.get("keywords") or []) for faq in faqs]
+
+def _index_shard(shard: Shard) -> Tuple[Dict[str, List[int]], Dict[str, List[int]]]:
+    """Tokenize and normalize one shard of documents (runs in a worker process)"""
+    first_id, docs = shard
+    tokens: Dict[str, List[int]] = {}
+    keywords: Dict[str, List[int]] = {}
+    for doc_id, (question, answer, doc_keywords) in enumerate(docs, first_id):
+        for token in set(question.lower().split()) | set(answer.lower().split()):
+            tokens.setdefault(token, []).append(doc_id)
+        for keyword in set(keyword.lower() for keyword in doc_keywords):
+            keywords.setdefault(keyword, []).append(doc_id)
+    return tokens, keywords
+
+def build_text_index(faqs: Sequence[Dict], **kwargs) -> TextIndex:
+    """Build the index of one corpus (see ``build_text_indexes``)"""
+    return build_text_indexes({"": faqs}, **kwargs)[""]
+
+def build_text_indexes(corpora: Dict[str, Sequence[Dict]], workers: int = Config.INDEX_BUILD_WORKERS,
+                       shard_size: int = Config.INDEX_SHARD_SIZE,
+                       parallel_min_docs: int = Config.INDEX_PARALLEL_MIN_DOCS,
+                       progress: Optional[Callable[[int, int], None]] = None) -> Dict[str, TextIndex]:
+    """Build one index per named corpus, tokenizing shards in a process pool once there are ``parallel_min_docs`` documents
+
+    Every corpus is cut into shards of ``shard_size`` documents and all shards
+    share one pool. Shards are merged in document order, so every postings
+    list stays sorted. ``progress(indexed, total)`` is called after each shard
+    is merged.
+    """
+    start = time.perf_counter()
+    workers = workers or os.cpu_count() or 1
+    indexes: Dict[str, TextIndex] = {}
+    shards: List[Tuple[str, Shard]] = []
+    for name, faqs in corpora.items():
+        fields = _shard_fields(faqs)
+        indexes[name] = TextIndex({}, {}, len(fields))
+        shards.extend((name, (first_id, fields[first_id:first_id + shard_size]))
+                      for first_id in range(0, len(fields), shard_size))
+    total = sum(index.doc_count for index in indexes.values())
+
+    def merge(name: str, count: int, results: Tuple[Dict[str, List[int]], Dict[str, List[int]]], indexed: int) -> int:
+        for target, additions in zip((indexes[name].tokens, indexes[name].keywords), results):
+            for term, ids in additions.items():
+                postings = target.get(term)
+                if postings is None:
+                    target[term] = array("I", ids)
+                else:
+                    postings.extend(ids)
+        indexed += count
+        if progress is not None:
+            progress(indexed, total)
+        return indexed
+
+    indexed = 0
+    if workers > 1 and len(shards) > 1 and total >= parallel_min_docs:
+        with ProcessPoolExecutor(max_workers=min(workers, len(shards))) as executor:
+            for (name, shard), results in zip(shards, executor.map(_index_shard, [shard for _, shard in shards])):
+                indexed = merge(name, len(shard[1]), results, indexed)
+    else:
+        workers = 1
+        for name, shard in shards:
+            indexed = merge(name, len(shard[1]), _index_shard(shard), indexed)
+
+    seconds = time.perf_counter() - start
+    for index in indexes.values():
+        index.build_seconds = seconds
+    logger.info(f"Built {len(indexes)} text index{'es' if len(indexes) != 1 else ''}: {total} docs in "
+                f"{seconds:.2f}s ({workers} process{'es' if workers > 1 else ''})")
+    return indexes
+
+def corpus_digest(data: bytes) -> str:
+    """Cache key of a serialized corpus"""
+    return hashlib.sha256(data).hexdigest()
+
+def _cache_name(digest: str) -> str:
+    return f"text_index-v{INDEX_FORMAT_VERSION}-{digest[:32]}.pkl"
+
+def load_cached_indexes(directory: str, digest: str) -> Optional[Dict[str, TextIndex]]:
+    """The indexes cached for a corpus, or None if there are none"""
+    if not directory:
+        return None
+    path = os.path.join(directory, _cache_name(digest))
+    try:
+        with open(path, "rb") as f:
+            indexes = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable text index cache {path}: {str(e)}")
+        return None
+    if not isinstance(indexes, dict) or not all(isinstance(index, TextIndex) for index in indexes.values()):
+        return None
+    for index in indexes.values():
+        index.source = "cache"
+    return indexes
+
+def save_cached_indexes(directory: str, digest: str, indexes: Dict[str, TextIndex]):
+    """Write the indexes for the next start, replacing older cache files (atomically, for concurrent workers)"""
+    if not directory:
+        return
+    name = _cache_name(digest)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        temp_path = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+        with open(temp_path, "wb") as f:
+            pickle.dump(indexes, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, os.path.join(directory, name))
+        for other in os.listdir(directory):
+            if other.startswith("text_index-") and other != name:
+                os.remove(os.path.join(directory, other))
+    except OSError as e:
+        logger.warning(f"Could not cache the text index in {directory}: {str(e)}")
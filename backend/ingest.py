@@ -0,0 +1,128 @@
+"""
+Bulk FAQ Ingestion for ShifaAI
+Streams NDJSON records into the live knowledge base in batches
+"""
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from .utils import logger, Config
+
+async def iter_ndjson_lines(chunks: AsyncIterator[bytes],
+                            max_line_bytes: int = Config.INGEST_MAX_LINE_BYTES) -> AsyncIterator[Tuple[int, Optional[bytes]]]:
+    """Split a byte stream into (line number, line) pairs without buffering the whole body
+
+    Lines longer than ``max_line_bytes`` are skipped and yielded as ``None``.
+    """
+    buffer = b""
+    line_number = 0
+    oversized = False
+    async for chunk in chunks:
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            line_number += 1
+            yield line_number, None if oversized or len(line) > max_line_bytes else line
+            oversized = False
+        if len(buffer) > max_line_bytes:
+            # Drop the partial line instead of buffering it until its newline arrives
+            buffer = b""
+            oversized = True
+    if buffer or oversized:
+        yield line_number + 1, None if oversized else buffer
+
+class FAQIngestor:
+    """Validates, cleans and batches streamed FAQ records into a knowledge base
+
+    Each record is cleaned with ``MedicalScraper.preprocess_item``; records that
+    are not JSON objects with a question and answer are rejected as invalid,
+    and questions already in the corpus (or earlier in the stream) as duplicates.
+    Batches are merged off the event loop so searches keep being served.
+    """
+
+    def __init__(self, knowledge_base, scraper, batch_size: int = Config.INGEST_BATCH_SIZE,
+                 max_reported_errors: int = 20):
+        self.knowledge_base = knowledge_base
+        self.scraper = scraper
+        self.batch_size = batch_size
+        self.max_reported_errors = max_reported_errors
+        self.batch: List[Dict[str, str]] = []
+        self.batches: List[Dict[str, Any]] = []
+        self.errors: List[Dict[str, Any]] = []
+        self.received = 0
+        self.added = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self._started = time.perf_counter()
+
+    async def feed(self, line_number: int, line: Optional[bytes]):
+        """Validate one NDJSON line, flushing a batch when it is full"""
+        if line is not None and not line.strip():
+            return
+        self.received += 1
+
+        if line is None:
+            self._reject(line_number, "Line too long")
+            return
+        try:
+            record = json.loads(line)
+        except ValueError:
+            self._reject(line_number, "Invalid JSON")
+            return
+        if not isinstance(record, dict):
+            self._reject(line_number, "Record must be a JSON object")
+            return
+
+        faq = self.scraper.preprocess_item(record)
+        if faq is None:
+            self._reject(line_number, "Record needs a non-empty question and answer")
+            return
+
+        self.batch.append(faq)
+        if len(self.batch) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        """Merge the pending batch into the knowledge base"""
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+
+        start = time.perf_counter()
+        added, duplicates = await asyncio.to_thread(self.knowledge_base.add_faqs, batch)
+        seconds = time.perf_counter() - start
+
+        self.added += added
+        self.duplicates += duplicates
+        self.batches.append({
+            "batch": len(self.batches) + 1,
+            "records": len(batch),
+            "added": added,
+            "duplicates": duplicates,
+            "seconds": round(seconds, 4),
+            "records_per_second": round(len(batch) / seconds, 1) if seconds else None
+        })
+
+    async def finish(self) -> Dict[str, Any]:
+        """Flush the last batch and build the ingestion report"""
+        await self.flush()
+        seconds = time.perf_counter() - self._started
+        logger.info(f"Ingested {self.added} FAQs ({self.duplicates} duplicates, {self.invalid} invalid) "
+                    f"in {seconds:.2f}s")
+        return {
+            "received": self.received,
+            "added": self.added,
+            "duplicates": self.duplicates,
+            "invalid": self.invalid,
+            "total_faqs": len(self.knowledge_base.faqs),
+            "seconds": round(seconds, 4),
+            "records_per_second": round(self.received / seconds, 1) if seconds else None,
+            "batches": self.batches,
+            "errors": self.errors
+        }
+
+    def _reject(self, line_number: int, reason: str):
+        self.invalid += 1
+        if len(self.errors) < self.max_reported_errors:
+            self.errors.append({"line": line_number, "error": reason})
@@ -0,0 +1,168 @@
+"""
+Conversation Memory for ShifaAI
+Server-side, bounded per-user conversation context for the GPT router
+"""
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional
+
+from .utils import Config, estimate_tokens, truncate_to_tokens
+
+class ConversationTurn:
+    """A single question/answer exchange"""
+
+    __slots__ = ("question", "answer", "tokens")
+
+    def __init__(self, question: str, answer: str):
+        self.question = question
+        self.answer = answer
+        self.tokens = estimate_tokens(question) + estimate_tokens(answer)
+
+class ConversationSession:
+    """Recent turns plus a rolling summary of older ones"""
+
+    __slots__ = ("turns", "summary", "tokens", "last_access")
+
+    def __init__(self):
+        self.turns: Deque[ConversationTurn] = deque()
+        self.summary = ""
+        self.tokens = 0
+        self.last_access = time.monotonic()
+
+class ConversationStore:
+    """LRU/TTL-bounded conversation memory keyed by user id
+
+    Each session keeps its recent turns within ``session_token_budget``;
+    older turns are folded into a rolling extractive summary capped at
+    ``summary_token_budget``. The whole store is bounded by ``max_sessions``
+    and ``max_total_tokens``, evicting the least recently used sessions.
+    """
+
+    def __init__(self, max_sessions: int = Config.CONVERSATION_MAX_SESSIONS,
+                 ttl_seconds: int = Config.CONVERSATION_TTL_SECONDS,
+                 session_token_budget: int = Config.CONVERSATION_TOKEN_BUDGET,
+                 summary_token_budget: int = Config.CONVERSATION_SUMMARY_TOKENS,
+                 max_total_tokens: int = Config.CONVERSATION_MAX_TOTAL_TOKENS):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.session_token_budget = session_token_budget
+        self.summary_token_budget = summary_token_budget
+        self.max_total_tokens = max_total_tokens
+        self._sessions: "OrderedDict[str, ConversationSession]" = OrderedDict()
+        self._total_tokens = 0
+        self._lock = threading.Lock()
+        self._evictions = 0
+        self._compactions = 0
+
+    def get_context(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """Get the bounded conversation context for a user, if any"""
+        if not user_id:
+            return None
+
+        with self._lock:
+            session = self._get_live_session(user_id)
+            if session is None:
+                return None
+            session.last_access = time.monotonic()
+            self._sessions.move_to_end(user_id)
+            return {
+                "conversation_summary": session.summary,
+                "conversation_turns": [
+                    {"question": turn.question, "answer": turn.answer} for turn in session.turns
+                ]
+            }
+
+    def add_turn(self, user_id: str, question: str, answer: str):
+        """Record a completed exchange and enforce all budgets"""
+        if not user_id:
+            return
+
+        turn = ConversationTurn(question, answer)
+        with self._lock:
+            session = self._get_live_session(user_id)
+            if session is None:
+                session = ConversationSession()
+                self._sessions[user_id] = session
+            session.turns.append(turn)
+            session.tokens += turn.tokens
+            session.last_access = time.monotonic()
+            self._sessions.move_to_end(user_id)
+            self._total_tokens += turn.tokens
+
+            self._compact(session)
+            self._evict()
+
+    def clear(self, user_id: str = None):
+        """Forget one user's conversation, or all conversations"""
+        with self._lock:
+            if user_id is None:
+                self._sessions.clear()
+                self._total_tokens = 0
+            elif user_id in self._sessions:
+                self._drop(user_id)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get conversation memory statistics"""
+        with self._lock:
+            return {
+                "active_sessions": len(self._sessions),
+                "total_tokens": self._total_tokens,
+                "max_sessions": self.max_sessions,
+                "max_total_tokens": self.max_total_tokens,
+                "evictions": self._evictions,
+                "compactions": self._compactions
+            }
+
+    def _get_live_session(self, user_id: str) -> Optional[ConversationSession]:
+        session = self._sessions.get(user_id)
+        if session is not None and time.monotonic() - session.last_access > self.ttl_seconds:
+            self._drop(user_id)
+            self._evictions += 1
+            return None
+        return session
+
+    def _compact(self, session: ConversationSession):
+        """Fold the oldest turns into the rolling summary until within budget"""
+        while session.tokens > self.session_token_budget and len(session.turns) > 1:
+            oldest = session.turns.popleft()
+            session.tokens -= oldest.tokens
+            self._total_tokens -= oldest.tokens
+
+            previous_summary_tokens = estimate_tokens(session.summary)
+            entry = f"Asked: {_first_sentence(oldest.question)} Told: {_first_sentence(oldest.answer)}"
+            summary = f"{session.summary} {entry}".strip()
+            if estimate_tokens(summary) > self.summary_token_budget:
+                # Keep the most recent part of the summary
+                summary = "..." + summary[-self.summary_token_budget * 4:]
+            session.summary = summary
+
+            summary_tokens = estimate_tokens(summary)
+            session.tokens += summary_tokens - previous_summary_tokens
+            self._total_tokens += summary_tokens - previous_summary_tokens
+            self._compactions += 1
+
+    def _evict(self):
+        """Evict expired sessions, then least recently used ones over the caps"""
+        now = time.monotonic()
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            over_capacity = (len(self._sessions) > self.max_sessions or
+                             self._total_tokens > self.max_total_tokens)
+            if not over_capacity and now - session.last_access <= self.ttl_seconds:
+                break
+            self._drop(user_id)
+            self._evictions += 1
+
+    def _drop(self, user_id: str):
+        session = self._sessions.pop(user_id)
+        self._total_tokens -= session.tokens
+
+def _first_sentence(text: str, max_tokens: int = 40) -> str:
+    """Take the first sentence of a turn for the rolling summary"""
+    sentence = re.split(r"(?<=[.!?])\s+", text.strip(), maxsplit=1)[0]
+    return truncate_to_tokens(sentence, max_tokens)
+
+# Global instance
+conversation_store = ConversationStore()
@@ -0,0 +1,133 @@
+"""
+Speculative Follow-up Prefetch for ShifaAI
+Answers suggested follow-up questions in the background while the server is idle
+"""
+import asyncio
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Set
+
+from .utils import logger, Config, is_emergency_query
+from .admission import TokenBucket, admission_controller
+from .cache import response_cache, TieredCache
+from .hedging import deadline
+from .tracing import tracer
+from .usage import usage_accountant
+from .gpt_router import gpt_router
+
+class FollowUpPrefetcher:
+    """Pre-generates answers to an answer's follow-up questions into the response cache
+
+    Runs as a detached task, so it holds neither the admission slot nor the
+    deadline of the ``/ask`` request that scheduled it, and is traced as a
+    request of its own. Each prefetch spends from a token bucket
+    (``rate_per_minute`` LLM calls, up to ``burst`` at once), at most
+    ``max_concurrent`` run at a time, and it is skipped whenever ``is_idle``
+    says real traffic needs the capacity. Prefetched keys are remembered so
+    hits on them can be counted.
+    """
+
+    def __init__(self, router, cache: TieredCache = response_cache, is_idle: Callable[[], bool] = lambda: True,
+                 enabled: bool = Config.PREFETCH_ENABLED, rate_per_minute: float = Config.PREFETCH_RATE_PER_MINUTE,
+                 burst: int = Config.PREFETCH_BURST, max_per_request: int = Config.PREFETCH_MAX_PER_REQUEST,
+                 timeout: float = Config.PREFETCH_TIMEOUT_SECONDS,
+                 max_concurrent: int = Config.PREFETCH_MAX_CONCURRENT, max_tracked: int = 10000):
+        self.router = router
+        self.cache = cache
+        self.is_idle = is_idle
+        self.enabled = enabled
+        self.max_per_request = max_per_request
+        self.timeout = timeout
+        self.max_concurrent = max_concurrent
+        self.max_tracked = max_tracked
+        self._bucket = TokenBucket(rate_per_minute / 60, burst)
+        self._active = 0
+        # Running prefetch tasks (the event loop only keeps weak references)
+        self._tasks: Set[asyncio.Task] = set()
+        self._prefetched: "OrderedDict[str, None]" = OrderedDict()
+        self._stats = {"scheduled": 0, "generated": 0, "already_cached": 0, "skipped_busy": 0,
+                       "skipped_budget": 0, "failed": 0, "hits": 0}
+
+    def schedule(self, medical_response: Dict[str, Any]):
+        """Start a detached prefetch of a response's follow-up questions (call from the event loop)"""
+        follow_ups = medical_response.get("follow_up_questions") or []
+        if not self.enabled or not follow_ups or medical_response.get("category") in ("error", "emergency"):
+            return
+        self._stats["scheduled"] += 1
+        task = asyncio.create_task(self.prefetch(follow_ups[:self.max_per_request]))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def cancel(self):
+        """Cancel running prefetches (at shutdown)"""
+        for task in list(self._tasks):
+            task.cancel()
+
+    def record_question(self, question: str):
+        """Count an asked question that was answered ahead of time"""
+        key = self.cache.make_key("medical_response", question)
+        if key in self._prefetched:
+            del self._prefetched[key]
+            self._stats["hits"] += 1
+
+    async def prefetch(self, questions: List[str]):
+        """Answer follow-up questions into the cache while capacity and budget allow"""
+        if self._active >= self.max_concurrent:
+            self._stats["skipped_busy"] += 1
+            return
+        self._active += 1
+        try:
+            # The prefetch outlives the request, so it gets its own trace and deadline
+            with tracer.trace("prefetch", questions=len(questions)), usage_accountant.attribute("prefetch"), \
+                    deadline(self.timeout, detached=True):
+                for question in questions:
+                    if not await self._prefetch_one(question):
+                        break
+        except Exception as e:
+            self._stats["failed"] += 1
+            logger.warning(f"Follow-up prefetch failed: {str(e)}")
+        finally:
+            self._active -= 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        generated = self._stats["generated"]
+        return {
+            "enabled": self.enabled,
+            "active": self._active,
+            **self._stats,
+            "hit_rate": round(self._stats["hits"] / generated, 4) if generated else 0.0
+        }
+
+    async def _prefetch_one(self, question: str) -> bool:
+        """Prefetch one question; False stops the remaining ones"""
+        key = self.cache.make_key("medical_response", question)
+        if await self.cache.aget(key) is not None:
+            self._stats["already_cached"] += 1
+            return True
+        if is_emergency_query(question) or self.router.answer_from_knowledge_base(question, record_stats=False) is not None:
+            return True
+        if not self.is_idle():
+            self._stats["skipped_busy"] += 1
+            return False
+        if self._bucket.consume():
+            self._stats["skipped_budget"] += 1
+            return False
+
+        response = await self.router.generate_medical_response(question)
+        if response["category"] == "error":
+            self._stats["failed"] += 1
+            return False
+        await self.cache.aset(key, response)
+        self._stats["generated"] += 1
+        self._prefetched[key] = None
+        if len(self._prefetched) > self.max_tracked:
+            self._prefetched.popitem(last=False)
+        return True
+
+def llm_capacity_idle() -> bool:
+    """True when LLM routes have no queue and only a few requests in flight (including the caller's)"""
+    llm = admission_controller.endpoint_classes["llm"]
+    return llm.queue_depth == 0 and llm.in_flight <= Config.PREFETCH_IDLE_MAX_IN_FLIGHT
+
+# Global instance (needs an OpenAI key; there is nothing to prefetch in fallback mode)
+followup_prefetcher = FollowUpPrefetcher(gpt_router, is_idle=llm_capacity_idle,
+                                         enabled=Config.PREFETCH_ENABLED and bool(Config.OPENAI_API_KEY))
@@ -0,0 +1,248 @@
+"""
+On-demand Request Profiling for ShifaAI
+Admin-triggered per-request profiles and Server-Timing stage breakdowns
+"""
+import asyncio
+import cProfile
+import hmac
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from .utils import logger, Config
+
+PROFILE_MODES = ("cprofile", "sample")
+
+# Stage timings of the request being profiled; None (the default) disables timing entirely
+_stage_timings: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("stage_timings", default=None)
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a request stage for the Server-Timing header (no-op unless profiling)"""
+    timings = _stage_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.append((name, (time.perf_counter() - start) * 1000))
+
+@contextmanager
+def collect_stages() -> Iterator[List[Tuple[str, float]]]:
+    """Record stage timings for the enclosed block, sharing the list of a request being profiled"""
+    timings = _stage_timings.get()
+    if timings is not None:
+        yield timings
+        return
+    timings = []
+    token = _stage_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _stage_timings.reset(token)
+
+def format_server_timing(timings: List[Tuple[str, float]], total_ms: float, profile_name: str = "") -> str:
+    """Render stage timings (summed per stage, in first-seen order) as a Server-Timing value"""
+    totals: Dict[str, float] = {}
+    for name, duration in timings:
+        totals[name] = totals.get(name, 0.0) + duration
+    entries = [f"{name};dur={duration:.1f}" for name, duration in totals.items()]
+    entries.append(f"total;dur={total_ms:.1f}")
+    if profile_name:
+        entries.append(f'profile;desc="{profile_name}"')
+    return ", ".join(entries)
+
+class StackSampler:
+    """Samples one thread's Python stack on a timer and counts collapsed stacks
+
+    The output is the collapsed-stack format used by flame graph tools:
+    one ``frame;frame;frame count`` line per distinct stack, root first.
+    """
+
+    def __init__(self, thread_id: int, interval: float = Config.PROFILING_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="shifa-stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if frames:
+                self.stacks[";".join(reversed(frames))] += 1
+
+class RequestProfiler:
+    """Runs one request at a time under a profiler when the admin token is presented
+
+    The profiler covers the event loop thread for the duration of the request,
+    so concurrent requests on the same worker show up in the profile too.
+    Profiles are written to ``output_dir`` as ``.pstats`` (cProfile) or
+    ``.collapsed`` (stack sampling) files.
+    """
+
+    def __init__(self, admin_token: str = Config.PROFILING_ADMIN_TOKEN,
+                 output_dir: str = Config.PROFILING_OUTPUT_DIR, default_mode: str = Config.PROFILING_MODE):
+        self.admin_token = admin_token
+        self.output_dir = output_dir
+        self.default_mode = default_mode if default_mode in PROFILE_MODES else "cprofile"
+        self._active = False
+        self._stats = {"profiles_written": 0, "rejected_tokens": 0, "skipped_busy": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.admin_token)
+
+    def authorize(self, token: str) -> bool:
+        """Check a presented token against the admin token in constant time"""
+        if self.enabled and hmac.compare_digest(token.encode("utf-8"), self.admin_token.encode("utf-8")):
+            return True
+        self._stats["rejected_tokens"] += 1
+        return False
+
+    def try_begin(self) -> bool:
+        """Claim the single profiling slot; False if another profile is running"""
+        if self._active:
+            self._stats["skipped_busy"] += 1
+            return False
+        self._active = True
+        return True
+
+    def end(self):
+        self._active = False
+
+    def start(self, mode: str):
+        """Start a profiler of the given mode on the current thread"""
+        if mode == "sample":
+            profiler = StackSampler(threading.get_ident())
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        return profiler
+
+    def stop(self, profiler):
+        if isinstance(profiler, StackSampler):
+            profiler.stop()
+        else:
+            profiler.disable()
+
+    @staticmethod
+    def profile_name(path: str, mode: str) -> str:
+        """Unique profile file name for a request path"""
+        slug = re.sub(r"[^a-zA-Z0-9]+", "-", path).strip("-") or "root"
+        extension = "collapsed" if mode == "sample" else "pstats"
+        return f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{slug}-{uuid.uuid4().hex[:8]}.{extension}"
+
+    def save(self, profiler, name: str) -> str:
+        """Write a stopped profiler to the output directory; returns the file path"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        file_path = os.path.join(self.output_dir, name)
+        if isinstance(profiler, StackSampler):
+            with open(file_path, "w", encoding="utf-8") as f:
+                f.write(profiler.collapsed())
+        else:
+            profiler.dump_stats(file_path)
+        self._stats["profiles_written"] += 1
+        logger.info(f"Saved request profile to {file_path}")
+        return file_path
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "output_dir": self.output_dir,
+            "default_mode": self.default_mode,
+            "active": self._active,
+            **self._stats
+        }
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles requests carrying a valid ``X-Profile-Token``
+
+    Requests without the header pass straight through. Profiled responses get
+    a ``Server-Timing`` header with the stage breakdown and the profile file
+    name. ``X-Profile-Mode: sample`` selects stack sampling instead of cProfile.
+    """
+
+    def __init__(self, app, profiler: "RequestProfiler"):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        token = mode = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-profile-token":
+                token = value.decode("latin-1")
+            elif name == b"x-profile-mode":
+                mode = value.decode("latin-1").lower()
+        if token is None:
+            await self.app(scope, receive, send)
+            return
+
+        if not self.profiler.authorize(token):
+            logger.warning(f"Rejected profiling token for {scope['path']}")
+            await self.app(scope, receive, send)
+            return
+        if not self.profiler.try_begin():
+            await self.app(scope, receive, send)
+            return
+
+        await self._profile(scope, receive, send, mode if mode in PROFILE_MODES else self.profiler.default_mode)
+
+    async def _profile(self, scope, receive, send, mode: str):
+        timings: List[Tuple[str, float]] = []
+        context_token = _stage_timings.set(timings)
+        profile_name = self.profiler.profile_name(scope["path"], mode)
+        start = time.perf_counter()
+        profiler = self.profiler.start(mode)
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                header = format_server_timing(timings, (time.perf_counter() - start) * 1000, profile_name)
+                message = {**message, "headers": [*message.get("headers", []),
+                                                  (b"server-timing", header.encode("latin-1"))]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            self.profiler.stop(profiler)
+            _stage_timings.reset(context_token)
+            try:
+                await asyncio.to_thread(self.profiler.save, profiler, profile_name)
+            except Exception as e:
+                logger.error(f"Failed to save request profile: {str(e)}")
+            finally:
+                self.profiler.end()
+
+# Global instance (profiling stays off unless PROFILING_ADMIN_TOKEN is set)
+request_profiler = RequestProfiler()
@@ -0,0 +1,157 @@
+"""
+Production Query Log for ShifaAI
+Append-only JSON Lines log of health questions, written in batches off the request path
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .utils import logger, Config, get_request_id
+
+class QueryLog:
+    """Buffers query records in memory and appends them to a rotating JSON Lines file
+
+    ``record()`` only appends to a buffer; the ``run()`` task writes the
+    buffer in a worker thread once ``batch_size`` records are waiting or every
+    ``flush_interval`` seconds. When the file would grow past ``max_bytes`` it
+    is rotated to ``<path>.1`` (older files shift up to ``backups``). If the
+    writer falls behind, the oldest buffered records are dropped rather than
+    growing memory without bound. Forked workers call ``split_per_process()``
+    so each one writes and rotates a file of its own.
+    """
+
+    def __init__(self, path: str = Config.QUERY_LOG_FILE, batch_size: int = Config.QUERY_LOG_BATCH_SIZE,
+                 flush_interval: float = Config.QUERY_LOG_FLUSH_SECONDS, max_bytes: int = Config.QUERY_LOG_MAX_BYTES,
+                 backups: int = Config.QUERY_LOG_BACKUPS, max_buffered: int = Config.QUERY_LOG_MAX_BUFFERED):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.max_buffered = max_buffered
+        self._buffer: List[Dict[str, Any]] = []
+        self._batch_ready: Optional[asyncio.Event] = None
+        self._write_lock = threading.Lock()
+        self._stats = {"recorded": 0, "written": 0, "dropped": 0, "batches": 0, "rotations": 0, "write_errors": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def record(self, entry: Dict[str, Any]):
+        """Buffer one record (never blocks on I/O)"""
+        if not self.enabled:
+            return
+        self._buffer.append(entry)
+        self._stats["recorded"] += 1
+        overflow = len(self._buffer) - self.max_buffered
+        if overflow > 0:
+            del self._buffer[:overflow]
+            self._stats["dropped"] += overflow
+        if len(self._buffer) >= self.batch_size and self._batch_ready is not None:
+            self._batch_ready.set()
+
+    async def run(self):
+        """Write buffered records in batches (runs until cancelled)"""
+        self._batch_ready = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            # Take the batch on the event loop thread, where records are added
+            batch, self._buffer = self._buffer, []
+            await asyncio.to_thread(self._write, batch)
+
+    def flush(self) -> int:
+        """Write everything buffered so far; returns the records written"""
+        batch, self._buffer = self._buffer, []
+        return self._write(batch)
+
+    def split_per_process(self):
+        """Write to ``<name>.<pid><ext>`` instead, so processes never rotate a file another one is appending to"""
+        if self.enabled:
+            root, ext = os.path.splitext(self.path)
+            self.path = f"{root}.{os.getpid()}{ext}"
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"enabled": self.enabled, "path": self.path, "buffered": len(self._buffer), **self._stats}
+
+    def _write(self, batch: List[Dict[str, Any]]) -> int:
+        if not batch:
+            return 0
+        data = "".join(json.dumps(entry, default=str) + "\n" for entry in batch).encode("utf-8")
+        try:
+            with self._write_lock:
+                if self.max_bytes and os.path.exists(self.path) and \
+                        os.path.getsize(self.path) + len(data) > self.max_bytes:
+                    self._rotate()
+                with open(self.path, "ab") as f:
+                    f.write(data)
+        except OSError as e:
+            self._stats["write_errors"] += 1
+            logger.error(f"Failed to write {len(batch)} query log records to {self.path}: {str(e)}")
+            return 0
+        self._stats["written"] += len(batch)
+        self._stats["batches"] += 1
+        return len(batch)
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._stats["rotations"] += 1
+
+def answer_outcome(response_data: Dict[str, Any], stage_names: List[str]) -> str:
+    """How a question was answered: emergency, knowledge_base, cache_hit, llm or error"""
+    medical_response = response_data.get("medical_response")
+    if not medical_response or medical_response.get("category") == "error":
+        return "error"
+    if medical_response.get("fast_lane"):
+        return "emergency"
+    if "knowledge_match" in medical_response:
+        return "knowledge_base"
+    if "llm" in stage_names:
+        return "llm"
+    return "cache_hit"
+
+def user_key(user_id: Optional[str]) -> Optional[str]:
+    """Stable pseudonym of a user ID, so replays keep per-user conversations without logging the ID"""
+    if not user_id:
+        return None
+    return hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).hexdigest()
+
+def build_entry(endpoint: str, query, response_data: Dict[str, Any], stages: List[Tuple[str, float]],
+                seconds: float) -> Dict[str, Any]:
+    """Query log record for an answered health question (the user ID itself is never logged)"""
+    stage_ms: Dict[str, float] = {}
+    for name, duration in stages:
+        stage_ms[name] = round(stage_ms.get(name, 0.0) + duration, 2)
+    medical_response = response_data.get("medical_response") or {}
+    return {
+        "ts": round(time.time(), 3),
+        "request_id": get_request_id(),
+        "endpoint": endpoint,
+        "question": query.question,
+        "include_cbt": query.include_cbt,
+        "include_shifa": query.include_shifa,
+        "has_user_id": bool(query.user_id),
+        "user_key": user_key(query.user_id),
+        "category": medical_response.get("category"),
+        "outcome": answer_outcome(response_data, list(stage_ms)),
+        "stages_ms": stage_ms,
+        "total_ms": round(seconds * 1000, 2)
+    }
+
+# Global instance (off unless QUERY_LOG_FILE is set)
+query_log = QueryLog()
@@ -0,0 +1,81 @@
+"""
+Immutable catalog records for ShifaAI
+Shared, read-only building blocks for the CBT and Shifa catalogs
+"""
+from collections.abc import Mapping
+from dataclasses import fields
+from typing import Any, Dict, Iterator, Tuple
+
+
+class CatalogRecord:
+    """Read-only, dict-style access for frozen catalog dataclasses
+
+    Subclasses are declared with ``@dataclass(frozen=True, slots=True)`` so one
+    instance per catalog entry is shared by every request. Optional fields left
+    as ``None`` behave like missing keys, matching the original dict catalogs.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "CatalogRecord":
+        """Build a record from a catalog dict, freezing list values into tuples"""
+        return cls(**{
+            key: tuple(value) if isinstance(value, list) else value
+            for key, value in data.items()
+        })
+
+    def keys(self) -> Tuple[str, ...]:
+        return tuple(f.name for f in fields(self) if getattr(self, f.name) is not None)
+
+    def __getitem__(self, key: str) -> Any:
+        value = getattr(self, key, None) if isinstance(key, str) else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        return isinstance(key, str) and getattr(self, key, None) is not None
+
+    def get(self, key: str, default: Any = None) -> Any:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Materialize the record as a plain dict"""
+        return {key: getattr(self, key) for key in self.keys()}
+
+
+class RecordView(Mapping):
+    """Request-specific view over a shared catalog record
+
+    Carries per-request fields (ids, scores, encouragement) next to a reference
+    to the shared record instead of copying the catalog entry for every request.
+    """
+
+    __slots__ = ("record", "extra")
+
+    def __init__(self, record: CatalogRecord, **extra: Any):
+        self.record = record
+        self.extra = extra
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self.extra:
+            return self.extra[key]
+        return self.record[key]
+
+    def __iter__(self) -> Iterator[str]:
+        yield from (key for key in self.record.keys() if key not in self.extra)
+        yield from self.extra
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.record!r}, **{self.extra!r})"
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Materialize the view as a plain dict (e.g. for nested JSON payloads)"""
+        return dict(self)
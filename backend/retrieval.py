@@ -0,0 +1,167 @@
+"""
+Dense Retrieval for ShifaAI
+CPU-only vector index over the medical knowledge base (TF-IDF + SVD embeddings)
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .utils import logger, Config
+
+try:
+    import numpy as np
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.decomposition import TruncatedSVD
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    DENSE_RETRIEVAL_AVAILABLE = True
+except ImportError:  # Optional dependencies; keyword search is used instead
+    DENSE_RETRIEVAL_AVAILABLE = False
+
+class DenseRetrievalIndex:
+    """Latent semantic index with batched matrix-vector top-k search
+
+    Documents are embedded with word and character n-gram TF-IDF reduced by
+    truncated SVD, L2-normalized and stored as one contiguous float32 matrix,
+    so cosine similarity is a single matrix-vector product. Corpora above
+    ``ivf_min_docs`` are also partitioned into k-means cells (IVF) and only
+    the ``nprobe`` closest cells are scanned per query.
+    """
+
+    def __init__(self, dimensions: int = Config.DENSE_DIMENSIONS, ivf_min_docs: int = Config.DENSE_IVF_MIN_DOCS,
+                 nprobe: int = Config.DENSE_IVF_NPROBE, random_state: int = 42):
+        if not DENSE_RETRIEVAL_AVAILABLE:
+            raise RuntimeError("Dense retrieval requires numpy and scikit-learn")
+        self.dimensions = dimensions
+        self.ivf_min_docs = ivf_min_docs
+        self.nprobe = nprobe
+        self.random_state = random_state
+        self.vectorizer = None
+        self.svd = None
+        self.matrix = None
+        self.centroids = None
+        self.cell_members: List["np.ndarray"] = []
+        self.folded_in = 0
+
+    def __len__(self) -> int:
+        return 0 if self.matrix is None else self.matrix.shape[0]
+
+    def build(self, documents: Sequence[str]) -> "DenseRetrievalIndex":
+        """Fit the embedding model on the documents and index them"""
+        self.vectorizer = TfidfVectorizer(
+            analyzer="char_wb", ngram_range=(3, 5), sublinear_tf=True, min_df=1, dtype=np.float32
+        )
+        sparse = self.vectorizer.fit_transform(documents)
+
+        # SVD needs fewer components than both documents and features
+        components = min(self.dimensions, sparse.shape[0] - 1, sparse.shape[1] - 1)
+        if components >= 2:
+            self.svd = TruncatedSVD(n_components=components, random_state=self.random_state)
+            dense = self.svd.fit_transform(sparse)
+        else:
+            self.svd = None
+            dense = sparse.toarray()
+
+        self.matrix = _normalize(np.ascontiguousarray(dense, dtype=np.float32))
+        self._build_ivf()
+        logger.info(f"Built dense retrieval index: {self.matrix.shape[0]} docs x {self.matrix.shape[1]} dims"
+                    f"{f', {len(self.cell_members)} IVF cells' if self.centroids is not None else ''}")
+        return self
+
+    def add(self, documents: Sequence[str]) -> int:
+        """Fold new documents into the index without refitting the embedding model"""
+        if self.matrix is None or not documents:
+            return 0
+        return self.add_vectors(self.embed(documents))
+
+    def add_vectors(self, vectors: "np.ndarray") -> int:
+        """Append already-embedded documents (and assign them to their nearest IVF cell)
+
+        New rows use the existing vocabulary and SVD basis, so searches keep
+        running against the previous matrix until the extended one is swapped in.
+        """
+        first_row = len(self)
+        cell_members = self.cell_members
+        if self.centroids is not None:
+            cells = np.argmax(vectors @ self.centroids.T, axis=1)
+            new_rows = np.arange(first_row, first_row + len(vectors))
+            cell_members = [
+                np.concatenate([members, new_rows[cells == cell]]) for cell, members in enumerate(self.cell_members)
+            ]
+
+        # Rows must exist before any IVF cell can point at them
+        self.matrix = np.concatenate([self.matrix, vectors])
+        self.cell_members = cell_members
+        self.folded_in += len(vectors)
+        return len(vectors)
+
+    def embed(self, texts: Sequence[str]) -> "np.ndarray":
+        """Embed query texts into the index space"""
+        sparse = self.vectorizer.transform(texts)
+        dense = self.svd.transform(sparse) if self.svd is not None else sparse.toarray()
+        return _normalize(np.ascontiguousarray(dense, dtype=np.float32))
+
+    def search(self, query: str, k: int = 5, candidates: Optional["np.ndarray"] = None) -> List[Tuple[int, float]]:
+        """Get (document index, cosine score) pairs for the top-k documents"""
+        return self.search_batch([query], k, candidates)[0]
+
+    def search_batch(self, queries: Sequence[str], k: int = 5,
+                     candidates: Optional["np.ndarray"] = None) -> List[List[Tuple[int, float]]]:
+        """Top-k search for several queries at once with one matrix product"""
+        if self.matrix is None or not len(self):
+            return [[] for _ in queries]
+
+        query_vectors = self.embed(queries)
+        if candidates is None and self.centroids is None:
+            scores = query_vectors @ self.matrix.T
+            return [_top_k(row, np.arange(len(self)), k) for row in scores]
+
+        results = []
+        for query_vector in query_vectors:
+            rows = self._probe(query_vector) if candidates is None else candidates
+            if self.centroids is not None and candidates is not None:
+                rows = np.intersect1d(rows, self._probe(query_vector), assume_unique=True)
+            scores = self.matrix[rows] @ query_vector
+            results.append(_top_k(scores, rows, k))
+        return results
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "documents": len(self),
+            "dimensions": 0 if self.matrix is None else int(self.matrix.shape[1]),
+            "ivf_cells": len(self.cell_members),
+            "folded_in": self.folded_in,
+            "memory_bytes": 0 if self.matrix is None else int(self.matrix.nbytes)
+        }
+
+    def _build_ivf(self):
+        self.centroids = None
+        self.cell_members = []
+        if len(self) < self.ivf_min_docs:
+            return
+
+        cells = max(2, int(np.sqrt(len(self))))
+        kmeans = MiniBatchKMeans(n_clusters=cells, random_state=self.random_state, n_init=3,
+                                 batch_size=4096)
+        labels = kmeans.fit_predict(self.matrix)
+        self.centroids = _normalize(np.ascontiguousarray(kmeans.cluster_centers_, dtype=np.float32))
+        self.cell_members = [np.flatnonzero(labels == cell) for cell in range(cells)]
+
+    def _probe(self, query_vector: "np.ndarray") -> "np.ndarray":
+        """Rows of the ``nprobe`` IVF cells closest to the query"""
+        if self.centroids is None:
+            return np.arange(len(self))
+        cell_scores = self.centroids @ query_vector
+        nprobe = min(self.nprobe, len(self.cell_members))
+        closest = np.argpartition(-cell_scores, nprobe - 1)[:nprobe]
+        return np.sort(np.concatenate([self.cell_members[cell] for cell in closest]))
+
+def _normalize(matrix: "np.ndarray") -> "np.ndarray":
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def _top_k(scores: "np.ndarray", rows: "np.ndarray", k: int) -> List[Tuple[int, float]]:
+    if not len(scores):
+        return []
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(int(rows[i]), float(scores[i])) for i in top]
@@ -0,0 +1,114 @@
+"""
+Model Routing for ShifaAI
+Per-category model, completion budget and temperature for LLM calls
+"""
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Optional
+
+from .utils import settings, Config
+
+@dataclass(frozen=True)
+class ModelRoute:
+    """LLM settings used for one question category"""
+    model: str
+    max_tokens: int
+    temperature: float
+
+class RouteStats:
+    """Call count, errors, and rolling latency and token usage for one route"""
+
+    def __init__(self, window: int):
+        self.calls = 0
+        self.errors = 0
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.prompt_tokens: Deque[int] = deque(maxlen=window)
+        self.completion_tokens: Deque[int] = deque(maxlen=window)
+
+    def to_dict(self) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "latency_ms_p50": _percentile_ms(latencies, 0.5),
+            "latency_ms_p95": _percentile_ms(latencies, 0.95),
+            "avg_prompt_tokens": _mean(self.prompt_tokens),
+            "avg_completion_tokens": _mean(self.completion_tokens)
+        }
+
+class ModelRouter:
+    """Picks the LLM settings for a question category and records how each route performs
+
+    Categories without a route of their own use the ``default`` route. Stats
+    are kept per category so the table can be tuned on observed latency and
+    token usage.
+    """
+
+    def __init__(self, routes: Dict[str, ModelRoute], default: str = "general_health",
+                 window: int = Config.LLM_ROUTE_STATS_WINDOW):
+        self.routes = routes
+        self.default = default
+        self.window = window
+        self._stats: Dict[str, RouteStats] = {}
+        self._lock = threading.Lock()
+
+    def route(self, category: str) -> ModelRoute:
+        return self.routes.get(category) or self.routes[self.default]
+
+    def record(self, category: str, seconds: float, usage: Any = None, error: bool = False):
+        """Record one call made on a category's route"""
+        if category not in self.routes:
+            category = self.default
+        with self._lock:
+            stats = self._stats.get(category)
+            if stats is None:
+                stats = self._stats[category] = RouteStats(self.window)
+            stats.calls += 1
+            if error:
+                stats.errors += 1
+                return
+            stats.latencies.append(seconds)
+            if isinstance(getattr(usage, "prompt_tokens", None), int):
+                stats.prompt_tokens.append(usage.prompt_tokens)
+                stats.completion_tokens.append(usage.completion_tokens)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get each route's settings with its observed latency and token usage"""
+        with self._lock:
+            return {
+                category: {
+                    "model": route.model,
+                    "max_tokens": route.max_tokens,
+                    "temperature": route.temperature,
+                    **(self._stats[category].to_dict() if category in self._stats else RouteStats(0).to_dict())
+                }
+                for category, route in self.routes.items()
+            }
+
+def default_routes() -> Dict[str, ModelRoute]:
+    """Routing table: the configured model for clinical categories, the fast model for simple ones"""
+    routes = {
+        "mental_health": ModelRoute(settings.openai_model, 800, 0.7),
+        "chronic_condition": ModelRoute(settings.openai_model, 800, 0.5),
+        "pain_management": ModelRoute(settings.openai_model, 700, 0.5),
+        "acute_illness": ModelRoute(settings.openai_model, 700, 0.4),
+        "lifestyle": ModelRoute(settings.openai_model, 500, 0.7),
+        "general_health": ModelRoute(settings.openai_model, 500, 0.6)
+    }
+    for category in Config.LLM_FAST_CATEGORIES:
+        if category in routes:
+            route = routes[category]
+            routes[category] = ModelRoute(Config.LLM_FAST_MODEL, route.max_tokens, route.temperature)
+    return routes
+
+def _percentile_ms(samples, fraction: float) -> Optional[float]:
+    if not samples:
+        return None
+    return round(samples[min(len(samples) - 1, int(fraction * len(samples)))] * 1000, 1)
+
+def _mean(values) -> Optional[float]:
+    return round(sum(values) / len(values), 1) if values else None
+
+# Global instance
+model_router = ModelRouter(default_routes())
@@ -4,12 +4,26 @@ Scrapes medical information from trusted sources
 """
 import requests
 from bs4 import BeautifulSoup
+import heapq
 import json
+import re
+import threading
 import time
-from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import List, Dict, Optional, Tuple
 from urllib.parse import urljoin, urlparse
 import logging
-from .utils import logger, clean_text, Config
+from .utils import logger, clean_text, Config, MEDICAL_KEYWORDS, MEDICAL_CATEGORIES
+from .retrieval import DenseRetrievalIndex, DENSE_RETRIEVAL_AVAILABLE
+from .spelling import SpellingCorrector
+from .suggest import SuggestionIndex
+from .cache import VersionedLRUCache, TieredCache, response_cache
+from .indexing import (TextIndex, build_text_index, build_text_indexes, corpus_digest, load_cached_indexes,
+                       save_cached_indexes)
+
+if DENSE_RETRIEVAL_AVAILABLE:
+    import numpy as np
 
 class MedicalScraper:
     """Scraper for medical FAQ content from trusted sources"""
@@ -107,19 +121,29 @@ class MedicalScraper:
         processed_content = []
         
         for item in content:
-            processed_item = {
-                "question": clean_text(item.get("question", "")),
-                "answer": clean_text(item.get("answer", "")),
-                "source": item.get("source", "Unknown"),
-                "category": item.get("category", "general_health")
-            }
-            
-            # Only include items with valid question and answer
-            if processed_item["question"] and processed_item["answer"]:
+            processed_item = self.preprocess_item(item)
+            if processed_item is not None:
                 processed_content.append(processed_item)
         
         return processed_content
     
+    def preprocess_item(self, item: Dict[str, str]) -> Optional[Dict[str, str]]:
+        """Clean a single FAQ record; returns None if it has no valid question and answer"""
+        if not isinstance(item.get("question"), str) or not isinstance(item.get("answer"), str):
+            return None
+        
+        processed_item = {
+            "question": clean_text(item["question"]),
+            "answer": clean_text(item["answer"]),
+            "source": str(item.get("source") or "Unknown"),
+            "category": str(item.get("category") or "general_health")
+        }
+        
+        # Only include items with valid question and answer
+        if processed_item["question"] and processed_item["answer"]:
+            return processed_item
+        return None
+    
     def save_faqs_to_file(self, faqs: List[Dict[str, str]], filename: str = "medical_faqs.json"):
         """Save FAQs to a JSON file"""
         try:
@@ -129,21 +153,247 @@ class MedicalScraper:
         except Exception as e:
             logger.error(f"Error saving FAQs to file: {str(e)}")
 
+class CategoryShard:
+    """The FAQs of one category with their positions in the corpus and their own text index
+
+    Shards are never changed in place; ingestion and reloads swap in new ones.
+    """
+    
+    __slots__ = ("category", "faqs", "positions", "text_index")
+    
+    def __init__(self, category: str, faqs: List[Dict], positions: List[int], text_index: TextIndex):
+        self.category = category
+        self.faqs = faqs
+        self.positions = positions
+        self.text_index = text_index
+    
+    def search(self, query_lower: str, limit: int) -> List[Tuple[int, int, Dict]]:
+        """Top ``limit`` (score, corpus position, faq) keyword matches, earliest first among equal scores"""
+        faqs = self.faqs
+        candidates = self.text_index.candidates(query_lower)
+        query_words = [word for word in query_lower.split() if len(word) > 3]  # Skip short words
+        
+        matches = []
+        for local_id in (range(len(faqs)) if candidates is None else candidates):
+            faq = faqs[local_id]
+            score = keyword_score(query_lower, query_words, faq)
+            if score > 0:
+                matches.append((score, self.positions[local_id], faq))
+        return heapq.nlargest(limit, matches, key=lambda match: match[0])
+
+def keyword_score(query_lower: str, query_words: List[str], faq: Dict) -> int:
+    """Keyword relevance of a FAQ to a lowercase query (``query_words`` are its words longer than 3 characters)"""
+    question_lower = faq.get("question", "").lower()
+    answer_lower = faq.get("answer", "").lower()
+    score = 0
+    
+    # Exact matches in question
+    if query_lower in question_lower:
+        score += 10
+    
+    # Keyword matches
+    for keyword in faq.get("keywords", []):
+        if keyword.lower() in query_lower:
+            score += 5
+    
+    # Partial matches in answer
+    for word in query_words:
+        if word in question_lower:
+            score += 2
+        if word in answer_lower:
+            score += 1
+    
+    return score
+
+def question_overlap(question: str, other: str) -> float:
+    """Share of the two questions' distinct words that they have in common (1.0 for the same words)"""
+    words = set(re.findall(r"[a-z0-9']+", question.lower()))
+    other_words = set(re.findall(r"[a-z0-9']+", other.lower()))
+    if not words or not other_words:
+        return 0.0
+    return len(words & other_words) / len(words | other_words)
+
 class MedicalKnowledgeBase:
-    """Manages the medical knowledge base"""
+    """Manages the medical knowledge base
     
-    def __init__(self):
+    FAQs are partitioned into one shard per category. Category-filtered
+    searches only touch that shard; unfiltered searches take the top matches
+    of every shard (optionally on a thread pool) and merge them. ``faqs``
+    keeps the whole corpus in order for export, stats and the dense index.
+    """
+    
+    SEARCH_MODES = ("keyword", "dense")
+    
+    def __init__(self, search_cache_entries: int = Config.SEARCH_CACHE_MAX_ENTRIES,
+                 index_cache_dir: str = Config.INDEX_CACHE_DIR, search_threads: int = Config.KB_SEARCH_THREADS,
+                 response_cache: Optional[TieredCache] = None):
         self.faqs = []
+        self.shards: Dict[str, CategoryShard] = {}
+        self.index_cache_dir = index_cache_dir
         self.categories = set()
+        self.question_keys = set()
+        self.version = 0
+        # Search results are tagged with the corpus version they were computed on
+        self.search_cache = VersionedLRUCache(search_cache_entries) if search_cache_entries > 0 else None
+        # Cached LLM/RAG answers are grounded in the corpus, so they are invalidated when it changes
+        self.response_cache = response_cache
+        self.corpus_digest = ""
+        self.search_executor = ThreadPoolExecutor(search_threads, thread_name_prefix="kb-search") \
+            if search_threads > 0 else None
+        self.dense_index = None
+        self.spelling = None
+        self.suggestions = None
+        self._suggestion_popularity = {}
+        self._dense_lock = threading.Lock()
+        self._spelling_lock = threading.Lock()
+        self._suggestion_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+    
+    @staticmethod
+    def question_key(question: str) -> str:
+        """Normalized question text used to detect duplicate FAQs"""
+        return " ".join(question.lower().split())
+    
+    @staticmethod
+    def faq_category(faq: Dict) -> str:
+        return faq.get("category", "general")
+    
+    def set_faqs(self, faqs: List[Dict], text_indexes: Optional[Dict[str, TextIndex]] = None,
+                 digest: Optional[str] = None):
+        """Replace the FAQ corpus, sharding and indexing it by category and dropping indexes built over the old one
+        
+        ``text_indexes`` are reused for categories whose FAQ count they match.
+        ``digest`` identifies the corpus (computed from the FAQs if not given).
+        """
+        groups = self._group_by_category(faqs)
+        text_indexes = dict(text_indexes or {})
+        missing = {category: group for category, (group, _) in groups.items()
+                   if category not in text_indexes or text_indexes[category].doc_count != len(group)}
+        if missing:
+            text_indexes.update(build_text_indexes(missing, progress=self._log_index_progress))
+        shards = {category: CategoryShard(category, group, positions, text_indexes[category])
+                  for category, (group, positions) in groups.items()}
+        derived = self._rebuild_derived_indexes(faqs)
+        
+        with self._write_lock, self._dense_lock:
+            self.faqs = faqs
+            self.shards = shards
+            self.categories = set(shards)
+            self.question_keys = set(self.question_key(faq.get("question", "")) for faq in faqs)
+            self._swap_derived_indexes(derived)
+        if self.search_cache is not None:
+            self.search_cache.clear()
+        self._sync_response_cache(digest or self._faqs_digest(faqs))
+    
+    def reload_category(self, category: str, faqs: List[Dict]) -> int:
+        """Replace the FAQs of one category, rebuilding only its shard; returns the FAQs loaded
+        
+        Other shards keep their FAQs and text indexes (only their corpus
+        positions move). The corpus-wide dense, spelling and suggestion
+        indexes that were in use are rebuilt before the swap, so searches keep
+        using the old ones meanwhile. This is slow; call it off the event loop.
+        """
+        faqs = [faq for faq in faqs if self.faq_category(faq) == category]
+        text_index = build_text_index(faqs)
+        
+        with self._write_lock:
+            corpus = [faq for faq in self.faqs if self.faq_category(faq) != category] + faqs
+            groups = self._group_by_category(corpus)
+            shards = {}
+            for name, (group, positions) in groups.items():
+                previous = self.shards.get(name)
+                shard_index = text_index if name == category else previous.text_index
+                shards[name] = CategoryShard(name, group, positions, shard_index)
+            derived = self._rebuild_derived_indexes(corpus)
+            
+            with self._dense_lock:
+                self.faqs = corpus
+                self.shards = shards
+                self.categories = set(shards)
+                self.question_keys = set(self.question_key(faq.get("question", "")) for faq in corpus)
+                self._swap_derived_indexes(derived)
+        if self.search_cache is not None:
+            self.search_cache.clear()
+        self._sync_response_cache(self._faqs_digest(corpus))
+        
+        logger.info(f"Reloaded category {category}: {len(faqs)} FAQs")
+        return len(faqs)
+    
+    def load_category(self, category: str, filename: str = "medical_faqs.json") -> int:
+        """Reload one category from a FAQ file; returns the FAQs loaded"""
+        with open(filename, 'r', encoding='utf-8') as f:
+            return self.reload_category(category, json.load(f))
+    
+    def add_faqs(self, faqs: List[Dict]) -> Tuple[int, int]:
+        """Append cleaned FAQs to the live corpus and indexes; returns (added, duplicates)
+        
+        Keyword searches keep using the previous shards while a batch is merged;
+        the extended list and shards are swapped in by assignment. An already-built
+        dense index is extended in place rather than rebuilt.
+        """
+        with self._write_lock:
+            new_faqs = []
+            for faq in faqs:
+                key = self.question_key(faq["question"])
+                if key not in self.question_keys:
+                    self.question_keys.add(key)
+                    new_faqs.append(faq)
+            if not new_faqs:
+                return 0, len(faqs)
+            
+            documents = [f"{faq['question']} {faq['answer']}" for faq in new_faqs]
+            shards = dict(self.shards)
+            for category, (group, positions) in self._group_by_category(new_faqs, first_position=len(self.faqs)).items():
+                shard = shards.get(category)
+                if shard is None:
+                    shards[category] = CategoryShard(category, group, positions, build_text_index(group, workers=1))
+                else:
+                    shards[category] = CategoryShard(category, shard.faqs + group, shard.positions + positions,
+                                                     shard.text_index.extended(group))
+            index = self.dense_index
+            # Embed outside the dense lock so dense searches are only blocked for the swap
+            vectors = index.embed(documents) if index is not None else None
+            
+            with self._dense_lock:
+                self.faqs = self.faqs + new_faqs
+                self.shards = shards
+                self.categories = set(shards)
+                if self.dense_index is not None:
+                    if self.dense_index is index:
+                        self.dense_index.add_vectors(vectors)
+                    else:
+                        self.dense_index.add(documents)
+                self.version += 1
+            if self.search_cache is not None:
+                self.search_cache.clear()
+            self._sync_response_cache(self._faqs_digest(new_faqs, self.corpus_digest))
+            
+            spelling = self.spelling
+            if spelling is not None:
+                for faq in new_faqs:
+                    spelling.add_text(f"{faq['question']} {faq['answer']}")
+            with self._suggestion_lock:
+                if self.suggestions is not None:
+                    self.suggestions.add_questions(faq["question"] for faq in new_faqs)
+            
+            return len(new_faqs), len(faqs) - len(new_faqs)
         
     def load_faqs(self, filename: str = "medical_faqs.json") -> bool:
-        """Load FAQs from file"""
+        """Load FAQs from file, reusing the shard text indexes cached for the same file contents"""
         try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                self.faqs = json.load(f)
+            with open(filename, 'rb') as f:
+                data = f.read()
+            faqs = json.loads(data.decode('utf-8'))
+            
+            digest = corpus_digest(data)
+            cached = load_cached_indexes(self.index_cache_dir, digest)
+            self.set_faqs(faqs, cached, digest)
+            if cached is None:
+                save_cached_indexes(self.index_cache_dir, digest,
+                                    {category: shard.text_index for category, shard in self.shards.items()})
             
-            self.categories = set(faq.get("category", "general") for faq in self.faqs)
-            logger.info(f"Loaded {len(self.faqs)} FAQs from {filename}")
+            logger.info(f"Loaded {len(self.faqs)} FAQs in {len(self.shards)} category shards from {filename}"
+                        f"{' (cached text indexes)' if cached is not None else ''}")
             return True
             
         except FileNotFoundError:
@@ -153,48 +403,180 @@ class MedicalKnowledgeBase:
             logger.error(f"Error loading FAQs: {str(e)}")
             return False
     
-    def search_faqs(self, query: str, category: str = None, limit: int = 5) -> List[Dict]:
-        """Search FAQs based on query"""
+    @staticmethod
+    def _log_index_progress(indexed: int, total: int):
+        logger.debug(f"Indexed {indexed}/{total} FAQs")
+    
+    @classmethod
+    def _group_by_category(cls, faqs: List[Dict], first_position: int = 0) -> Dict[str, Tuple[List[Dict], List[int]]]:
+        """FAQs and their corpus positions per category, in corpus order"""
+        groups: Dict[str, Tuple[List[Dict], List[int]]] = {}
+        for position, faq in enumerate(faqs, first_position):
+            group, positions = groups.setdefault(cls.faq_category(faq), ([], []))
+            group.append(faq)
+            positions.append(position)
+        return groups
+    
+    @staticmethod
+    def _faqs_digest(faqs: List[Dict], previous: str = "") -> str:
+        """Digest of a corpus, or of ``faqs`` appended to the corpus with digest ``previous``"""
+        return corpus_digest((previous + json.dumps(faqs, sort_keys=True)).encode("utf-8"))
+    
+    def _sync_response_cache(self, digest: str):
+        """Drop cached answers computed over another corpus (in every worker sharing the cache)"""
+        self.corpus_digest = digest
+        if self.response_cache is not None and self.response_cache.sync_data_version(digest):
+            logger.info("Knowledge base changed; invalidated cached answers")
+    
+    def _rebuild_derived_indexes(self, faqs: List[Dict]) -> Tuple[Optional["DenseRetrievalIndex"],
+                                                                   Optional[SpellingCorrector],
+                                                                   Optional[SuggestionIndex]]:
+        """Build the corpus-wide indexes already in use over a new corpus (None for those not built yet)"""
+        dense = self._build_dense_index(faqs) if self.dense_index is not None and faqs else None
+        spelling = self._build_spelling_corrector(faqs) if self.spelling is not None else None
+        suggestions = self.suggestions
+        if suggestions is not None:
+            suggestions = self._build_suggestion_index(faqs, suggestions.get_popularity())
+        return dense, spelling, suggestions
+    
+    def _swap_derived_indexes(self, derived: Tuple):
+        """Replace the corpus-wide indexes with ones rebuilt for the new corpus (callers hold the write and dense locks)"""
+        self.dense_index, spelling, suggestions = derived
+        with self._spelling_lock:
+            self.spelling = spelling
+        with self._suggestion_lock:
+            if suggestions is None and self.suggestions is not None:
+                self._suggestion_popularity = self.suggestions.get_popularity()
+            self.suggestions = suggestions
+        self.version += 1
+    
+    def search_faqs(self, query: str, category: str = None, limit: int = 5, mode: str = "keyword") -> List[Dict]:
+        """Search FAQs based on query, serving repeated queries from the result cache"""
+        query = self.question_key(query)
+        if self.search_cache is None:
+            return self._search_faqs(query, category, limit, mode)
+        
+        # Read the version first: a corpus change during the search leaves the entry stale
+        key = (query, category, limit, mode)
+        version = self.version
+        results = self.search_cache.get(key, version)
+        if results is None:
+            results = self._search_faqs(query, category, limit, mode)
+            self.search_cache.set(key, version, results)
+        return [result.copy() for result in results]
+    
+    def _search_faqs(self, query: str, category: str = None, limit: int = 5, mode: str = "keyword") -> List[Dict]:
+        if mode == "dense":
+            return self.search_faqs_dense(query, category, limit)
+        
         query_lower = query.lower()
-        matching_faqs = []
         
-        for faq in self.faqs:
-            if category and faq.get("category") != category:
+        # A category filter touches one shard; otherwise gather each shard's top matches
+        shards = self.shards
+        if category:
+            targets = [shards[category]] if category in shards else []
+        else:
+            targets = list(shards.values())
+        if self.search_executor is not None and len(targets) > 1:
+            shard_matches = list(self.search_executor.map(lambda shard: shard.search(query_lower, limit), targets))
+        else:
+            shard_matches = [shard.search(query_lower, limit) for shard in targets]
+        matching_faqs = list(chain.from_iterable(shard_matches))
+        
+        # Nothing matched: retry once with misspelled terms corrected
+        if not matching_faqs and Config.SPELLING_CORRECTION_ENABLED:
+            corrected = self.correct_query(query)
+            if corrected != query:
+                return self._search_faqs(corrected, category, limit, mode)
+        
+        # Top matches by relevance score, earlier FAQs first among ties (like a full sort); only those are copied
+        top_faqs = heapq.nlargest(limit, matching_faqs, key=lambda match: (match[0], -match[1]))
+        return [{**faq, "relevance_score": score} for score, _, faq in top_faqs]
+    
+    def search_faqs_dense(self, query: str, category: str = None, limit: int = 5) -> List[Dict]:
+        """Search FAQs by embedding similarity, falling back to keyword search"""
+        index = self.get_dense_index()
+        if index is None:
+            return self._search_faqs(query, category, limit)
+        
+        # Ingestion may be mid-way through extending the corpus and index; only use rows both have
+        faqs = self.faqs
+        candidates = None
+        if category:
+            shard = self.shards.get(category)
+            candidates = np.array(shard.positions if shard is not None else [], dtype=np.int64)
+            candidates = candidates[candidates < len(index)]
+        
+        matching_faqs = []
+        for doc_index, score in index.search(query, limit, candidates):
+            if score < Config.DENSE_MIN_SCORE or doc_index >= len(faqs):
                 continue
-                
-            question_lower = faq.get("question", "").lower()
-            answer_lower = faq.get("answer", "").lower()
-            keywords = faq.get("keywords", [])
-            
-            score = 0
-            
-            # Exact matches in question
-            if query_lower in question_lower:
-                score += 10
-            
-            # Keyword matches
-            for keyword in keywords:
-                if keyword.lower() in query_lower:
-                    score += 5
-            
-            # Partial matches in answer
-            query_words = query_lower.split()
-            for word in query_words:
-                if len(word) > 3:  # Skip short words
-                    if word in question_lower:
-                        score += 2
-                    if word in answer_lower:
-                        score += 1
-            
-            if score > 0:
-                faq_with_score = faq.copy()
-                faq_with_score["relevance_score"] = score
-                matching_faqs.append(faq_with_score)
+            faq_with_score = faqs[doc_index].copy()
+            faq_with_score["relevance_score"] = round(score, 4)
+            matching_faqs.append(faq_with_score)
         
-        # Sort by relevance score
-        matching_faqs.sort(key=lambda x: x["relevance_score"], reverse=True)
+        return matching_faqs
+    
+    def get_dense_index(self) -> Optional["DenseRetrievalIndex"]:
+        """Get the dense index, building it on first use after each corpus change"""
+        if not DENSE_RETRIEVAL_AVAILABLE or not self.faqs:
+            return None
         
-        return matching_faqs[:limit]
+        with self._dense_lock:
+            if self.dense_index is None:
+                self.dense_index = self._build_dense_index(self.faqs)
+            return self.dense_index
+    
+    @staticmethod
+    def _build_dense_index(faqs: List[Dict]) -> "DenseRetrievalIndex":
+        return DenseRetrievalIndex().build([f"{faq.get('question', '')} {faq.get('answer', '')}" for faq in faqs])
+    
+    def get_spelling_corrector(self) -> SpellingCorrector:
+        """Get the spelling corrector, building its vocabulary on first use after each corpus change"""
+        with self._spelling_lock:
+            if self.spelling is None:
+                self.spelling = self._build_spelling_corrector(self.faqs)
+            return self.spelling
+    
+    @staticmethod
+    def _build_spelling_corrector(faqs: List[Dict]) -> SpellingCorrector:
+        spelling = SpellingCorrector()
+        # Medical terms outrank ordinary corpus words when several corrections are equally close
+        for term in MEDICAL_KEYWORDS + [term for terms in MEDICAL_CATEGORIES.values() for term in terms]:
+            spelling.add_text(term, weight=100)
+        for faq in faqs:
+            spelling.add_text(f"{faq.get('question', '')} {faq.get('answer', '')}")
+            spelling.add_words(faq.get("keywords", []), weight=10)
+        return spelling
+    
+    def correct_query(self, query: str) -> str:
+        """Correct misspelled medical terms against the knowledge base vocabulary (for searches that found nothing)"""
+        if not Config.SPELLING_CORRECTION_ENABLED:
+            return query
+        return self.get_spelling_corrector().correct(query)
+    
+    def get_suggestion_index(self) -> SuggestionIndex:
+        """Get the autocomplete index, building it on first use after each corpus reload"""
+        with self._suggestion_lock:
+            if self.suggestions is None:
+                self.suggestions = self._build_suggestion_index(self.faqs, self._suggestion_popularity)
+            return self.suggestions
+    
+    @staticmethod
+    def _build_suggestion_index(faqs: List[Dict], popularity: Dict) -> SuggestionIndex:
+        return SuggestionIndex().build((faq.get("question", "") for faq in faqs), MEDICAL_KEYWORDS,
+                                       popularity=popularity)
+    
+    def record_question(self, question: str):
+        """Count an asked question toward autocomplete popularity"""
+        suggestions = self.suggestions
+        if suggestions is not None:
+            suggestions.record_query(question)
+    
+    def get_category_faqs(self, category: str) -> List[Dict]:
+        """FAQs of one category, in corpus order"""
+        shard = self.shards.get(category)
+        return shard.faqs if shard is not None else []
     
     def get_categories(self) -> List[str]:
         """Get all available categories"""
@@ -204,14 +586,20 @@ class MedicalKnowledgeBase:
         """Get knowledge base statistics"""
         return {
             "total_faqs": len(self.faqs),
+            "version": self.version,
             "categories": len(self.categories),
-            "category_breakdown": {cat: len([faq for faq in self.faqs if faq.get("category") == cat]) 
-                                 for cat in self.categories}
+            "category_breakdown": {category: len(shard.faqs) for category, shard in self.shards.items()},
+            "dense_index": self.dense_index.get_stats() if self.dense_index is not None else None,
+            "spelling": self.spelling.get_stats() if self.spelling is not None else None,
+            "suggestions": self.suggestions.get_stats() if self.suggestions is not None else None,
+            "search_cache": self.search_cache.get_stats() if self.search_cache is not None else None,
+            "text_indexes": {category: shard.text_index.get_stats() for category, shard in self.shards.items()},
+            "parallel_search": self.search_executor is not None
         }
 
 # Global instances for easy access
 medical_scraper = MedicalScraper()
-knowledge_base = MedicalKnowledgeBase()
+knowledge_base = MedicalKnowledgeBase(response_cache=response_cache)
 
 def initialize_knowledge_base():
     """Initialize the knowledge base with scraped data"""
@@ -220,8 +608,7 @@ def initialize_knowledge_base():
         faqs = medical_scraper.scrape_all_sources()
         processed_faqs = medical_scraper.preprocess_content(faqs)
         medical_scraper.save_faqs_to_file(processed_faqs)
-        knowledge_base.faqs = processed_faqs
-        knowledge_base.categories = set(faq.get("category", "general") for faq in processed_faqs)
+        knowledge_base.set_faqs(processed_faqs)
 
 if __name__ == "__main__":
     # Initialize and test the scraper
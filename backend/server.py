@@ -0,0 +1,166 @@
+"""
+Production Launcher for ShifaAI
+Preloads the engines once in a master process, then forks workers that share them copy-on-write
+
+Usage:
+    python -m backend.server                        # one worker (WEB_CONCURRENCY overrides)
+    python -m backend.server --workers 4 --port 8000
+    python -m backend.server --workers 0            # one worker per CPU
+    python -m backend.server --no-preload           # every worker loads its own engines (for comparison)
+
+Workers share nothing after the fork except the cache tier when it is Redis:
+admin changes (ingest, category reload, short-circuit tuning), conversation
+memory and in-memory traces only exist in the worker that handled the request.
+Admission limits are divided between the workers so they hold in total.
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import uvicorn
+
+from .utils import logger, settings, Config
+
+def fastest_loop_and_parser() -> Tuple[str, str]:
+    """uvloop and httptools when installed (uvicorn[standard]), otherwise the pure-Python defaults"""
+    try:
+        import uvloop  # noqa: F401
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+    try:
+        import httptools  # noqa: F401
+        http = "httptools"
+    except ImportError:
+        http = "h11"
+    return loop, http
+
+def bind_socket(host: str, port: int, backlog: int = 2048) -> socket.socket:
+    """Listening socket created by the master and inherited by every worker"""
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+class WorkerSupervisor:
+    """Forks uvicorn workers serving one shared socket and replaces workers that die
+
+    SIGTERM or SIGINT is passed on to the workers, which finish their
+    in-flight requests and run the shutdown hooks before the master exits.
+    """
+
+    def __init__(self, app, sock: socket.socket, workers: int, loop: str = "auto", http: str = "auto",
+                 restart_delay: float = Config.SERVER_RESTART_DELAY):
+        self.app = app
+        self.sock = sock
+        self.workers = workers
+        self.loop = loop
+        self.http = http
+        self.restart_delay = restart_delay
+        self.children: Dict[int, float] = {}
+        self.stopping = False
+
+    def run(self) -> int:
+        """Start the workers and supervise them until they have all stopped"""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for _ in range(self.workers):
+            self._spawn()
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = self.children.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            logger.warning(f"Worker {pid} exited with code {os.waitstatus_to_exitcode(status)}; starting a replacement")
+            # A worker that fails at startup would otherwise be restarted in a tight loop
+            if time.monotonic() - started < self.restart_delay:
+                time.sleep(self.restart_delay)
+            if not self.stopping:
+                self._spawn()
+        return 0
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._serve()
+            except BaseException as e:
+                logger.error(f"Worker {os.getpid()} failed: {str(e)}")
+                code = 1
+            finally:
+                os._exit(code)
+        self.children[pid] = time.monotonic()
+
+    def _serve(self):
+        # The master's handlers must not run in the worker; uvicorn installs its own
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        gc.enable()
+        if self.workers > 1:
+            from .querylog import query_log
+            query_log.split_per_process()
+        config = uvicorn.Config(self.app, loop=self.loop, http=self.http, log_level=settings.log_level.lower())
+        uvicorn.Server(config).run(sockets=[self.sock])
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Run ShifaAI with preloaded engines and forked workers")
+    parser.add_argument("--host", default=settings.host)
+    parser.add_argument("--port", type=int, default=settings.port)
+    parser.add_argument("--workers", type=int, default=Config.SERVER_WORKERS, help="worker processes (0 = one per CPU)")
+    parser.add_argument("--no-preload", action="store_true", help="load the engines in each worker instead")
+    args = parser.parse_args(argv)
+    workers = args.workers or os.cpu_count() or 1
+
+    # Collections in the master free objects and leave holes in pages the workers would then copy;
+    # after the preload, freeze() keeps collections in the workers from touching the shared objects
+    gc.disable()
+    start = time.perf_counter()
+    # Importing the app creates cbt_engine and shifa_engine; load_engines() loads the knowledge base
+    from .app import app, load_engines
+    if not args.no_preload:
+        load_engines()
+    gc.freeze()
+    if not args.no_preload:
+        logger.info(f"Preloaded engines in {time.perf_counter() - start:.1f}s "
+                    f"({gc.get_freeze_count()} objects frozen)")
+
+    from .admission import admission_controller
+    from .cache import shared_backend, LocalBackend
+    if workers > 1:
+        admission_controller.partition(workers)
+        logger.warning(f"Running {workers} workers: admission limits are split between them, but admin changes "
+                       f"(knowledge ingest and reload, short-circuit tuning), conversation memory and in-memory "
+                       f"traces apply only to the worker that served the request")
+    if workers > 1 and isinstance(shared_backend, LocalBackend):
+        logger.warning(f"The shared cache tier is per process (CACHE_BACKEND={Config.CACHE_BACKEND}): the {workers} "
+                       f"workers each cache their own answers and invalidations do not reach the others; "
+                       f"set CACHE_BACKEND=redis")
+
+    loop, http = fastest_loop_and_parser()
+    sock = bind_socket(args.host, args.port)
+    logger.info(f"Serving on {args.host}:{args.port} with {workers} worker{'s' if workers != 1 else ''} "
+                f"({loop} event loop, {http} HTTP parser)")
+    sys.exit(WorkerSupervisor(app, sock, workers, loop, http).run())
+
+if __name__ == "__main__":
+    main()
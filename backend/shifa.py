@@ -3,9 +3,12 @@ Shifa (Islamic Healing) Module for ShifaAI
 Provides Islamic healing guidance based on authentic sources
 """
 import random
-from typing import Dict, List, Optional, Any
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Any, Tuple
 from enum import Enum
 from .utils import logger, ResponseFormatter, get_islamic_greeting
+from .records import CatalogRecord
+from .tracing import tracer
 
 class HealingType(Enum):
     """Types of Islamic healing approaches"""
@@ -15,6 +18,32 @@ class HealingType(Enum):
     SPIRITUAL = "spiritual"
     DIETARY = "dietary"
 
+@dataclass(frozen=True, slots=True)
+class HealingDua(CatalogRecord):
+    """Immutable healing du'a catalog entry"""
+    arabic: str
+    transliteration: str
+    translation: str
+    source: str
+    category: str
+    benefits: Tuple[str, ...]
+    recitation_notes: str
+
+@dataclass(frozen=True, slots=True)
+class PropheticRemedy(CatalogRecord):
+    """Immutable prophetic medicine catalog entry"""
+    arabic_name: str
+    description: str
+    recommended_for: Tuple[str, ...]
+    usage: str
+    halal_status: str
+    precautions: str
+    quran_reference: Optional[str] = None
+    prophetic_saying: Optional[str] = None
+    prophetic_usage: Optional[str] = None
+    modern_benefits: Optional[Tuple[str, ...]] = None
+    spiritual_benefits: Optional[Tuple[str, ...]] = None
+
 class ShifaEngine:
     """Islamic healing module with du'as, prophetic medicine, and halal compliance"""
     
@@ -23,9 +52,9 @@ class ShifaEngine:
         self.prophetic_remedies = self._load_prophetic_remedies()
         self.general_guidance = self._load_general_guidance()
         
-    def _load_healing_duas(self) -> Dict[str, Dict[str, Any]]:
+    def _load_healing_duas(self) -> Dict[str, HealingDua]:
         """Load authentic healing du'as from Quran and Sunnah"""
-        return {
+        duas = {
             "general_healing": {
                 "arabic": "اللَّهُمَّ رَبَّ النَّاسِ أَذْهِبِ الْبَأْسَ وَاشْفِ أَنْتَ الشَّافِي لاَ شِفَاءَ إِلاَّ شِفَاؤُكَ شِفَاءً لاَ يُغَادِرُ سَقَمًا",
                 "transliteration": "Allahumma rabbannāsi adhhibil-ba'sa washfi anta ash-shāfī lā shifā'a illā shifā'uka shifā'an lā yughādiru saqamā",
@@ -81,10 +110,11 @@ class ShifaEngine:
                 "recitation_notes": "Recite 7 times while placing hand on area of pain"
             }
         }
+        return {key: HealingDua.from_dict(data) for key, data in duas.items()}
     
-    def _load_prophetic_remedies(self) -> Dict[str, Dict[str, Any]]:
+    def _load_prophetic_remedies(self) -> Dict[str, PropheticRemedy]:
         """Load authentic prophetic medical remedies"""
-        return {
+        remedies = {
             "honey": {
                 "arabic_name": "عَسَل",
                 "description": "Honey is mentioned in the Quran as having healing properties",
@@ -166,6 +196,7 @@ class ShifaEngine:
                 "precautions": "Ensure authenticity of source"
             }
         }
+        return {key: PropheticRemedy.from_dict(data) for key, data in remedies.items()}
     
     def _load_general_guidance(self) -> Dict[str, List[str]]:
         """Load general Islamic health guidance"""
@@ -193,6 +224,7 @@ class ShifaEngine:
             ]
         }
     
+    @tracer.traced("shifa.healing_dua")
     def get_healing_dua(self, category: str = None, specific_condition: str = None) -> Dict[str, Any]:
         """Get appropriate healing du'a based on category or condition"""
         try:
@@ -233,6 +265,7 @@ class ShifaEngine:
             logger.error(f"Error getting healing du'a: {str(e)}")
             return self._get_default_dua()
     
+    @tracer.traced("shifa.prophetic_remedy")
     def get_prophetic_remedy(self, condition: str) -> Dict[str, Any]:
         """Get relevant prophetic medicine recommendation"""
         try:
@@ -267,8 +300,8 @@ class ShifaEngine:
             
             return {
                 "remedy": remedy,
-                "Islamic_guidance": f"Following the Sunnah of Prophet Muhammad (ﷺ) in using {remedy['arabic_name']}",
-                "halal_verification": remedy["halal_status"],
+                "Islamic_guidance": f"Following the Sunnah of Prophet Muhammad (ﷺ) in using {remedy.arabic_name}",
+                "halal_verification": remedy.halal_status,
                 "modern_validation": "This remedy aligns with both Islamic teachings and modern nutritional science"
             }
             
@@ -396,6 +429,7 @@ class ShifaEngine:
 # Global instance
 shifa_engine = ShifaEngine()
 
+@tracer.traced("shifa")
 async def get_shifa_guidance(query: str, query_type: str = "general") -> Dict[str, Any]:
     """
     Get Islamic healing guidance based on user query
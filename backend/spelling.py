@@ -0,0 +1,118 @@
+"""
+Spelling Correction for ShifaAI
+SymSpell-style deletion index for typo-tolerant search
+"""
+import re
+from typing import Dict, Iterable, List, Set
+
+from .utils import Config
+
+_WORD_PATTERN = re.compile(r"[A-Za-z]+")
+
+class SpellingCorrector:
+    """Corrects misspelled words against a vocabulary with a symmetric deletion index
+
+    Every vocabulary word is indexed under all variants with up to
+    ``max_distance`` characters deleted (from its first ``prefix_length``
+    characters). A misspelling shares at least one deletion variant with the
+    intended word, so lookups are a handful of dict probes followed by an
+    exact edit distance check on the few candidates.
+    """
+
+    def __init__(self, max_distance: int = Config.SPELLING_MAX_DISTANCE,
+                 min_word_length: int = Config.SPELLING_MIN_WORD_LENGTH, prefix_length: int = 7,
+                 max_cached: int = 50000):
+        self.max_distance = max_distance
+        self.min_word_length = min_word_length
+        self.prefix_length = prefix_length
+        self.max_cached = max_cached
+        self.words: Dict[str, int] = {}
+        self.deletes: Dict[str, List[str]] = {}
+        self._cache: Dict[str, str] = {}
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def add_words(self, words: Iterable[str], weight: int = 1):
+        """Add words (or raise their frequency) in the vocabulary"""
+        for word in words:
+            word = word.lower()
+            if word in self.words:
+                self.words[word] += weight
+                continue
+            self.words[word] = weight
+            for variant in self._delete_variants(word[:self.prefix_length], self.max_distance):
+                self.deletes.setdefault(variant, []).append(word)
+        self._cache.clear()
+
+    def add_text(self, text: str, weight: int = 1):
+        """Add every word of a text to the vocabulary"""
+        self.add_words((word for word in _WORD_PATTERN.findall(text) if len(word) >= 3), weight)
+
+    def correct_word(self, word: str) -> str:
+        """Get the closest, most frequent vocabulary word within the allowed distance"""
+        word = word.lower()
+        if len(word) < self.min_word_length or word in self.words:
+            return word
+        cached = self._cache.get(word)
+        if cached is not None:
+            return cached
+
+        # Short words tolerate one edit, longer words up to max_distance
+        max_distance = min(self.max_distance, 1 if len(word) < 8 else 2)
+        candidates: Set[str] = set()
+        for variant in self._delete_variants(word[:self.prefix_length], max_distance):
+            candidates.update(self.deletes.get(variant, ()))
+
+        best = word
+        best_rank = (max_distance + 1, 0)
+        for candidate in candidates:
+            if abs(len(candidate) - len(word)) > max_distance:
+                continue
+            distance = edit_distance(word, candidate, max_distance)
+            rank = (distance, -self.words[candidate])
+            if distance <= max_distance and rank < best_rank:
+                best, best_rank = candidate, rank
+
+        if len(self._cache) >= self.max_cached:
+            self._cache.clear()
+        self._cache[word] = best
+        return best
+
+    def correct(self, text: str) -> str:
+        """Correct every misspelled word of a text, keeping everything else unchanged"""
+        return _WORD_PATTERN.sub(lambda match: self._correct_match(match.group(0)), text)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"vocabulary": len(self.words), "delete_variants": len(self.deletes), "cached": len(self._cache)}
+
+    def _correct_match(self, word: str) -> str:
+        corrected = self.correct_word(word)
+        return word if corrected == word.lower() else corrected
+
+    @staticmethod
+    def _delete_variants(word: str, distance: int) -> Set[str]:
+        variants = {word}
+        frontier = {word}
+        for _ in range(distance):
+            frontier = {item[:i] + item[i + 1:] for item in frontier for i in range(len(item))}
+            variants |= frontier
+        return variants
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Optimal string alignment distance (Levenshtein plus transpositions), capped at max_distance + 1"""
+    if a == b:
+        return 0
+    previous_previous: List[int] = []
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous_previous[j - 2] + 1)
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous_previous, previous = previous, current
+    return min(previous[-1], max_distance + 1)
@@ -0,0 +1,190 @@
+"""
+Question Autocomplete for ShifaAI
+Sorted-array prefix index over FAQ questions and medical keywords
+"""
+import heapq
+import time
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+from .utils import Config, extract_keywords
+
+Segment = Tuple[List[str], List[int]]
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.lower().split())
+
+class SuggestionIndex:
+    """Prefix autocomplete ranked by popularity
+
+    Each FAQ question is indexed under every word position (so "diab" finds
+    "What are the symptoms of diabetes?") and each medical keyword under
+    itself, as truncated keys in sorted arrays searched with binary search.
+
+    Entries that have been asked about (and keywords) are also kept in a
+    small "popular" array that is always searched in full, while the large
+    array is only scanned for the first ``max_scan`` keys of a prefix range,
+    so broad prefixes like "wh" cost the same as narrow ones. Results are
+    cached per prefix for ``cache_ttl`` seconds.
+    """
+
+    def __init__(self, max_scan: int = Config.SUGGEST_MAX_SCAN, max_cached_prefixes: int = 10000,
+                 cache_ttl: float = Config.SUGGEST_CACHE_TTL):
+        self.max_scan = max_scan
+        self.max_cached_prefixes = max_cached_prefixes
+        self.cache_ttl = cache_ttl
+        self.texts: List[str] = []
+        self.normalized: List[str] = []
+        self.kinds: List[str] = []
+        self.popularity: List[int] = []
+        self._ids_by_text: Dict[str, int] = {}
+        # Main sorted segment plus a small delta for recently added questions,
+        # swapped together as one tuple so readers never see a half-updated index
+        self._segments: Tuple[Segment, Segment] = (([], []), ([], []))
+        self._popular: Segment = ([], [])
+        self._popular_ids: Set[int] = set()
+        self._cache: "OrderedDict[Tuple[str, int], Tuple[float, List[Dict[str, Any]]]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def build(self, questions: Iterable[str], keywords: Iterable[str],
+              popularity: Dict[str, int] = None) -> "SuggestionIndex":
+        """Index questions and keywords, carrying over popularity counts by text"""
+        popularity = popularity or {}
+        questions = list(questions)
+        pairs = self._add_questions(questions, popularity)
+
+        normalized_questions = [normalize_text(question) for question in questions]
+        for keyword in keywords:
+            normalized = normalize_text(keyword)
+            # Seed keyword popularity with how many FAQs mention it
+            default = sum(1 for question in normalized_questions if normalized in question) + 1
+            entry_id = self._add_entry(keyword, "keyword", popularity.get(normalized, default))
+            if entry_id is not None:
+                pairs.extend(self._entry_keys(entry_id))
+
+        pairs.sort()
+        self._segments = (_split(pairs), ([], []))
+        popular = [pair for pair in pairs if self.popularity[pair[1]] > 1 or self.kinds[pair[1]] == "keyword"]
+        self._popular_ids = {entry_id for _, entry_id in popular}
+        self._popular = _split(popular)
+        self._cache.clear()
+        return self
+
+    def add_questions(self, questions: Iterable[str]):
+        """Index new questions in the delta segment, merging it into the main one when it grows"""
+        pairs = self._add_questions(questions, {})
+        if not pairs:
+            return
+        main, delta = self._segments
+        delta_pairs = sorted([*zip(*delta), *pairs])
+        if len(delta_pairs) > max(10000, len(main[0]) // 8):
+            self._segments = (_split(sorted([*zip(*main), *delta_pairs])), ([], []))
+        else:
+            self._segments = (main, _split(delta_pairs))
+        self._cache.clear()
+
+    def suggest(self, prefix: str, limit: int = 8) -> List[Dict[str, Any]]:
+        """Get the most popular entries containing a word that starts with the prefix"""
+        prefix = normalize_text(prefix)
+        if len(prefix) < Config.SUGGEST_MIN_PREFIX:
+            return []
+
+        cache_key = (prefix, limit)
+        cached = self._cache.get(cache_key)
+        now = time.monotonic()
+        if cached is not None and cached[0] > now:
+            self._cache.move_to_end(cache_key)
+            return cached[1]
+
+        key_prefix = prefix[:Config.SUGGEST_KEY_CHARS]
+        entry_ids = set(_prefix_range(self._popular, key_prefix))
+        for segment in self._segments:
+            entry_ids.update(_prefix_range(segment, key_prefix, self.max_scan))
+        if len(prefix) > len(key_prefix):
+            # Keys are truncated; check longer prefixes against the full text
+            entry_ids = {entry_id for entry_id in entry_ids if self.normalized[entry_id].startswith(prefix)
+                         or " " + prefix in self.normalized[entry_id]}
+
+        # Most popular first, then entries that start with the prefix, then shorter texts
+        top_ids = heapq.nlargest(limit, entry_ids, key=lambda entry_id: (
+            self.popularity[entry_id],
+            self.normalized[entry_id].startswith(prefix),
+            -len(self.texts[entry_id])
+        ))
+        suggestions = [
+            {"text": self.texts[entry_id], "type": self.kinds[entry_id], "popularity": self.popularity[entry_id]}
+            for entry_id in top_ids
+        ]
+
+        self._cache[cache_key] = (now + self.cache_ttl, suggestions)
+        if len(self._cache) > self.max_cached_prefixes:
+            self._cache.popitem(last=False)
+        return suggestions
+
+    def record_query(self, question: str):
+        """Count a user question toward the popularity of matching entries"""
+        normalized = normalize_text(question)
+        for text in [normalized, *extract_keywords(normalized)]:
+            entry_id = self._ids_by_text.get(text)
+            if entry_id is None:
+                continue
+            self.popularity[entry_id] += 1
+            if entry_id not in self._popular_ids:
+                self._popular_ids.add(entry_id)
+                pairs = list(zip(*self._popular))
+                for pair in self._entry_keys(entry_id):
+                    insort(pairs, pair)
+                self._popular = _split(pairs)
+
+    def get_popularity(self) -> Dict[str, int]:
+        """Popularity counts by normalized text (carried over when the index is rebuilt)"""
+        return {text: self.popularity[entry_id] for text, entry_id in self._ids_by_text.items()}
+
+    def get_stats(self) -> Dict[str, int]:
+        main, delta = self._segments
+        return {
+            "entries": len(self.texts),
+            "keys": len(main[0]) + len(delta[0]),
+            "delta_keys": len(delta[0]),
+            "popular_keys": len(self._popular[0]),
+            "cached_prefixes": len(self._cache)
+        }
+
+    def _add_questions(self, questions: Iterable[str], popularity: Dict[str, int]) -> List[Tuple[str, int]]:
+        pairs = []
+        for question in questions:
+            entry_id = self._add_entry(question, "question", popularity.get(normalize_text(question), 1))
+            if entry_id is not None:
+                pairs.extend(self._entry_keys(entry_id))
+        return pairs
+
+    def _entry_keys(self, entry_id: int) -> List[Tuple[str, int]]:
+        """Index keys for an entry: its text from each word position, truncated"""
+        words = self.normalized[entry_id].split(" ")
+        return [(" ".join(words[position:])[:Config.SUGGEST_KEY_CHARS], entry_id) for position in range(len(words))]
+
+    def _add_entry(self, text: str, kind: str, popularity: int):
+        normalized = normalize_text(text)
+        if not normalized or normalized in self._ids_by_text:
+            return None
+        self._ids_by_text[normalized] = len(self.texts)
+        self.texts.append(text)
+        self.normalized.append(normalized)
+        self.kinds.append(kind)
+        self.popularity.append(popularity)
+        return len(self.texts) - 1
+
+def _split(pairs: List[Tuple[str, int]]) -> Segment:
+    return [key for key, _ in pairs], [entry_id for _, entry_id in pairs]
+
+def _prefix_range(segment: Segment, prefix: str, max_keys: int = None) -> List[int]:
+    """Entry ids of the keys starting with the prefix (at most ``max_keys``)"""
+    keys, entry_ids = segment
+    start = bisect_left(keys, prefix)
+    end = bisect_left(keys, prefix + "\uffff", start)
+    if max_keys is not None:
+        end = min(end, start + max_keys)
+    return entry_ids[start:end]
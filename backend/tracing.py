@@ -0,0 +1,276 @@
+"""
+Request Tracing for ShifaAI
+Request IDs and lightweight spans across the app, router, CBT and Shifa modules
+"""
+import asyncio
+import functools
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional
+
+from .utils import logger, Config, request_id_var
+from .profiling import stage
+
+_REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+class Span:
+    """One timed stage of a request"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start_time", "duration_ms", "attributes", "error")
+
+    def __init__(self, name: str, trace_id: Optional[str], parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.start_time = time.time()
+        self.duration_ms = 0.0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration_ms": round(self.duration_ms, 3),
+            "attributes": self.attributes,
+            "error": self.error
+        }
+
+class InMemorySpanExporter:
+    """Keeps the most recent spans in memory (tests and /admin/traces)"""
+
+    def __init__(self, max_spans: int = Config.TRACING_MEMORY_SPANS):
+        self._spans: Deque[Span] = deque(maxlen=max_spans)
+
+    def export(self, spans: List[Span]):
+        self._spans.extend(spans)
+
+    def get_spans(self, trace_id: Optional[str] = None) -> List[Span]:
+        return [span for span in self._spans if trace_id is None or span.trace_id == trace_id]
+
+    def clear(self):
+        self._spans.clear()
+
+class FileSpanExporter:
+    """Buffers spans in memory and appends them to a JSON Lines file from a background thread
+
+    ``export()`` only appends to a buffer; the writer thread wakes once
+    ``batch_size`` spans are waiting or every ``flush_interval`` seconds and
+    writes the batch in one append. If the writer falls behind, the oldest
+    buffered spans are dropped. The thread is started on first export in
+    each process, so forked workers get their own.
+    """
+
+    def __init__(self, path: str = Config.TRACING_FILE, batch_size: int = Config.TRACING_BATCH_SIZE,
+                 flush_interval: float = Config.TRACING_FLUSH_SECONDS, max_buffered: int = Config.TRACING_MAX_BUFFERED):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._buffer: Deque[Span] = deque(maxlen=max_buffered)
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._batch_ready = threading.Event()
+        self._writer_pid: Optional[int] = None
+        self._stats = {"exported": 0, "written": 0, "dropped": 0, "batches": 0, "write_errors": 0}
+
+    def export(self, spans: List[Span]):
+        """Buffer a request's spans (never blocks on I/O)"""
+        with self._lock:
+            overflow = len(self._buffer) + len(spans) - self._buffer.maxlen
+            if overflow > 0:
+                self._stats["dropped"] += overflow
+            self._buffer.extend(spans)
+            self._stats["exported"] += len(spans)
+            buffered = len(self._buffer)
+            if self._writer_pid != os.getpid():
+                self._writer_pid = os.getpid()
+                threading.Thread(target=self._run, name="span-writer", daemon=True).start()
+        if buffered >= self.batch_size:
+            self._batch_ready.set()
+
+    def flush(self) -> int:
+        """Write everything buffered so far; returns the spans written"""
+        with self._lock:
+            batch = list(self._buffer)
+            self._buffer.clear()
+        return self._write(batch)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"path": self.path, "buffered": len(self._buffer), **self._stats}
+
+    def _run(self):
+        while True:
+            self._batch_ready.wait(self.flush_interval)
+            self._batch_ready.clear()
+            self.flush()
+
+    def _write(self, batch: List[Span]) -> int:
+        if not batch:
+            return 0
+        lines = "".join(json.dumps(span.to_dict(), default=str) + "\n" for span in batch)
+        try:
+            with self._write_lock, open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+        except OSError as e:
+            self._stats["write_errors"] += 1
+            logger.error(f"Failed to write {len(batch)} spans to {self.path}: {str(e)}")
+            return 0
+        self._stats["written"] += len(batch)
+        self._stats["batches"] += 1
+        return len(batch)
+
+# Innermost open span, and the finished spans of the current request awaiting export
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+_pending_spans: ContextVar[Optional[List[Span]]] = ContextVar("pending_spans", default=None)
+
+class Tracer:
+    """Creates nested spans and hands each finished request's spans to an exporter
+
+    Any object with an ``export(spans)`` method can be plugged in as the
+    exporter; with no exporter spans are still timed (for Server-Timing) and
+    request IDs still propagate, but nothing is recorded.
+    """
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+        self._stats = {"spans": 0, "traces": 0, "export_errors": 0}
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        """Time a block as a child of the current span"""
+        parent = _current_span.get()
+        span = Span(name, request_id_var.get(), parent.span_id if parent else None, attributes)
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            with stage(name):
+                yield span
+        except Exception as e:
+            span.error = f"{type(e).__name__}: {str(e)}"
+            raise
+        finally:
+            span.duration_ms = (time.perf_counter() - start) * 1000
+            _current_span.reset(token)
+            self._finish(span, parent)
+
+    def traced(self, name: str) -> Callable:
+        """Decorator that runs a sync or async function inside a span"""
+        def decorator(func: Callable) -> Callable:
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.span(name):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def trace(self, name: str, request_id: Optional[str] = None, **attributes: Any) -> Iterator[Span]:
+        """Start a request: assign its ID and open the root span"""
+        id_token = request_id_var.set(request_id or new_request_id())
+        pending_token = _pending_spans.set([])
+        parent_token = _current_span.set(None)
+        try:
+            with self.span(name, **attributes) as root:
+                yield root
+        finally:
+            _current_span.reset(parent_token)
+            _pending_spans.reset(pending_token)
+            request_id_var.reset(id_token)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = {"exporter": type(self.exporter).__name__ if self.exporter else None, **self._stats}
+        if isinstance(self.exporter, FileSpanExporter):
+            stats["file"] = self.exporter.get_stats()
+        return stats
+
+    def _finish(self, span: Span, parent: Optional[Span]):
+        self._stats["spans"] += 1
+        if self.exporter is None:
+            return
+        pending = _pending_spans.get()
+        if parent is not None and pending is not None:
+            pending.append(span)
+            return
+
+        # Root span (or a span outside any request): export everything collected
+        spans = [*pending, span] if pending else [span]
+        if pending:
+            pending.clear()
+        self._stats["traces"] += 1
+        try:
+            self.exporter.export(spans)
+        except Exception as e:
+            self._stats["export_errors"] += 1
+            logger.warning(f"Failed to export {len(spans)} spans: {str(e)}")
+
+class TracingMiddleware:
+    """ASGI middleware that assigns each request an ID and wraps it in a root span
+
+    A well-formed incoming ``X-Request-ID`` is reused so traces can be joined
+    with upstream proxies; the ID is echoed back in the response headers.
+    """
+
+    def __init__(self, app, tracer: "Tracer"):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                candidate = value.decode("latin-1")
+                if _REQUEST_ID_PATTERN.match(candidate):
+                    request_id = candidate
+                break
+
+        with self.tracer.trace(f"{scope['method']} {scope['path']}", request_id,
+                               method=scope["method"], path=scope["path"]) as root:
+            async def send_with_request_id(message):
+                if message["type"] == "http.response.start":
+                    root.set_attribute("status_code", message["status"])
+                    message = {**message, "headers": [*message.get("headers", []),
+                                                      (b"x-request-id", root.trace_id.encode("latin-1"))]}
+                await send(message)
+
+            await self.app(scope, receive, send_with_request_id)
+
+def new_request_id() -> str:
+    return secrets.token_hex(16)
+
+def create_exporter():
+    """Create the span exporter configured by TRACING_EXPORTER"""
+    if Config.TRACING_EXPORTER == "memory":
+        return InMemorySpanExporter()
+    if Config.TRACING_EXPORTER == "file":
+        return FileSpanExporter()
+    if Config.TRACING_EXPORTER != "none":
+        logger.warning(f"Unknown TRACING_EXPORTER '{Config.TRACING_EXPORTER}', spans will not be exported")
+    return None
+
+# Global instance
+tracer = Tracer(create_exporter())
@@ -0,0 +1,176 @@
+"""
+LLM Usage Accounting for ShifaAI
+Token, latency and cost totals per category, endpoint, model and user
+"""
+import asyncio
+import json
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Dict, Iterator, Optional
+
+from .utils import logger, Config
+
+DIMENSIONS = ("category", "endpoint", "model", "user")
+
+class RequestUsage:
+    """LLM usage attributed to one request"""
+
+    __slots__ = ("endpoint", "user_id", "calls", "prompt_tokens", "completion_tokens", "latency_seconds", "cost")
+
+    def __init__(self, endpoint: str, user_id: Optional[str]):
+        self.endpoint = endpoint
+        self.user_id = user_id
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency_seconds = 0.0
+        self.cost = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency_ms": round(self.latency_seconds * 1000, 1),
+            "cost_usd": round(self.cost, 6)
+        }
+
+# Endpoint and user the current request's LLM calls are charged to
+_attribution: ContextVar[Optional[RequestUsage]] = ContextVar("usage_attribution", default=None)
+
+class UsageAccountant:
+    """Aggregates LLM calls in memory and periodically appends them to a JSON Lines store
+
+    Every call is added to running totals (for /admin/stats) and to a pending
+    batch; ``flush()`` appends the pending batch as one line of raw sums, so
+    adding up the store's lines gives the all-time totals. Users beyond
+    ``max_users`` are folded into an ``other`` bucket to keep memory bounded.
+    """
+
+    def __init__(self, store_path: str = Config.USAGE_STORE_FILE, flush_interval: float = Config.USAGE_FLUSH_SECONDS,
+                 max_users: int = Config.USAGE_MAX_USERS, prices: Optional[Dict[str, Any]] = None):
+        self.store_path = store_path
+        self.flush_interval = flush_interval
+        self.max_users = max_users
+        self.prices = prices if prices is not None else Config.LLM_PRICES_PER_1K
+        self._totals = self._new_aggregates()
+        self._pending = self._new_aggregates()
+        self._pending_since = datetime.now().isoformat()
+        self._lock = threading.Lock()
+        self._stats = {"flushes": 0, "flush_errors": 0, "estimated_calls": 0}
+
+    @contextmanager
+    def attribute(self, endpoint: str, user_id: Optional[str] = None) -> Iterator[RequestUsage]:
+        """Charge LLM calls made inside the block to an endpoint and user"""
+        request_usage = RequestUsage(endpoint, user_id)
+        token = _attribution.set(request_usage)
+        try:
+            yield request_usage
+        finally:
+            _attribution.reset(token)
+
+    def cost(self, model: str, prompt_tokens: int, completion_tokens: int) -> float:
+        """Estimated USD cost of a call; models without a price cost 0"""
+        price = self.prices.get(model)
+        if price is None:
+            # Dated model snapshots ("gpt-4o-2024-08-06") use their base model's price
+            matches = [name for name in self.prices if model.startswith(name + "-")]
+            price = self.prices[max(matches, key=len)] if matches else (0.0, 0.0)
+        return (prompt_tokens * price[0] + completion_tokens * price[1]) / 1000
+
+    def record(self, model: str, category: str, prompt_tokens: int, completion_tokens: int, seconds: float,
+               estimated: bool = False):
+        """Record one LLM call against the current request's endpoint and user"""
+        request_usage = _attribution.get()
+        endpoint = request_usage.endpoint if request_usage else "internal"
+        user = (request_usage.user_id if request_usage else None) or "anonymous"
+        cost = self.cost(model, prompt_tokens, completion_tokens)
+        keys = {"category": category, "endpoint": endpoint, "model": model, "user": user}
+
+        with self._lock:
+            for aggregates in (self._totals, self._pending):
+                for dimension, key in keys.items():
+                    table = aggregates[dimension]
+                    if dimension == "user" and key not in table and len(table) >= self.max_users:
+                        key = "other"
+                    totals = table.setdefault(key, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                                    "latency_seconds": 0.0, "cost": 0.0})
+                    totals["calls"] += 1
+                    totals["prompt_tokens"] += prompt_tokens
+                    totals["completion_tokens"] += completion_tokens
+                    totals["latency_seconds"] += seconds
+                    totals["cost"] += cost
+            if estimated:
+                self._stats["estimated_calls"] += 1
+
+        if request_usage is not None:
+            request_usage.calls += 1
+            request_usage.prompt_tokens += prompt_tokens
+            request_usage.completion_tokens += completion_tokens
+            request_usage.latency_seconds += seconds
+            request_usage.cost += cost
+
+    def flush(self) -> int:
+        """Append the usage recorded since the last flush to the store; returns the calls written"""
+        with self._lock:
+            pending, self._pending = self._pending, self._new_aggregates()
+            since, self._pending_since = self._pending_since, datetime.now().isoformat()
+
+        calls = sum(totals["calls"] for totals in pending["model"].values())
+        if not calls:
+            return 0
+        line = json.dumps({
+            "period_start": since,
+            "period_end": self._pending_since,
+            **{dimension: {key: {**totals, "latency_seconds": round(totals["latency_seconds"], 4),
+                                 "cost": round(totals["cost"], 8)}
+                           for key, totals in pending[dimension].items()}
+               for dimension in DIMENSIONS}
+        })
+        try:
+            with open(self.store_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            self._stats["flush_errors"] += 1
+            logger.error(f"Failed to flush LLM usage to {self.store_path}: {str(e)}")
+            return 0
+        self._stats["flushes"] += 1
+        return calls
+
+    async def run_periodic_flush(self):
+        """Flush the pending usage every ``flush_interval`` seconds (runs until cancelled)"""
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await asyncio.to_thread(self.flush)
+
+    def get_stats(self, top_users: int = Config.USAGE_TOP_USERS) -> Dict[str, Any]:
+        """Usage totals per category, endpoint and model, plus the most expensive users"""
+        with self._lock:
+            users = sorted(self._totals["user"].items(), key=lambda item: item[1]["cost"], reverse=True)
+            return {
+                "store": self.store_path,
+                **self._stats,
+                "by_category": {key: _rounded(totals) for key, totals in self._totals["category"].items()},
+                "by_endpoint": {key: _rounded(totals) for key, totals in self._totals["endpoint"].items()},
+                "by_model": {key: _rounded(totals) for key, totals in self._totals["model"].items()},
+                "tracked_users": len(self._totals["user"]),
+                "top_users": {key: _rounded(totals) for key, totals in users[:top_users]}
+            }
+
+    @staticmethod
+    def _new_aggregates() -> Dict[str, Dict[str, Dict[str, Any]]]:
+        return {dimension: {} for dimension in DIMENSIONS}
+
+def _rounded(totals: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "calls": totals["calls"],
+        "prompt_tokens": totals["prompt_tokens"],
+        "completion_tokens": totals["completion_tokens"],
+        "avg_latency_ms": round(totals["latency_seconds"] / totals["calls"] * 1000, 1) if totals["calls"] else 0.0,
+        "cost_usd": round(totals["cost"], 6)
+    }
+
+# Global instance
+usage_accountant = UsageAccountant()
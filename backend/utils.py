@@ -2,8 +2,14 @@
 Utility functions and configurations for ShifaAI
 """
 import os
+import base64
+import hashlib
+import hmac
+import json
 import logging
 import re
+import secrets
+from contextvars import ContextVar
 from typing import Dict, List, Optional, Any
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
@@ -18,6 +24,163 @@ class Config:
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
     MAX_RESPONSE_LENGTH = int(os.getenv("MAX_RESPONSE_LENGTH", "2000"))
     
+    # Production launcher (python -m backend.server): forked worker processes (0 = one per CPU);
+    # admin changes, conversation memory and traces stay per worker (see SETUP.md)
+    SERVER_WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
+    SERVER_RESTART_DELAY = float(os.getenv("SERVER_RESTART_DELAY", "1"))
+    
+    # Server-side conversation memory
+    CONVERSATION_MAX_SESSIONS = int(os.getenv("CONVERSATION_MAX_SESSIONS", "10000"))
+    CONVERSATION_TTL_SECONDS = int(os.getenv("CONVERSATION_TTL_SECONDS", "1800"))
+    CONVERSATION_TOKEN_BUDGET = int(os.getenv("CONVERSATION_TOKEN_BUDGET", "600"))
+    CONVERSATION_SUMMARY_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "150"))
+    CONVERSATION_MAX_TOTAL_TOKENS = int(os.getenv("CONVERSATION_MAX_TOTAL_TOKENS", "2000000"))
+    
+    # Admission control: per-client token buckets and per-class concurrency caps
+    ADMISSION_MAX_BUCKETS = int(os.getenv("ADMISSION_MAX_BUCKETS", "50000"))
+    ADMISSION_LLM_RATE_PER_SECOND = float(os.getenv("ADMISSION_LLM_RATE_PER_SECOND", "0.5"))
+    ADMISSION_LLM_BURST = int(os.getenv("ADMISSION_LLM_BURST", "5"))
+    ADMISSION_LLM_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_LLM_MAX_IN_FLIGHT", "16"))
+    ADMISSION_LLM_MAX_QUEUE = int(os.getenv("ADMISSION_LLM_MAX_QUEUE", "32"))
+    ADMISSION_LLM_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_LLM_QUEUE_TIMEOUT", "5"))
+    ADMISSION_CATALOG_RATE_PER_SECOND = float(os.getenv("ADMISSION_CATALOG_RATE_PER_SECOND", "20"))
+    ADMISSION_CATALOG_BURST = int(os.getenv("ADMISSION_CATALOG_BURST", "40"))
+    ADMISSION_CATALOG_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_CATALOG_MAX_IN_FLIGHT", "256"))
+    ADMISSION_CATALOG_MAX_QUEUE = int(os.getenv("ADMISSION_CATALOG_MAX_QUEUE", "512"))
+    ADMISSION_CATALOG_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_CATALOG_QUEUE_TIMEOUT", "1"))
+    
+    # Two-tier cache: per-process L1, shared L2 ("local" or "redis")
+    CACHE_BACKEND = os.getenv("CACHE_BACKEND", "local").lower()
+    CACHE_L1_MAX_ENTRIES = int(os.getenv("CACHE_L1_MAX_ENTRIES", "2048"))
+    CACHE_L1_TTL_SECONDS = int(os.getenv("CACHE_L1_TTL_SECONDS", "300"))
+    CACHE_LOCAL_MAX_ENTRIES = int(os.getenv("CACHE_LOCAL_MAX_ENTRIES", "20000"))
+    CACHE_L2_TTL_SECONDS = int(os.getenv("CACHE_L2_TTL_SECONDS", "86400"))
+    CACHE_VERSION_CHECK_SECONDS = float(os.getenv("CACHE_VERSION_CHECK_SECONDS", "1"))
+    
+    # Upstream LLM calls: per-request deadline and hedging of calls slower than the rolling p95
+    REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", "30"))
+    LLM_HEDGING_ENABLED = os.getenv("LLM_HEDGING_ENABLED", "True").lower() == "true"
+    LLM_HEDGE_BUDGET = float(os.getenv("LLM_HEDGE_BUDGET", "0.05"))
+    LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0.95"))
+    LLM_HEDGE_INITIAL_DELAY = float(os.getenv("LLM_HEDGE_INITIAL_DELAY", "8"))
+    LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.5"))
+    LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+    LLM_LATENCY_MIN_SAMPLES = int(os.getenv("LLM_LATENCY_MIN_SAMPLES", "20"))
+    
+    # Per-category LLM routing: simple categories go to a faster, cheaper model
+    LLM_FAST_MODEL = os.getenv("LLM_FAST_MODEL", "gpt-4o-mini")
+    LLM_FAST_CATEGORIES = [c.strip() for c in os.getenv("LLM_FAST_CATEGORIES", "general_health,lifestyle").split(",")
+                           if c.strip()]
+    LLM_ROUTE_STATS_WINDOW = int(os.getenv("LLM_ROUTE_STATS_WINDOW", "500"))
+    
+    # LLM token usage and cost accounting (prices in USD per 1K prompt and completion tokens)
+    USAGE_STORE_FILE = os.getenv("USAGE_STORE_FILE", "usage.jsonl")
+    USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "60"))
+    USAGE_MAX_USERS = int(os.getenv("USAGE_MAX_USERS", "10000"))
+    USAGE_TOP_USERS = int(os.getenv("USAGE_TOP_USERS", "20"))
+    LLM_PRICES_PER_1K = json.loads(os.getenv(
+        "LLM_PRICES_PER_1K",
+        '{"gpt-4o": [0.0025, 0.01], "gpt-4o-mini": [0.00015, 0.0006], "gpt-4": [0.03, 0.06]}'
+    ))
+    
+    # Offline response cache warming (python -m backend.warmup); the answer store is loaded at startup
+    WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "4"))
+    WARMUP_RATE_PER_SECOND = float(os.getenv("WARMUP_RATE_PER_SECOND", "2"))
+    WARMUP_ANSWERS_FILE = os.getenv("WARMUP_ANSWERS_FILE", "")
+    
+    # Speculative prefetch of follow-up answers after /ask, only while LLM routes are idle
+    PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "True").lower() == "true"
+    PREFETCH_RATE_PER_MINUTE = float(os.getenv("PREFETCH_RATE_PER_MINUTE", "6"))
+    PREFETCH_BURST = int(os.getenv("PREFETCH_BURST", "3"))
+    PREFETCH_MAX_PER_REQUEST = int(os.getenv("PREFETCH_MAX_PER_REQUEST", "3"))
+    PREFETCH_TIMEOUT_SECONDS = float(os.getenv("PREFETCH_TIMEOUT_SECONDS", "60"))
+    PREFETCH_IDLE_MAX_IN_FLIGHT = int(os.getenv("PREFETCH_IDLE_MAX_IN_FLIGHT", "2"))
+    PREFETCH_MAX_CONCURRENT = int(os.getenv("PREFETCH_MAX_CONCURRENT", "1"))
+    
+    # Append-only query log of /ask traffic (off unless QUERY_LOG_FILE is set), rotated by size
+    QUERY_LOG_FILE = os.getenv("QUERY_LOG_FILE", "")
+    QUERY_LOG_BATCH_SIZE = int(os.getenv("QUERY_LOG_BATCH_SIZE", "100"))
+    QUERY_LOG_FLUSH_SECONDS = float(os.getenv("QUERY_LOG_FLUSH_SECONDS", "2"))
+    QUERY_LOG_MAX_BYTES = int(os.getenv("QUERY_LOG_MAX_BYTES", str(100 * 1024 * 1024)))
+    QUERY_LOG_BACKUPS = int(os.getenv("QUERY_LOG_BACKUPS", "5"))
+    QUERY_LOG_MAX_BUFFERED = int(os.getenv("QUERY_LOG_MAX_BUFFERED", "10000"))
+    
+    # Keyword text index: built across processes for large corpora and cached on disk ("" disables the cache)
+    INDEX_BUILD_WORKERS = int(os.getenv("INDEX_BUILD_WORKERS", "0"))  # 0 = one per CPU
+    INDEX_PARALLEL_MIN_DOCS = int(os.getenv("INDEX_PARALLEL_MIN_DOCS", "20000"))
+    INDEX_SHARD_SIZE = int(os.getenv("INDEX_SHARD_SIZE", "5000"))
+    INDEX_CACHE_DIR = os.getenv("INDEX_CACHE_DIR", ".index_cache")
+    
+    # Category shards: threads that search shards concurrently when no category is given (0 searches them in turn)
+    KB_SEARCH_THREADS = int(os.getenv("KB_SEARCH_THREADS", "0"))
+    
+    # Dense (vector) retrieval over the knowledge base
+    DENSE_DIMENSIONS = int(os.getenv("DENSE_DIMENSIONS", "256"))
+    DENSE_IVF_MIN_DOCS = int(os.getenv("DENSE_IVF_MIN_DOCS", "20000"))
+    DENSE_IVF_NPROBE = int(os.getenv("DENSE_IVF_NPROBE", "8"))
+    DENSE_MIN_SCORE = float(os.getenv("DENSE_MIN_SCORE", "0.1"))
+    
+    # Serve knowledge base answers directly when the best match clears the threshold (off unless enabled).
+    # Keyword mode scores the word overlap of the questions; dense mode needs a corpus large enough for the SVD
+    KB_SHORT_CIRCUIT_ENABLED = os.getenv("KB_SHORT_CIRCUIT_ENABLED", "False").lower() == "true"
+    KB_SHORT_CIRCUIT_MODE = os.getenv("KB_SHORT_CIRCUIT_MODE", "keyword")
+    KB_SHORT_CIRCUIT_THRESHOLD = float(os.getenv("KB_SHORT_CIRCUIT_THRESHOLD", "0.85"))
+    KB_SHORT_CIRCUIT_DENSE_MIN_DOCS = int(os.getenv("KB_SHORT_CIRCUIT_DENSE_MIN_DOCS", "1000"))
+    KB_SHORT_CIRCUIT_DENSE_MIN_DIMENSIONS = int(os.getenv("KB_SHORT_CIRCUIT_DENSE_MIN_DIMENSIONS", "64"))
+    
+    # Retrieval-augmented prompting: top-k passages within a token budget
+    RAG_ENABLED = os.getenv("RAG_ENABLED", "True").lower() == "true"
+    RAG_SEARCH_MODE = os.getenv("RAG_SEARCH_MODE", "dense")
+    RAG_TOP_K = int(os.getenv("RAG_TOP_K", "3"))
+    RAG_MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", "0.3"))
+    RAG_CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "400"))
+    RAG_BASE_COMPLETION_TOKENS = int(os.getenv("RAG_BASE_COMPLETION_TOKENS", "250"))
+    
+    # Typo-tolerant search: correct words not in the knowledge base vocabulary
+    SPELLING_CORRECTION_ENABLED = os.getenv("SPELLING_CORRECTION_ENABLED", "True").lower() == "true"
+    SPELLING_MAX_DISTANCE = int(os.getenv("SPELLING_MAX_DISTANCE", "2"))
+    SPELLING_MIN_WORD_LENGTH = int(os.getenv("SPELLING_MIN_WORD_LENGTH", "5"))
+    
+    # Question autocomplete
+    SUGGEST_MIN_PREFIX = int(os.getenv("SUGGEST_MIN_PREFIX", "2"))
+    SUGGEST_MAX_LIMIT = int(os.getenv("SUGGEST_MAX_LIMIT", "20"))
+    SUGGEST_MAX_SCAN = int(os.getenv("SUGGEST_MAX_SCAN", "500"))
+    SUGGEST_KEY_CHARS = int(os.getenv("SUGGEST_KEY_CHARS", "48"))
+    SUGGEST_CACHE_TTL = float(os.getenv("SUGGEST_CACHE_TTL", "30"))
+    
+    # Versioned LRU cache of knowledge base search results (0 disables it)
+    SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1024"))
+    
+    # Knowledge base search pagination and export
+    KNOWLEDGE_SEARCH_MAX_LIMIT = int(os.getenv("KNOWLEDGE_SEARCH_MAX_LIMIT", "50"))
+    KNOWLEDGE_EXPORT_CHUNK_SIZE = int(os.getenv("KNOWLEDGE_EXPORT_CHUNK_SIZE", "500"))
+    KNOWLEDGE_SEARCH_MAX_OFFSET = int(os.getenv("KNOWLEDGE_SEARCH_MAX_OFFSET", "1000"))
+    # Signs pagination cursors; the random default is shared by forked workers but changes on restart
+    CURSOR_SECRET = os.getenv("CURSOR_SECRET", "") or secrets.token_hex(32)
+    
+    # Admin endpoints that change the knowledge base (sent as X-Admin-Token; they refuse every request when unset)
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+    
+    # Bulk NDJSON ingestion into the knowledge base
+    INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "500"))
+    INGEST_MAX_BATCH_SIZE = int(os.getenv("INGEST_MAX_BATCH_SIZE", "5000"))
+    INGEST_MAX_LINE_BYTES = int(os.getenv("INGEST_MAX_LINE_BYTES", "65536"))
+    
+    # On-demand request profiling (disabled unless an admin token is configured)
+    PROFILING_ADMIN_TOKEN = os.getenv("PROFILING_ADMIN_TOKEN", "")
+    PROFILING_OUTPUT_DIR = os.getenv("PROFILING_OUTPUT_DIR", "profiles")
+    PROFILING_MODE = os.getenv("PROFILING_MODE", "cprofile")
+    PROFILING_SAMPLE_INTERVAL = float(os.getenv("PROFILING_SAMPLE_INTERVAL", "0.002"))
+    
+    # Request tracing: span exporter ("none", "memory" or "file")
+    TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "memory").lower()
+    TRACING_FILE = os.getenv("TRACING_FILE", "traces.jsonl")
+    TRACING_MEMORY_SPANS = int(os.getenv("TRACING_MEMORY_SPANS", "5000"))
+    # The file exporter buffers spans and appends them from a background thread
+    TRACING_BATCH_SIZE = int(os.getenv("TRACING_BATCH_SIZE", "500"))
+    TRACING_FLUSH_SECONDS = float(os.getenv("TRACING_FLUSH_SECONDS", "2"))
+    TRACING_MAX_BUFFERED = int(os.getenv("TRACING_MAX_BUFFERED", "50000"))
+    
     # Medical sources for scraping
     MEDICAL_SOURCES = [
         "https://www.mayoclinic.org",
@@ -44,15 +207,32 @@ class Settings(BaseSettings):
 
 settings = Settings()
 
+# ID of the request being handled, set at ingress and inherited by tasks and threads it starts
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+def get_request_id() -> Optional[str]:
+    """Get the ID of the request being handled, if any"""
+    return request_id_var.get()
+
+class RequestIdFilter(logging.Filter):
+    """Stamp log records with the current request ID for cross-module correlation"""
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get() or "-"
+        return True
+
 def setup_logging():
     """Configure logging for the application"""
+    handlers = [
+        logging.FileHandler('shifa_ai.log'),
+        logging.StreamHandler()
+    ]
+    for handler in handlers:
+        handler.addFilter(RequestIdFilter())
     logging.basicConfig(
         level=getattr(logging, Config.LOG_LEVEL.upper()),
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            logging.FileHandler('shifa_ai.log'),
-            logging.StreamHandler()
-        ]
+        format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s',
+        handlers=handlers
     )
     return logging.getLogger(__name__)
 
@@ -71,18 +251,55 @@ def clean_text(text: str) -> str:
     
     return text
 
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the number of LLM tokens in text (~4 characters per token)"""
+    if not text:
+        return 0
+    return max(1, len(text) // 4)
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Trim text to an estimated token budget, cutting at a word boundary"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    cut = text[:max(0, max_tokens * 4)]
+    if " " in cut:
+        cut = cut.rsplit(" ", 1)[0]
+    return cut.rstrip(" ,;:") + "..."
+
+def _cursor_signature(body: str) -> str:
+    digest = hmac.new(Config.CURSOR_SECRET.encode("utf-8"), body.encode("ascii"), hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(digest).decode("ascii").rstrip("=")
+
+def encode_cursor(payload: Dict[str, Any]) -> str:
+    """Encode pagination state as an opaque URL-safe cursor, signed with CURSOR_SECRET"""
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    body = base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+    return f"{body}.{_cursor_signature(body)}"
+
+def decode_cursor(cursor: str) -> Optional[Dict[str, Any]]:
+    """Decode a cursor from encode_cursor; returns None if it is malformed or its signature does not match"""
+    body, _, signature = cursor.partition(".")
+    if not hmac.compare_digest(signature.encode("ascii", "replace"), _cursor_signature(body).encode("ascii")):
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))
+        payload = json.loads(raw)
+    except ValueError:
+        return None
+    return payload if isinstance(payload, dict) else None
+
+MEDICAL_KEYWORDS = [
+    'pain', 'ache', 'fever', 'headache', 'nausea', 'vomiting', 'diarrhea',
+    'constipation', 'fatigue', 'tired', 'dizzy', 'breath', 'cough', 'cold',
+    'flu', 'infection', 'diabetes', 'blood pressure', 'heart', 'chest',
+    'stomach', 'back', 'joint', 'muscle', 'skin', 'rash', 'allergy',
+    'anxiety', 'depression', 'stress', 'sleep', 'insomnia'
+]
+
 def extract_keywords(text: str) -> List[str]:
     """Extract medical keywords from text"""
-    medical_keywords = [
-        'pain', 'ache', 'fever', 'headache', 'nausea', 'vomiting', 'diarrhea',
-        'constipation', 'fatigue', 'tired', 'dizzy', 'breath', 'cough', 'cold',
-        'flu', 'infection', 'diabetes', 'blood pressure', 'heart', 'chest',
-        'stomach', 'back', 'joint', 'muscle', 'skin', 'rash', 'allergy',
-        'anxiety', 'depression', 'stress', 'sleep', 'insomnia'
-    ]
-    
     text_lower = text.lower()
-    found_keywords = [keyword for keyword in medical_keywords if keyword in text_lower]
+    found_keywords = [keyword for keyword in MEDICAL_KEYWORDS if keyword in text_lower]
     
     return found_keywords
 
@@ -148,6 +365,11 @@ def categorize_medical_query(query: str) -> str:
     
     return "general"
 
+def is_emergency_query(query: str) -> bool:
+    """Check whether a query mentions emergency warning signs"""
+    query_lower = query.lower()
+    return any(keyword in query_lower for keyword in MEDICAL_CATEGORIES["emergency"])
+
 def categorize_question(text: str) -> str:
     """Categorize medical question type"""
     text_lower = text.lower()
@@ -0,0 +1,157 @@
+"""
+Response Cache Warming for ShifaAI
+Pre-generates answers for known questions so deploys start with a warm cache
+
+Usage:
+    CACHE_BACKEND=redis python -m backend.warmup                # every FAQ question, into the shared Redis tier
+    CACHE_BACKEND=redis python -m backend.warmup --query-log queries.jsonl --top 500
+    python -m backend.warmup --output warm_answers.jsonl        # a portable answer store (WARMUP_ANSWERS_FILE)
+
+Without Redis the cache only lives in this process, so --output is required.
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional
+
+from .utils import logger, Config, is_emergency_query
+from .admission import TokenBucket
+from .cache import response_cache, shared_backend, RedisBackend, TieredCache
+from .usage import usage_accountant
+
+def load_faq_questions(path: str = "medical_faqs.json") -> List[str]:
+    """Questions of a FAQ file in the knowledge base format"""
+    with open(path, "r", encoding="utf-8") as f:
+        return [faq["question"] for faq in json.load(f) if faq.get("question")]
+
+def load_query_log(path: str, top: Optional[int] = None) -> List[str]:
+    """Most frequent questions of a query log, most frequent first
+
+    Each line is either a JSON object with a ``question`` field or plain text.
+    """
+    counts: Counter = Counter()
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = line
+            question = record.get("question") if isinstance(record, dict) else record
+            if isinstance(question, str) and question.strip():
+                counts[question.strip()] += 1
+    return [question for question, _ in counts.most_common(top)]
+
+def load_answer_store(path: str, cache: TieredCache = response_cache) -> int:
+    """Load a warmed answer store into the response cache; returns the answers loaded"""
+    loaded = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                cache.set(entry["key"], entry["response"])
+                loaded += 1
+    return loaded
+
+class CacheWarmer:
+    """Generates answers through the GPT router and stores them in the response cache
+
+    At most ``concurrency`` LLM calls are in flight and new calls start at no
+    more than ``rate_per_second``. Questions that are already cached, that get
+    the emergency response, or that the knowledge base answers directly are
+    skipped since the app never asks the LLM for them.
+    """
+
+    def __init__(self, router, cache: TieredCache = response_cache, concurrency: int = Config.WARMUP_CONCURRENCY,
+                 rate_per_second: float = Config.WARMUP_RATE_PER_SECOND, force: bool = False):
+        self.router = router
+        self.cache = cache
+        self.concurrency = concurrency
+        self.force = force
+        self._bucket = TokenBucket(rate_per_second, 1)
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.answers: List[Dict[str, Any]] = []
+        self.stats = {"questions": 0, "generated": 0, "already_cached": 0, "skipped": 0, "failed": 0}
+
+    async def warm(self, questions: Iterable[str]) -> Dict[str, Any]:
+        """Warm the cache for distinct questions; returns a report"""
+        questions = list(dict.fromkeys(question.strip() for question in questions if question.strip()))
+        self.stats["questions"] = len(questions)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        start = time.perf_counter()
+
+        with usage_accountant.attribute("warmup"):
+            await asyncio.gather(*(self._warm_one(question) for question in questions))
+
+        seconds = time.perf_counter() - start
+        logger.info(f"Warmed {self.stats['generated']} answers for {len(questions)} questions in {seconds:.1f}s")
+        return {**self.stats, "seconds": round(seconds, 2)}
+
+    async def _warm_one(self, question: str):
+        key = self.cache.make_key("medical_response", question)
+        if not self.force and await self.cache.aget(key) is not None:
+            self.stats["already_cached"] += 1
+            return
+        if is_emergency_query(question) or self.router.answer_from_knowledge_base(question, record_stats=False) is not None:
+            self.stats["skipped"] += 1
+            return
+
+        async with self._semaphore:
+            wait = self._bucket.consume()
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self._bucket.consume()
+            response = await self.router.generate_medical_response(question)
+
+        if response["category"] == "error":
+            self.stats["failed"] += 1
+            return
+        await self.cache.aset(key, response)
+        self.answers.append({"key": key, "question": question, "response": response})
+        self.stats["generated"] += 1
+
+    def save_answers(self, path: str):
+        """Write generated answers as a JSON Lines store for ``load_answer_store``"""
+        with open(path, "w", encoding="utf-8") as f:
+            for answer in self.answers:
+                f.write(json.dumps(answer) + "\n")
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Pre-generate answers for known questions into the response cache")
+    parser.add_argument("--faqs", default="medical_faqs.json", help="FAQ file whose questions are warmed")
+    parser.add_argument("--no-faqs", action="store_true", help="only warm questions from the query log")
+    parser.add_argument("--query-log", help="query log (JSON Lines with a 'question' field, or plain text lines)")
+    parser.add_argument("--top", type=int, default=500, help="most frequent query log questions to warm")
+    parser.add_argument("--concurrency", type=int, default=Config.WARMUP_CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=Config.WARMUP_RATE_PER_SECOND, help="LLM calls started per second")
+    parser.add_argument("--force", action="store_true", help="regenerate answers that are already cached")
+    parser.add_argument("--output", help="also write the answers to a JSON Lines store (see WARMUP_ANSWERS_FILE)")
+    args = parser.parse_args(argv)
+    if not isinstance(shared_backend, RedisBackend) and not args.output:
+        parser.error("the response cache is local to this process and is discarded when it exits; "
+                     "use CACHE_BACKEND=redis (with a reachable REDIS_URL) or pass --output")
+
+    # Imported here so loading the answer store at app startup does not pull in the router
+    from .scraper import initialize_knowledge_base
+    from .gpt_router import gpt_router
+    initialize_knowledge_base()
+
+    questions: List[str] = []
+    if args.query_log:
+        questions.extend(load_query_log(args.query_log, args.top))
+    if not args.no_faqs:
+        questions.extend(load_faq_questions(args.faqs))
+
+    warmer = CacheWarmer(gpt_router, concurrency=args.concurrency, rate_per_second=args.rate, force=args.force)
+    report = asyncio.run(warmer.warm(questions))
+    if args.output:
+        warmer.save_answers(args.output)
+    usage_accountant.flush()
+    print(json.dumps(report, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+ShifaAI Backend Micro-benchmarks
+Times the backend hot paths and saves results as JSON for run-to-run comparison
+
+Usage:
+    python benchmarks/bench_backend.py                      # full run
+    python benchmarks/bench_backend.py --quick              # smaller corpora, fewer iterations
+    python benchmarks/bench_backend.py --only search_faqs   # run matching benchmarks only
+    python benchmarks/bench_backend.py --compare benchmarks/results/baseline.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+from unittest.mock import MagicMock, patch
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, REPO_ROOT)
+
+from backend.cbt import CBTEngine
+from backend.indexing import build_text_index, load_cached_indexes, save_cached_indexes
+from backend.scraper import MedicalKnowledgeBase
+from backend.shifa import get_shifa_guidance
+from backend.utils import categorize_question, extract_keywords
+
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+
+# Realistic user questions of increasing length
+QUERIES = {
+    "short": "diabetes symptoms",
+    "medium": "I've had a headache and a mild fever for two days, should I be worried?",
+    "long": (
+        "For the past few weeks I have been feeling very tired and stressed at work, I can't sleep "
+        "well at night, I wake up with back pain and a stiff neck, and lately I get dizzy when I stand "
+        "up quickly. I also have high blood pressure in my family. What lifestyle changes or diet "
+        "adjustments would you recommend, and when should I see a doctor about these symptoms?"
+    )
+}
+
+TOPICS = [
+    ("diabetes", "chronic_condition"), ("blood pressure", "chronic_condition"),
+    ("anxiety", "mental_health"), ("depression", "mental_health"), ("insomnia", "general_health"),
+    ("headache", "pain_management"), ("back pain", "pain_management"), ("flu", "acute_illness"),
+    ("cough", "acute_illness"), ("weight loss", "lifestyle"), ("nutrition", "lifestyle"),
+    ("allergy", "general_health")
+]
+TEMPLATES = [
+    "What are the symptoms of {topic}?",
+    "How can I manage {topic} naturally?",
+    "When should I see a doctor about {topic}?",
+    "What causes {topic} in adults?",
+    "Can diet and exercise help with {topic}?"
+]
+FILLER = (
+    "Evidence-based guidance includes regular physical activity, balanced nutrition, adequate sleep, "
+    "stress management and follow-up with a healthcare provider when symptoms persist or worsen."
+).split()
+
+def make_synthetic_faqs(count: int, seed: int = 7) -> List[Dict[str, str]]:
+    """Generate a reproducible synthetic FAQ corpus shaped like medical_faqs.json"""
+    rng = random.Random(seed)
+    faqs = []
+    for i in range(count):
+        topic, category = TOPICS[i % len(TOPICS)]
+        answer_words = rng.sample(FILLER, k=len(FILLER) // 2)
+        faqs.append({
+            "question": rng.choice(TEMPLATES).format(topic=topic) + f" (variant {i})",
+            "answer": f"{topic.capitalize()} guidance: " + " ".join(answer_words),
+            "source": "Synthetic",
+            "category": category
+        })
+    return faqs
+
+def measure(func: Callable[[], Any], iterations: int, warmup: int = 3) -> Dict[str, float]:
+    """Time ``func`` and summarize per-call latency in microseconds"""
+    for _ in range(warmup):
+        func()
+
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1e6)
+
+    samples.sort()
+    mean = statistics.fmean(samples)
+    return {
+        "iterations": iterations,
+        "mean_us": round(mean, 3),
+        "median_us": round(statistics.median(samples), 3),
+        "p95_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        "min_us": round(samples[0], 3),
+        "ops_per_sec": round(1e6 / mean, 1) if mean else 0.0
+    }
+
+class BenchmarkRunner:
+    """Collects benchmark results with their parameters"""
+
+    def __init__(self, quick: bool = False, only: Optional[str] = None):
+        self.quick = quick
+        self.only = only
+        self.results: List[Dict[str, Any]] = []
+
+    def iterations(self, full: int) -> int:
+        return max(5, full // 10) if self.quick else full
+
+    def wants(self, name: str) -> bool:
+        return not self.only or self.only in name
+
+    def run(self, name: str, func: Callable[[], Any], iterations: int, warmup: int = 3, **params):
+        if not self.wants(name):
+            return
+        stats = measure(func, self.iterations(iterations), warmup)
+        self.results.append({"name": name, "params": params, **stats})
+        label = ", ".join(f"{k}={v}" for k, v in params.items())
+        print(f"{name:<32} {label:<28} mean={stats['mean_us']:>12.1f}us  p95={stats['p95_us']:>12.1f}us")
+
+def bench_search_faqs(runner: BenchmarkRunner):
+    if not runner.wants("search_faqs.keyword"):
+        return
+    sizes = [1_000, 10_000] if runner.quick else [1_000, 10_000, 100_000]
+    for size in sizes:
+        # The result cache is off so every iteration scores the corpus
+        kb = MedicalKnowledgeBase(search_cache_entries=0)
+        kb.set_faqs(make_synthetic_faqs(size))
+        cached_kb = MedicalKnowledgeBase()
+        cached_kb.set_faqs(kb.faqs)
+        threaded_kb = MedicalKnowledgeBase(search_cache_entries=0, search_threads=4)
+        threaded_kb.set_faqs(kb.faqs)
+        iterations = max(5, 2_000_000 // (size * 10))
+        for query_name in ("short", "medium"):
+            query = QUERIES[query_name]
+            runner.run("search_faqs.keyword", lambda: kb.search_faqs(query), iterations,
+                       corpus=size, query=query_name)
+            runner.run("search_faqs.keyword_category", lambda: kb.search_faqs(query, category="lifestyle"),
+                       iterations, corpus=size, query=query_name)
+            runner.run("search_faqs.keyword_threads", lambda: threaded_kb.search_faqs(query), iterations,
+                       corpus=size, query=query_name, shards=len(threaded_kb.shards))
+            runner.run("search_faqs.keyword_cached", lambda: cached_kb.search_faqs(query), 20_000,
+                       corpus=size, query=query_name)
+
+def bench_search_faqs_dense(runner: BenchmarkRunner):
+    if not runner.wants("search_faqs.dense"):
+        return
+    sizes = [1_000, 10_000] if runner.quick else [1_000, 10_000, 100_000]
+    for size in sizes:
+        kb = MedicalKnowledgeBase(search_cache_entries=0)
+        kb.set_faqs(make_synthetic_faqs(size))
+        start = time.perf_counter()
+        if kb.get_dense_index() is None:
+            print("search_faqs.dense skipped (numpy/scikit-learn not installed)")
+            return
+        build_seconds = round(time.perf_counter() - start, 3)
+        for query_name in ("short", "medium"):
+            query = QUERIES[query_name]
+            runner.run("search_faqs.dense", lambda: kb.search_faqs(query, mode="dense"), 200,
+                       corpus=size, query=query_name, build_seconds=build_seconds)
+
+def bench_text_index_build(runner: BenchmarkRunner):
+    """Text index build time as worker processes are added, and the disk cache load that replaces it"""
+    if not runner.wants("text_index"):
+        return
+    import tempfile
+    cpus = os.cpu_count() or 1
+    worker_counts = sorted({1, cpus} | {n for n in (2, 4, 8, 16) if n < cpus})
+    sizes = [20_000] if runner.quick else [20_000, 100_000]
+    for size in sizes:
+        faqs = make_synthetic_faqs(size)
+        for workers in worker_counts:
+            runner.run("text_index.build", lambda: build_text_index(faqs, workers=workers, parallel_min_docs=0),
+                       3, warmup=1, corpus=size, workers=workers)
+        with tempfile.TemporaryDirectory() as cache_dir:
+            save_cached_indexes(cache_dir, "bench", {"": build_text_index(faqs, workers=1)})
+            runner.run("text_index.cache_load", lambda: load_cached_indexes(cache_dir, "bench"), 3, warmup=1,
+                       corpus=size)
+
+def bench_text_utils(runner: BenchmarkRunner):
+    for query_name, query in QUERIES.items():
+        runner.run("extract_keywords", lambda: extract_keywords(query), 20_000, query=query_name)
+        runner.run("categorize_question", lambda: categorize_question(query), 20_000, query=query_name)
+
+def bench_cbt(runner: BenchmarkRunner):
+    cbt = CBTEngine()
+    for symptoms in (["anxiety"], ["stress", "sleep", "worry", "panic"]):
+        runner.run("cbt.recommend_exercise", lambda: cbt.recommend_exercise(symptoms, mood_rating=2), 20_000,
+                   symptoms=len(symptoms))
+    for query_name, query in QUERIES.items():
+        runner.run("cbt.identify_cognitive_distortion", lambda: cbt.identify_cognitive_distortion(query), 20_000,
+                   query=query_name)
+
+def bench_shifa(runner: BenchmarkRunner):
+    loop = asyncio.new_event_loop()
+    try:
+        for query_name in ("short", "medium"):
+            query = QUERIES[query_name]
+            runner.run("shifa.get_shifa_guidance", lambda: loop.run_until_complete(get_shifa_guidance(query)),
+                       5_000, query=query_name)
+    finally:
+        loop.close()
+
+def bench_ask_endpoint(runner: BenchmarkRunner):
+    """Full /ask round trip through the ASGI app with the LLM stubbed out"""
+    if not runner.wants("app.ask"):
+        return
+    from fastapi.testclient import TestClient
+    from backend.app import app
+    from backend.admission import admission_controller
+    from backend.gpt_router import gpt_router
+    from backend.scraper import initialize_knowledge_base
+
+    initialize_knowledge_base()
+
+    completion = MagicMock()
+    completion.choices = [MagicMock()]
+    completion.choices[0].message.content = "Stubbed medical answer. " * 20
+    completion.usage = None
+    llm = admission_controller.endpoint_classes["llm"]
+    counter = {"n": 0}
+
+    def ask(payload_extra: Dict[str, Any]):
+        # Unique questions so the response cache never short-circuits the measured path
+        counter["n"] += 1
+        question = f"{QUERIES['medium']} (case {counter['n']})"
+        response = client.post("/ask", json={"question": question, **payload_extra})
+        assert response.status_code == 200
+
+    with patch.object(gpt_router, "client") as stub_client, \
+            patch.object(llm, "rate_per_second", 1e9), patch.object(llm, "burst", 1e9):
+        stub_client.chat.completions.create.return_value = completion
+        with TestClient(app) as client:
+            runner.run("app.ask", lambda: ask({}), 500, stub_llm=True, extras="none")
+            runner.run("app.ask", lambda: ask({"include_shifa": True}), 500, stub_llm=True, extras="shifa")
+            runner.run("app.ask", lambda: ask({"user_id": "bench-user"}), 500, stub_llm=True, extras="memory")
+
+BENCHMARKS = [
+    bench_search_faqs,
+    bench_search_faqs_dense,
+    bench_text_index_build,
+    bench_text_utils,
+    bench_cbt,
+    bench_shifa,
+    bench_ask_endpoint
+]
+
+def get_metadata(quick: bool) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                                text=True, timeout=5).stdout.strip()
+    except Exception:
+        commit = None
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "quick": quick
+    }
+
+def result_key(result: Dict[str, Any]) -> str:
+    params = {k: v for k, v in result["params"].items() if k != "build_seconds"}
+    return result["name"] + json.dumps(params, sort_keys=True)
+
+def compare(results: List[Dict[str, Any]], baseline_path: str, tolerance: float) -> int:
+    """Print the change against a baseline run; returns the number of regressions"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {result_key(r): r for r in json.load(f)["results"]}
+
+    regressions = 0
+    print(f"\nComparison against {baseline_path} (tolerance {tolerance:.0%}):")
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if not previous or not previous["median_us"]:
+            continue
+        change = result["median_us"] / previous["median_us"] - 1
+        flag = ""
+        if change > tolerance:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"  {result_key(result):<80} {change:+7.1%}{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="ShifaAI backend micro-benchmarks")
+    parser.add_argument("--quick", action="store_true", help="Smaller corpora and fewer iterations")
+    parser.add_argument("--only", help="Only run benchmarks whose name contains this string")
+    parser.add_argument("--output", help="Result file (default: benchmarks/results/backend-<timestamp>.json)")
+    parser.add_argument("--compare", help="Baseline result file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed median slowdown before flagging")
+    args = parser.parse_args()
+
+    # Per-request logging (including handled fallbacks) would dominate the measurements
+    logging.disable(logging.ERROR)
+
+    runner = BenchmarkRunner(quick=args.quick, only=args.only)
+    for benchmark in BENCHMARKS:
+        benchmark(runner)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"backend-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"metadata": get_metadata(args.quick), "results": runner.results}, f, indent=2)
+    print(f"\nSaved {len(runner.results)} results to {output}")
+
+    if args.compare:
+        regressions = compare(runner.results, args.compare, args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""
+ShifaAI Production Server Benchmark
+Starts the launcher (backend/server.py) with different worker counts and reports memory per worker and requests/sec
+
+Usage:
+    python benchmarks/bench_server.py                         # 1 worker and one per CPU, preloaded
+    python benchmarks/bench_server.py --workers 1,2,4 --compare-preload
+    python benchmarks/bench_server.py --path "/knowledge/search?q=sleep" --duration 20
+
+Memory is read from /proc (Linux): RSS counts shared pages in every worker,
+PSS splits them between the processes sharing them, so PSS shows what
+copy-on-write sharing of the preloaded engines saves.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+RESULTS_DIR = os.path.join(REPO_ROOT, "benchmarks", "results")
+
+def read_memory_kb(pid: int) -> Dict[str, Optional[int]]:
+    """RSS and PSS of a process in KiB (None where /proc does not report them)"""
+    memory: Dict[str, Optional[int]] = {"rss_kb": None, "pss_kb": None}
+    for path, field, key in ((f"/proc/{pid}/status", "VmRSS:", "rss_kb"),
+                             (f"/proc/{pid}/smaps_rollup", "Pss:", "pss_kb")):
+        try:
+            with open(path, "r") as f:
+                for line in f:
+                    if line.startswith(field):
+                        memory[key] = int(line.split()[1])
+                        break
+        except OSError:
+            pass
+    return memory
+
+def child_pids(parent: int) -> List[int]:
+    """Worker processes forked by the launcher"""
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                # The command name may contain spaces; fields after it are space-separated
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == parent:
+            children.append(int(entry))
+    return sorted(children)
+
+def memory_report(master: int) -> Dict[str, Any]:
+    workers = {pid: read_memory_kb(pid) for pid in child_pids(master)}
+
+    def mean(key: str) -> Optional[float]:
+        values = [memory[key] for memory in workers.values() if memory[key] is not None]
+        return round(statistics.fmean(values) / 1024, 1) if values else None
+
+    pss_values = [memory["pss_kb"] for memory in workers.values() if memory["pss_kb"] is not None]
+    master_memory = read_memory_kb(master)
+    return {
+        "workers": len(workers),
+        "master_rss_mb": round(master_memory["rss_kb"] / 1024, 1) if master_memory["rss_kb"] else None,
+        "worker_rss_mb": mean("rss_kb"),
+        "worker_pss_mb": mean("pss_kb"),
+        "total_pss_mb": round((sum(pss_values) + (master_memory["pss_kb"] or 0)) / 1024, 1) if pss_values else None
+    }
+
+async def generate_load(url: str, path: str, duration: float, concurrency: int) -> Dict[str, Any]:
+    """Keep ``concurrency`` requests in flight for ``duration`` seconds"""
+    latencies: List[float] = []
+    errors = 0
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=30.0, limits=limits) as client:
+        deadline = time.perf_counter() + duration
+
+        async def client_loop():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = await client.get(path)
+                    if response.status_code != 200:
+                        errors += 1
+                        continue
+                except httpx.HTTPError:
+                    errors += 1
+                    continue
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+        seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "requests_per_sec": round(len(latencies) / seconds, 1),
+        "p50_ms": round(latencies[len(latencies) // 2], 2) if latencies else None,
+        "p99_ms": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 2) if latencies else None
+    }
+
+def wait_until_ready(url: str, process: subprocess.Popen, workers: int, timeout: float = 180.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if httpx.get(f"{url}/health", timeout=2.0).status_code == 200 and \
+                    len(child_pids(process.pid)) >= workers:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"Server not ready after {timeout:.0f}s")
+
+def bench_server(workers: int, preload: bool, args: argparse.Namespace) -> Dict[str, Any]:
+    url = f"http://127.0.0.1:{args.port}"
+    command = [sys.executable, "-m", "backend.server", "--host", "127.0.0.1", "--port", str(args.port),
+               "--workers", str(workers)]
+    if not preload:
+        command.append("--no-preload")
+    env = {**os.environ, "LOG_LEVEL": "WARNING"}
+    process = subprocess.Popen(command, cwd=REPO_ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_ready(url, process, workers)
+        idle = memory_report(process.pid)
+        load = asyncio.run(generate_load(url, args.path, args.duration, args.concurrency))
+        loaded = memory_report(process.pid)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    result = {"workers": workers, "preload": preload, "path": args.path, "idle": idle, "after_load": loaded, **load}
+    print(f"workers={workers:<3} preload={str(preload):<5} {load['requests_per_sec']:>9.1f} req/s  "
+          f"p99={load['p99_ms']}ms  worker RSS={loaded['worker_rss_mb']}MB  PSS={loaded['worker_pss_mb']}MB  "
+          f"total PSS={loaded['total_pss_mb']}MB  errors={load['errors']}")
+    return result
+
+def main():
+    cpus = os.cpu_count() or 1
+    parser = argparse.ArgumentParser(description="ShifaAI production server benchmark")
+    parser.add_argument("--workers", default=",".join(str(n) for n in sorted({1, cpus})),
+                        help="comma-separated worker counts")
+    parser.add_argument("--compare-preload", action="store_true", help="also run every count without preloading")
+    parser.add_argument("--path", default="/health", help="request path to load")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load per configuration")
+    parser.add_argument("--concurrency", type=int, default=64, help="requests kept in flight")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="Result file (default: benchmarks/results/server-<timestamp>.json)")
+    args = parser.parse_args()
+
+    results = []
+    for workers in (int(n) for n in args.workers.split(",")):
+        for preload in ((True, False) if args.compare_preload else (True,)):
+            results.append(bench_server(workers, preload, args))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"server-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"metadata": {"timestamp": datetime.now().isoformat(), "cpu_count": cpus,
+                                "duration": args.duration, "concurrency": args.concurrency},
+                   "results": results}, f, indent=2)
+    print(f"\nSaved {len(results)} results to {output}")
+
+if __name__ == "__main__":
+    main()
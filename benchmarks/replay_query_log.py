@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+ShifaAI Query Log Replay
+Re-sends the questions of a captured query log (QUERY_LOG_FILE) to a server with the original timing
+
+Usage:
+    python benchmarks/replay_query_log.py queries.jsonl                          # real time against localhost
+    python benchmarks/replay_query_log.py queries.jsonl --speedup 10             # 10x faster than production
+    python benchmarks/replay_query_log.py queries.jsonl --speedup 0 --limit 1000 # as fast as possible
+    python benchmarks/replay_query_log.py queries.*.jsonl                        # logs of several workers, merged
+
+Every request comes from this one machine, and admission control rate limits
+per client IP, so start the server under test with the LLM limits raised, e.g.
+
+    ADMISSION_LLM_RATE_PER_SECOND=1000 ADMISSION_LLM_BURST=1000 \
+    ADMISSION_LLM_MAX_IN_FLIGHT=256 ADMISSION_LLM_MAX_QUEUE=1024 python -m backend.server
+
+Otherwise the replay mostly measures throttling (reported as "rate_limited").
+Each record's pseudonymous user key is replayed as its user_id, so
+per-user conversation memory behaves as it did in production.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+def load_entries(paths: List[str], limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Query log records of one or more files in timestamp order"""
+    entries = []
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry.get("question") and "ts" in entry:
+                    entries.append(entry)
+    entries.sort(key=lambda entry: entry["ts"])
+    return entries[:limit] if limit else entries
+
+def percentile(samples: List[float], fraction: float) -> float:
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+async def replay(entries: List[Dict[str, Any]], url: str, speedup: float, concurrency: int,
+                 timeout: float) -> Dict[str, Any]:
+    """Send each entry at its original offset divided by ``speedup`` (0 sends back to back)"""
+    semaphore = asyncio.Semaphore(concurrency)
+    statuses: Counter = Counter()
+    outcomes: Counter = Counter()
+    latencies: List[float] = []
+    lag: List[float] = []
+    first_ts = entries[0]["ts"]
+
+    async with httpx.AsyncClient(base_url=url, timeout=timeout) as client:
+        start = time.perf_counter()
+
+        async def send(entry: Dict[str, Any]):
+            if speedup > 0:
+                delay = (entry["ts"] - first_ts) / speedup - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            async with semaphore:
+                if speedup > 0:
+                    lag.append(max(0.0, time.perf_counter() - start - (entry["ts"] - first_ts) / speedup))
+                payload = {
+                    "question": entry["question"],
+                    "include_cbt": entry.get("include_cbt", True),
+                    "include_shifa": entry.get("include_shifa", True)
+                }
+                if entry.get("user_key"):
+                    payload["user_id"] = f"replay-{entry['user_key']}"
+                sent = time.perf_counter()
+                try:
+                    response = await client.post(entry.get("endpoint", "/ask"), json=payload)
+                    statuses[str(response.status_code)] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                    return
+                latencies.append((time.perf_counter() - sent) * 1000)
+                outcomes[entry.get("outcome", "unknown")] += 1
+
+        await asyncio.gather(*(send(entry) for entry in entries))
+        seconds = time.perf_counter() - start
+
+    report = {
+        "requests": len(entries),
+        "seconds": round(seconds, 2),
+        "requests_per_second": round(len(entries) / seconds, 2) if seconds else 0.0,
+        "statuses": dict(statuses),
+        "rate_limited": statuses.get("429", 0),
+        "recorded_outcomes": dict(outcomes)
+    }
+    if latencies:
+        report["latency_ms"] = {
+            "mean": round(statistics.mean(latencies), 1),
+            "p50": round(percentile(latencies, 0.50), 1),
+            "p95": round(percentile(latencies, 0.95), 1),
+            "p99": round(percentile(latencies, 0.99), 1),
+            "max": round(max(latencies), 1)
+        }
+    if lag:
+        # How far sends fell behind the schedule (the client or concurrency limit could not keep up)
+        report["schedule_lag_ms_p95"] = round(percentile(lag, 0.95) * 1000, 1)
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a ShifaAI query log against a running server")
+    parser.add_argument("logs", nargs="+", help="query logs written by QUERY_LOG_FILE (JSON Lines)")
+    parser.add_argument("--url", default="http://localhost:8000", help="server base URL")
+    parser.add_argument("--speedup", type=float, default=1.0,
+                        help="replay this many times faster than recorded (0 = no pacing)")
+    parser.add_argument("--concurrency", type=int, default=64, help="maximum requests in flight")
+    parser.add_argument("--limit", type=int, help="replay only the first N records")
+    parser.add_argument("--timeout", type=float, default=60.0, help="per-request timeout in seconds")
+    parser.add_argument("--output", help="also save the report as JSON")
+    args = parser.parse_args()
+
+    entries = load_entries(args.logs, args.limit)
+    if not entries:
+        parser.error(f"no replayable records in {', '.join(args.logs)}")
+    span = entries[-1]["ts"] - entries[0]["ts"]
+    print(f"Replaying {len(entries)} requests recorded over {span:.0f}s against {args.url} "
+          f"(speedup {args.speedup:g}x, concurrency {args.concurrency})")
+
+    report = asyncio.run(replay(entries, args.url, args.speedup, args.concurrency, args.timeout))
+    print(json.dumps(report, indent=2))
+    if report["rate_limited"]:
+        print(f"\n{report['rate_limited']} requests were rate limited; raise the server's ADMISSION_LLM_* limits "
+              f"for replay runs (see the top of this script)")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -21,8 +21,20 @@ from backend.app import app
 
 @pytest.fixture
 def client():
-    """Create a test client for the FastAPI app"""
-    return TestClient(app)
+    """Create a test client for the FastAPI app
+
+    Every test client shares one client IP, so each test starts with fresh rate limit buckets.
+    """
+    from backend.admission import admission_controller
+    with patch.dict(admission_controller._buckets, clear=True):
+        yield TestClient(app)
+
+@pytest.fixture
+def admin_headers():
+    """Configure an admin token and return the headers that present it"""
+    from backend.utils import Config
+    with patch.object(Config, "ADMIN_TOKEN", "test-admin-token"):
+        yield {"X-Admin-Token": "test-admin-token"}
 
 @pytest.fixture
 def mock_openai_key():
@@ -936,6 +948,1758 @@ class TestUtilityFunctions:
         cleaned = clean_text("  Hello   world!  ")
         assert cleaned == "Hello world!"
 
+class TestCatalogRecords:
+    """Test immutable catalog records and per-request views"""
+    
+    def test_catalog_records_are_frozen(self):
+        """Catalog entries cannot be mutated by request handlers"""
+        from dataclasses import FrozenInstanceError
+        exercise = CBTEngine().exercises["breathing"]
+        
+        with pytest.raises(FrozenInstanceError):
+            exercise.name = "changed"
+        assert not hasattr(exercise, "__dict__")
+    
+    def test_recommendation_shares_catalog_record(self):
+        """Recommendations wrap the shared record instead of copying it"""
+        cbt = CBTEngine()
+        recommendation = cbt.recommend_exercise(["anxiety"], mood_rating=2)
+        
+        assert recommendation.record is cbt.exercises[recommendation["id"]]
+        assert "match_score" in recommendation
+        assert "id" not in cbt.exercises[recommendation["id"]]
+    
+    def test_optional_remedy_fields_behave_like_missing_keys(self):
+        """Remedies without a field act like the original dict catalog"""
+        remedy = ShifaEngine().prophetic_remedies["zamzam_water"]
+        
+        assert "modern_benefits" not in remedy
+        assert remedy.get("modern_benefits") is None
+        assert remedy["usage"] == "Drink with intention (dua) for healing"
+
+class TestConversationStore:
+    """Test bounded server-side conversation memory"""
+    
+    def test_old_turns_compacted_into_summary(self):
+        """Turns beyond the session budget roll into the summary"""
+        from backend.memory import ConversationStore
+        store = ConversationStore(session_token_budget=40, summary_token_budget=30)
+        
+        for i in range(5):
+            store.add_turn("user-1", f"Question {i} about sleep?", "Try a regular bedtime. " * 3)
+        
+        context = store.get_context("user-1")
+        assert len(context["conversation_turns"]) < 5
+        assert "Asked:" in context["conversation_summary"]
+        assert store.get_stats()["compactions"] > 0
+    
+    def test_lru_eviction_over_session_cap(self):
+        """Least recently used sessions are evicted first"""
+        from backend.memory import ConversationStore
+        store = ConversationStore(max_sessions=2)
+        
+        store.add_turn("a", "First question?", "First answer.")
+        store.add_turn("b", "Second question?", "Second answer.")
+        store.get_context("a")
+        store.add_turn("c", "Third question?", "Third answer.")
+        
+        assert store.get_context("b") is None
+        assert store.get_context("a") is not None
+        assert store.get_stats()["active_sessions"] == 2
+    
+    def test_ttl_expiry(self):
+        """Idle sessions expire after the TTL"""
+        from backend.memory import ConversationStore
+        store = ConversationStore(ttl_seconds=0)
+        store.add_turn("a", "Question?", "Answer.")
+        
+        import time
+        time.sleep(0.01)
+        assert store.get_context("a") is None
+        assert store.get_stats()["total_tokens"] == 0
+
+class TestAdmissionControl:
+    """Test rate limiting and load shedding"""
+    
+    def test_token_bucket_limits_burst(self):
+        """Buckets allow the burst then ask callers to wait"""
+        from backend.admission import TokenBucket
+        bucket = TokenBucket(rate=1.0, capacity=2)
+        
+        assert bucket.consume() == 0
+        assert bucket.consume() == 0
+        assert bucket.consume() > 0
+    
+    def test_queue_full_sheds_immediately(self):
+        """Requests beyond in-flight cap and queue depth are shed"""
+        from backend.admission import EndpointClass
+        limiter = EndpointClass("llm", max_in_flight=1, max_queue=0, queue_timeout=1,
+                                rate_per_second=10, burst=10)
+        
+        async def scenario():
+            assert await limiter.acquire()
+            assert not await limiter.acquire()
+            limiter.release()
+            assert await limiter.acquire()
+        
+        asyncio.run(scenario())
+        assert limiter.get_stats()["shed"] == 1
+    
+    def test_rate_limited_client_gets_429(self, client):
+        """Per-client buckets reject fast with Retry-After"""
+        from backend.admission import admission_controller
+        catalog = admission_controller.endpoint_classes["catalog"]
+        
+        with patch.dict(admission_controller._buckets, clear=True), \
+                patch.object(catalog, "rate_per_second", 0.01), patch.object(catalog, "burst", 2):
+            statuses = [client.get("/cbt/daily-tip").status_code for _ in range(3)]
+            response = client.get("/cbt/daily-tip")
+        
+        assert statuses == [200, 200, 429]
+        assert int(response.headers["Retry-After"]) > 0
+    
+    def test_user_id_header_does_not_reset_bucket(self, client):
+        """A new X-User-ID per request still draws from the caller's own bucket"""
+        from backend.admission import admission_controller
+        catalog = admission_controller.endpoint_classes["catalog"]
+        
+        with patch.dict(admission_controller._buckets, clear=True), \
+                patch.object(catalog, "rate_per_second", 0.01), patch.object(catalog, "burst", 2):
+            statuses = [client.get("/cbt/daily-tip", headers={"X-User-ID": f"user-{i}"}).status_code
+                        for i in range(3)]
+        
+        assert statuses == [200, 200, 429]
+
+class TestEmergencyFastLane:
+    """Test the emergency fast lane"""
+    
+    def test_emergency_detection(self):
+        """Emergency phrases are detected even when other categories match first"""
+        from backend.utils import is_emergency_query, categorize_medical_query
+        
+        assert categorize_medical_query("I have chest pain") == "symptoms"
+        assert is_emergency_query("I have chest pain")
+        assert not is_emergency_query("I have a mild headache")
+    
+    @patch('backend.gpt_router.gpt_router.generate_medical_response')
+    def test_emergency_skips_llm(self, mock_gpt, client):
+        """Emergency questions get the local safety response without calling the LLM"""
+        response = client.post("/ask", json={"question": "I have chest pain and difficulty breathing"})
+        
+        assert response.status_code == 200
+        data = response.json()["data"]
+        assert data["medical_response"]["category"] == "emergency"
+        assert data["request_metadata"]["fast_lane"] is True
+        mock_gpt.assert_not_called()
+    
+    def test_only_question_grants_priority(self):
+        """An emergency phrase in any other field does not buy the fast lane"""
+        from backend.admission import admission_controller
+        
+        assert admission_controller.is_priority(json.dumps({"question": "I have chest pain"}).encode())
+        assert not admission_controller.is_priority(
+            json.dumps({"question": "Tips for sleep?", "user_id": "chest pain"}).encode())
+        assert not admission_controller.is_priority(b'{"question": "Tips", "padding": "chest pain"')
+    
+    @patch('backend.gpt_router.gpt_router.generate_medical_response')
+    def test_emergency_bypasses_empty_bucket(self, mock_gpt, client):
+        """A client that has used up its /ask budget still gets the emergency response"""
+        from backend.admission import admission_controller
+        llm = admission_controller.endpoint_classes["llm"]
+        
+        with patch.object(llm, "rate_per_second", 0.01), patch.object(llm, "burst", 0):
+            throttled = client.post("/ask", json={"question": "What is a balanced diet?"})
+            response = client.post("/ask", json={"question": "I have severe chest pain right now"})
+        
+        assert throttled.status_code == 429
+        assert response.status_code == 200
+        assert response.json()["data"]["medical_response"]["category"] == "emergency"
+        mock_gpt.assert_not_called()
+    
+    def test_emergency_bypasses_in_flight_cap(self, client):
+        """A saturated LLM class neither queues nor sheds emergencies"""
+        from backend.admission import admission_controller
+        llm = admission_controller.endpoint_classes["llm"]
+        admitted = llm.fast_lane_admitted
+        
+        with patch.object(llm, "in_flight", llm.max_in_flight), patch.object(llm, "max_queue", 0):
+            response = client.post("/ask", json={"question": "My father is having a stroke, what do I do?"})
+        
+        assert response.status_code == 200
+        assert response.json()["data"]["medical_response"]["category"] == "emergency"
+        assert llm.fast_lane_admitted == admitted + 1
+        assert llm.fast_lane_in_flight == 0
+
+class TestTieredCache:
+    """Test the two-tier cache"""
+    
+    def test_l2_shared_between_workers(self):
+        """A value set by one worker's cache is served from L2 to another"""
+        from backend.cache import LocalBackend, TieredCache
+        shared = LocalBackend()
+        worker_a = TieredCache("test", shared)
+        worker_b = TieredCache("test", shared)
+        key = TieredCache.make_key("medical_response", "What is flu?")
+        
+        worker_a.set(key, {"response": "Flu is a viral infection"})
+        
+        assert worker_b.get(key) == {"response": "Flu is a viral infection"}
+        assert worker_b.get_stats()["l2_hits"] == 1
+        assert worker_b.get(key) is not None
+        assert worker_b.get_stats()["l1_hits"] == 1
+    
+    def test_key_hashing_is_normalized(self):
+        """Keys ignore case and surrounding whitespace"""
+        from backend.cache import TieredCache
+        
+        assert TieredCache.make_key("q", " Anxiety ") == TieredCache.make_key("q", "anxiety")
+    
+    def test_version_invalidation_reaches_other_workers(self):
+        """Bumping the namespace version hides old entries in every worker"""
+        from backend.cache import LocalBackend, TieredCache
+        shared = LocalBackend()
+        worker_a = TieredCache("test", shared, version_check_interval=0)
+        worker_b = TieredCache("test", shared, version_check_interval=0)
+        
+        worker_b.set("key", "old")
+        worker_a.invalidate()
+        
+        assert worker_b.get("key") is None
+    
+    def test_l1_is_bounded(self):
+        """L1 evicts least recently used entries past its size"""
+        from backend.cache import LocalBackend, TieredCache
+        cache = TieredCache("test", LocalBackend(), l1_max_entries=2)
+        
+        for i in range(5):
+            cache.set(f"key-{i}", i)
+        
+        assert cache.get_stats()["l1_entries"] == 2
+    
+    def test_local_backend_is_bounded(self):
+        """The local L2 evicts least recently used entries and sweeps expired ones, but keeps versions"""
+        from backend.cache import LocalBackend
+        backend = LocalBackend(max_entries=2, sweep_interval=0)
+        backend.incr("shifa:test:version")
+        
+        backend.set("a", "1", 0)
+        backend.set("b", "2", 0)
+        backend.get("a")
+        backend.set("c", "3", 0)
+        
+        assert backend.get("b") is None
+        assert backend.get("a") == "1"
+        assert backend.get("shifa:test:version") == "1"
+        
+        backend.set("d", "4", -1)
+        backend.set("e", "5", 0)
+        assert len(backend) == 2
+        assert backend.get("d") is None
+    
+    def test_async_access_with_blocking_backend(self):
+        """aget/aset move round trips to a blocking backend off the event loop"""
+        import threading
+        from backend.cache import LocalBackend, TieredCache
+        
+        class BlockingBackend(LocalBackend):
+            blocking = True
+            threads = set()
+            
+            def get(self, key):
+                self.threads.add(threading.current_thread().name)
+                return super().get(key)
+        
+        cache = TieredCache("test-async", BlockingBackend(), version_check_interval=0)
+        
+        async def scenario():
+            await cache.aset("key", {"answer": 1})
+            return await cache.aget("key")
+        
+        assert asyncio.run(scenario()) == {"answer": 1}
+        assert threading.main_thread().name not in BlockingBackend.threads
+    
+    def test_corpus_change_invalidates_answers(self):
+        """Replacing or extending the knowledge base drops cached answers; reloading the same corpus keeps them"""
+        from backend.cache import LocalBackend, TieredCache
+        from backend.scraper import MedicalKnowledgeBase
+        cache = TieredCache("test-corpus", LocalBackend(), version_check_interval=0)
+        kb = MedicalKnowledgeBase(response_cache=cache)
+        faqs = [{"question": "What is flu?", "answer": "A viral infection.", "source": "Test", "category": "general"}]
+        
+        kb.set_faqs(list(faqs))
+        cache.set("answer", "cached")
+        kb.set_faqs(list(faqs))
+        assert cache.get("answer") == "cached"
+        
+        kb.add_faqs([{"question": "What is a cold?", "answer": "A mild infection.", "source": "Test",
+                      "category": "general"}])
+        assert cache.get("answer") is None
+        
+        cache.set("answer", "cached")
+        kb.reload_category("general", faqs)
+        assert cache.get("answer") is None
+
+class TestDenseRetrieval:
+    """Test dense vector retrieval over the knowledge base"""
+    
+    def setup_method(self):
+        from backend.scraper import MedicalKnowledgeBase
+        self.kb = MedicalKnowledgeBase()
+        scraper = MedicalScraper()
+        self.kb.set_faqs(scraper.preprocess_content(
+            scraper.scrape_mayo_clinic_faq() + scraper.scrape_webmd_content() + scraper.scrape_healthline_content()
+        ))
+    
+    def test_dense_search_matches_paraphrase(self):
+        """Dense mode finds FAQs without exact query substrings"""
+        results = self.kb.search_faqs("trouble sleeping at night", mode="dense", limit=1)
+        
+        assert results
+        assert "sleep" in results[0]["question"].lower()
+    
+    def test_index_is_contiguous_float32(self):
+        """Vectors are stored as one contiguous float32 matrix"""
+        import numpy as np
+        index = self.kb.get_dense_index()
+        
+        assert index.matrix.dtype == np.float32
+        assert index.matrix.flags["C_CONTIGUOUS"]
+        assert index.matrix.shape[0] == len(self.kb.faqs)
+    
+    def test_category_filter_and_reload(self):
+        """Category filters restrict candidates and reloading rebuilds the index over the new corpus"""
+        results = self.kb.search_faqs("anxiety worry", category="lifestyle", mode="dense")
+        assert all(r["category"] == "lifestyle" for r in results)
+        index = self.kb.dense_index
+        
+        self.kb.set_faqs(self.kb.faqs[:2])
+        assert self.kb.dense_index is not index
+        assert len(self.kb.dense_index) == 2
+    
+    def test_ivf_partitioning(self):
+        """Large corpora are partitioned into IVF cells"""
+        from backend.retrieval import DenseRetrievalIndex
+        docs = [f"document about topic {i % 50} and symptom {i % 7}" for i in range(400)]
+        index = DenseRetrievalIndex(dimensions=16, ivf_min_docs=100, nprobe=2).build(docs)
+        
+        assert index.get_stats()["ivf_cells"] > 1
+        assert len(index.search("topic 3 symptom 3", k=5)) == 5
+
+class TestKnowledgeShortCircuit:
+    """Test serving knowledge base answers without the LLM"""
+    
+    @pytest.fixture(autouse=True)
+    def enabled(self):
+        from backend.gpt_router import gpt_router
+        from backend.scraper import initialize_knowledge_base
+        initialize_knowledge_base()
+        with patch.dict(gpt_router.knowledge_short_circuit, {"enabled": True, "mode": "keyword"}):
+            yield
+    
+    def test_disabled_by_default(self):
+        from backend.utils import Config
+        assert Config.KB_SHORT_CIRCUIT_ENABLED is False
+    
+    @patch('backend.gpt_router.gpt_router.generate_medical_response')
+    def test_high_confidence_match_skips_llm(self, mock_gpt):
+        """A verbatim FAQ question is answered from the knowledge base"""
+        from backend.gpt_router import process_medical_query
+        
+        result = asyncio.run(process_medical_query("How much sleep do adults need?"))
+        medical = result["medical_response"]
+        
+        mock_gpt.assert_not_called()
+        assert medical["knowledge_match"]["question"] == "How much sleep do adults need?"
+        assert "Medical Disclaimer" in medical["response"]
+        assert medical["follow_up_questions"]
+        assert medical["sources_recommended"]
+    
+    @pytest.mark.parametrize("mode", ["keyword", "dense"])
+    @pytest.mark.parametrize("question", [
+        "What are the symptoms of diabetes?",
+        "How much water should I drink with kidney failure?",
+        "How much sleep do teenagers need?"
+    ])
+    def test_near_miss_questions_reach_llm(self, question, mode):
+        """Questions that share words with a FAQ but ask something else are not given its answer"""
+        from backend.gpt_router import gpt_router, process_medical_query
+        llm_response = {"response": "From the LLM", "category": "general_health"}
+        
+        with patch.dict(gpt_router.knowledge_short_circuit, {"mode": mode}), \
+             patch.object(gpt_router, "generate_medical_response", new_callable=AsyncMock,
+                          return_value=llm_response) as mock_gpt, \
+             patch("backend.gpt_router.response_cache.aget", new_callable=AsyncMock, return_value=None), \
+             patch("backend.gpt_router.response_cache.aset", new_callable=AsyncMock):
+            result = asyncio.run(process_medical_query(question))
+        
+        mock_gpt.assert_called_once()
+        assert "knowledge_match" not in result["medical_response"]
+    
+    def test_dense_mode_refused_on_small_corpus(self):
+        """A handful of FAQs gives the SVD too few dimensions to tell topics apart"""
+        from backend.gpt_router import gpt_router
+        
+        with patch.dict(gpt_router.knowledge_short_circuit, {"mode": "dense"}):
+            assert gpt_router.get_short_circuit_stats()["available"] is False
+            assert gpt_router.answer_from_knowledge_base("How much sleep do adults need?") is None
+    
+    def test_disabled_without_dense_index(self):
+        """Keyword fallback scores never clear the cosine threshold, so the LLM is used instead"""
+        from backend.gpt_router import gpt_router
+        from backend.scraper import knowledge_base
+        
+        with patch.dict(gpt_router.knowledge_short_circuit, {"mode": "dense"}), \
+             patch.object(knowledge_base, "get_dense_index", return_value=None):
+            assert gpt_router.answer_from_knowledge_base("How much sleep do adults need?") is None
+            assert gpt_router.get_short_circuit_stats()["available"] is False
+    
+    def test_background_lookups_are_not_counted(self):
+        """Warmup and prefetch lookups leave the reported hit rate to user traffic"""
+        from backend.gpt_router import gpt_router
+        before = dict(gpt_router.get_short_circuit_stats())
+        
+        gpt_router.answer_from_knowledge_base("How much sleep do adults need?", record_stats=False)
+        after = gpt_router.get_short_circuit_stats()
+        
+        assert after["lookups"] == before["lookups"]
+        assert after["hits"] == before["hits"]
+    
+    def test_threshold_is_tunable(self, client, admin_headers):
+        """The admin endpoint updates the threshold and reports the hit rate"""
+        response = client.post("/admin/knowledge-short-circuit?threshold=0.95", headers=admin_headers)
+        data = response.json()["data"]
+        assert data["threshold"] == 0.95
+        assert "hit_rate" in data
+    
+    def test_tuning_requires_admin_token(self, client, admin_headers):
+        """Without the admin token the threshold cannot be lowered to answer everything"""
+        from backend.gpt_router import gpt_router
+        threshold = gpt_router.knowledge_short_circuit["threshold"]
+        
+        missing = client.post("/admin/knowledge-short-circuit?threshold=0.01")
+        wrong = client.post("/admin/knowledge-short-circuit?threshold=0.01", headers={"X-Admin-Token": "guess"})
+        zero = client.post("/admin/knowledge-short-circuit?threshold=0", headers=admin_headers)
+        
+        assert (missing.status_code, wrong.status_code, zero.status_code) == (401, 403, 400)
+        assert gpt_router.knowledge_short_circuit["threshold"] == threshold
+
+class TestRetrievalAugmentedPrompting:
+    """Test RAG prompting in the GPT router"""
+    
+    def setup_method(self):
+        from backend.scraper import initialize_knowledge_base
+        initialize_knowledge_base()
+    
+    def test_rag_context_respects_token_budget(self):
+        """Retrieved passages are trimmed to the token budget"""
+        from backend.gpt_router import gpt_router
+        from backend.utils import estimate_tokens
+        
+        passages = gpt_router.retrieve_passages("What are healthy ways to lose weight?")
+        rag_context, rag_tokens = gpt_router.build_rag_context(passages, token_budget=50)
+        
+        assert passages
+        assert rag_tokens <= 50
+        assert estimate_tokens(rag_context) <= 55
+    
+    def test_grounded_request_uses_smaller_completion_budget(self):
+        """Passages are injected and max_tokens shrinks when context is retrieved"""
+        from unittest.mock import MagicMock
+        from backend.gpt_router import gpt_router
+        
+        completion = MagicMock()
+        completion.choices = [MagicMock()]
+        completion.choices[0].message.content = "Grounded answer"
+        with patch.object(gpt_router, "client") as mock_client:
+            mock_client.chat.completions.create.return_value = completion
+            result = asyncio.run(gpt_router.generate_medical_response("How much sleep do adults need?"))
+            kwargs = mock_client.chat.completions.create.call_args.kwargs
+        
+        assert kwargs["max_tokens"] < 800
+        assert any("Reference material" in m["content"] for m in kwargs["messages"])
+        assert result["grounding"][0]["question"] == "How much sleep do adults need?"
+
+class TestRequestProfiling:
+    """Test the on-demand profiling hook"""
+    
+    def test_stage_is_noop_without_profiling(self):
+        """Stage timers record nothing outside a profiled request"""
+        from backend.profiling import stage, _stage_timings
+        
+        with stage("llm"):
+            pass
+        
+        assert _stage_timings.get() is None
+    
+    @pytest.mark.parametrize("mode,extension", [("cprofile", ".pstats"), ("sample", ".collapsed")])
+    def test_profiled_request(self, tmp_path, mode, extension):
+        """A request with the admin token gets Server-Timing and a saved profile"""
+        from backend.profiling import ProfilingMiddleware, RequestProfiler
+        profiler = RequestProfiler(admin_token="secret", output_dir=str(tmp_path))
+        profiled_client = TestClient(ProfilingMiddleware(app, profiler))
+        
+        response = profiled_client.post("/ask", headers={"X-Profile-Token": "secret", "X-Profile-Mode": mode},
+                                        json={"question": "I have chest pain and difficulty breathing"})
+        
+        assert response.status_code == 200
+        assert "triage;dur=" in response.headers["server-timing"]
+        assert "total;dur=" in response.headers["server-timing"]
+        saved = os.listdir(tmp_path)
+        assert len(saved) == 1 and saved[0].endswith(extension)
+        assert saved[0] in response.headers["server-timing"]
+    
+    def test_invalid_token_is_not_profiled(self, tmp_path):
+        """Requests without a valid token are served normally and leave no profile"""
+        from backend.profiling import ProfilingMiddleware, RequestProfiler
+        profiler = RequestProfiler(admin_token="secret", output_dir=str(tmp_path))
+        profiled_client = TestClient(ProfilingMiddleware(app, profiler))
+        
+        response = profiled_client.get("/health", headers={"X-Profile-Token": "wrong"})
+        
+        assert response.status_code == 200
+        assert "server-timing" not in response.headers
+        assert os.listdir(tmp_path) == []
+        assert profiler.get_stats()["rejected_tokens"] == 1
+
+class TestRequestTracing:
+    """Test request IDs and tracing spans"""
+    
+    @pytest.fixture
+    def exporter(self):
+        from backend.tracing import InMemorySpanExporter, tracer
+        exporter = InMemorySpanExporter()
+        with patch.object(tracer, "exporter", exporter):
+            yield exporter
+    
+    def test_nested_spans_share_request_id(self, exporter):
+        """Spans opened inside a trace are exported together with parent links"""
+        from backend.tracing import tracer
+        
+        with tracer.trace("request", "req-123") as root:
+            with tracer.span("llm", model="gpt-4o") as child:
+                pass
+        
+        spans = exporter.get_spans("req-123")
+        assert [span.name for span in spans] == ["llm", "request"]
+        assert child.parent_id == root.span_id
+        assert child.attributes["model"] == "gpt-4o"
+    
+    def test_file_exporter_writes_in_background(self, tmp_path):
+        """File exports only buffer spans; a background thread appends them in batches"""
+        import time
+        from backend.tracing import FileSpanExporter, Tracer
+        path = tmp_path / "traces.jsonl"
+        exporter = FileSpanExporter(str(path), batch_size=2, flush_interval=60)
+        file_tracer = Tracer(exporter)
+        
+        with file_tracer.trace("request", "req-file"):
+            pass
+        assert not path.exists()
+        
+        with file_tracer.trace("request", "req-file-2"):
+            pass
+        for _ in range(100):
+            if exporter.get_stats()["written"]:
+                break
+            time.sleep(0.01)
+        
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [line["trace_id"] for line in lines] == ["req-file", "req-file-2"]
+        assert exporter.get_stats()["batches"] == 1
+    
+    def test_span_records_errors(self, exporter):
+        """Exceptions are recorded on the span and re-raised"""
+        from backend.tracing import tracer
+        
+        with pytest.raises(ValueError):
+            with tracer.trace("request", "req-error"):
+                raise ValueError("boom")
+        
+        assert exporter.get_spans("req-error")[0].error == "ValueError: boom"
+    
+    def test_request_id_populated(self, client, exporter):
+        """Responses carry the request ID in the body, header and exported spans"""
+        response = client.post("/ask", headers={"X-Request-ID": "trace-test-1"},
+                               json={"question": "I have chest pain and difficulty breathing"})
+        
+        assert response.status_code == 200
+        assert response.json()["request_id"] == "trace-test-1"
+        assert response.headers["x-request-id"] == "trace-test-1"
+        names = {span.name for span in exporter.get_spans("trace-test-1")}
+        assert {"POST /ask", "triage"} <= names
+    
+    def test_invalid_request_id_replaced(self, client, exporter):
+        """Malformed incoming request IDs are replaced with a generated one"""
+        response = client.get("/health", headers={"X-Request-ID": "bad id with spaces"})
+        
+        assert response.headers["x-request-id"] != "bad id with spaces"
+        assert len(response.headers["x-request-id"]) == 32
+
+class TestBulkIngestion:
+    """Test streaming NDJSON ingestion into the knowledge base"""
+    
+    @pytest.fixture
+    def fresh_kb(self):
+        from backend.scraper import MedicalKnowledgeBase
+        kb = MedicalKnowledgeBase()
+        kb.set_faqs([{"question": "What is flu?", "answer": "A viral infection.", "source": "Test",
+                      "category": "acute_illness"}])
+        return kb
+    
+    def test_ingest_endpoint_reports_batches(self, client, fresh_kb, admin_headers):
+        """Valid records are cleaned and added; duplicates and invalid lines are rejected"""
+        lines = [
+            json.dumps({"question": "  What   causes migraines? ", "answer": "Triggers include stress.",
+                        "category": "pain_management"}),
+            json.dumps({"question": "what is FLU?", "answer": "Duplicate of an existing question."}),
+            "not json",
+            json.dumps({"question": "Missing answer"}),
+            "",
+            json.dumps({"question": "How much water should I drink?", "answer": "About 2 liters a day."})
+        ]
+        
+        with patch('backend.app.knowledge_base', fresh_kb):
+            response = client.post("/admin/knowledge/ingest?batch_size=2", content="\n".join(lines),
+                                   headers=admin_headers)
+        
+        data = response.json()["data"]
+        assert data["received"] == 5
+        assert data["added"] == 2
+        assert data["duplicates"] == 1
+        assert data["invalid"] == 2
+        assert [error["line"] for error in data["errors"]] == [3, 4]
+        assert len(data["batches"]) == 2
+        assert fresh_kb.faqs[1]["question"] == "What causes migraines?"
+        assert fresh_kb.faqs[2]["category"] == "general_health"
+    
+    def test_ingest_requires_admin_token(self, client, fresh_kb, admin_headers):
+        """Without the admin token nothing is ingested"""
+        line = json.dumps({"question": "What causes migraines?", "answer": "Triggers include stress."})
+        
+        with patch('backend.app.knowledge_base', fresh_kb):
+            missing = client.post("/admin/knowledge/ingest", content=line)
+            wrong = client.post("/admin/knowledge/ingest", content=line, headers={"X-Admin-Token": "guess"})
+        
+        assert missing.status_code == 401
+        assert wrong.status_code == 403
+        assert len(fresh_kb.faqs) == 1
+    
+    def test_ingest_disabled_without_configured_token(self, client):
+        """With no ADMIN_TOKEN set, any presented token is refused"""
+        from backend.utils import Config
+        
+        with patch.object(Config, "ADMIN_TOKEN", ""):
+            response = client.post("/admin/knowledge/ingest", content="", headers={"X-Admin-Token": ""})
+            guessed = client.post("/admin/knowledge/ingest", content="", headers={"X-Admin-Token": "x"})
+        
+        assert response.status_code == 401
+        assert guessed.status_code == 403
+    
+    def test_invalid_batch_size(self, client, admin_headers):
+        """Batch sizes outside the allowed range are rejected"""
+        response = client.post("/admin/knowledge/ingest?batch_size=0", content="", headers=admin_headers)
+        
+        assert response.status_code == 400
+    
+    def test_oversized_lines_rejected(self):
+        """Lines over the size limit are skipped without buffering them"""
+        from backend.ingest import iter_ndjson_lines
+        
+        async def chunks():
+            yield b'{"a": 1}\n' + b"x" * 50
+            yield b"x" * 50 + b'\n{"b": 2}'
+        
+        async def collect():
+            return [item async for item in iter_ndjson_lines(chunks(), max_line_bytes=64)]
+        
+        assert asyncio.run(collect()) == [(1, b'{"a": 1}'), (2, None), (3, b'{"b": 2}')]
+    
+    def test_dense_index_extended_incrementally(self, fresh_kb):
+        """Ingested FAQs are folded into an existing dense index instead of rebuilding it"""
+        from backend.retrieval import DENSE_RETRIEVAL_AVAILABLE
+        if not DENSE_RETRIEVAL_AVAILABLE:
+            pytest.skip("Dense retrieval dependencies not installed")
+        fresh_kb.add_faqs([{"question": "What are diabetes symptoms?", "answer": "Thirst and fatigue.",
+                            "source": "Test", "category": "chronic_condition"}])
+        index = fresh_kb.get_dense_index()
+        
+        added, duplicates = fresh_kb.add_faqs([
+            {"question": "How is asthma treated?", "answer": "Inhalers and avoiding triggers.",
+             "source": "Test", "category": "chronic_condition"}
+        ])
+        
+        assert (added, duplicates) == (1, 0)
+        assert fresh_kb.get_dense_index() is index
+        assert len(index) == 3 and index.folded_in == 1
+        results = fresh_kb.search_faqs("asthma inhalers", mode="dense")
+        assert results[0]["question"] == "How is asthma treated?"
+
+class TestKnowledgePagination:
+    """Test cursor-paginated search and the streaming export"""
+    
+    @pytest.fixture
+    def paged_kb(self):
+        from backend.scraper import MedicalKnowledgeBase
+        kb = MedicalKnowledgeBase()
+        kb.set_faqs([
+            {"question": f"How do I manage headache type {i}?", "answer": "Rest and hydration.",
+             "source": "Test", "category": "pain_management" if i % 2 else "general_health"}
+            for i in range(7)
+        ])
+        with patch('backend.app.knowledge_base', kb):
+            yield kb
+    
+    def test_cursor_pages_cover_all_results(self, client, paged_kb):
+        """Following next_cursor returns every match exactly once"""
+        seen = []
+        cursor = None
+        while True:
+            params = {"q": "headache", "limit": 3, **({"cursor": cursor} if cursor else {})}
+            data = client.get("/knowledge/search", params=params).json()["data"]
+            seen.extend(result["question"] for result in data["results"])
+            cursor = data["next_cursor"]
+            if cursor is None:
+                break
+        
+        assert len(seen) == 7
+        assert len(set(seen)) == 7
+    
+    def test_limit_is_capped(self, client, paged_kb):
+        """Limits above the server-side cap are clamped"""
+        from backend.utils import Config
+        
+        with patch.object(Config, "KNOWLEDGE_SEARCH_MAX_LIMIT", 2):
+            data = client.get("/knowledge/search", params={"q": "headache", "limit": 1000}).json()["data"]
+        
+        assert data["limit"] == 2
+        assert len(data["results"]) == 2
+    
+    def test_cursor_rejected_after_corpus_change(self, client, paged_kb):
+        """Cursors from another query or an older corpus version are rejected"""
+        data = client.get("/knowledge/search", params={"q": "headache", "limit": 2}).json()["data"]
+        
+        other_query = client.get("/knowledge/search", params={"q": "hydration", "cursor": data["next_cursor"]})
+        assert other_query.status_code == 400
+        
+        paged_kb.add_faqs([{"question": "New headache question?", "answer": "Rest.", "source": "Test",
+                            "category": "general_health"}])
+        stale = client.get("/knowledge/search", params={"q": "headache", "limit": 2, "cursor": data["next_cursor"]})
+        assert stale.status_code == 410
+    
+    def test_tampered_cursor_rejected(self, client, paged_kb):
+        """Editing a cursor's offset breaks its signature"""
+        import base64
+        data = client.get("/knowledge/search", params={"q": "headache", "limit": 2}).json()["data"]
+        body, signature = data["next_cursor"].split(".")
+        state = json.loads(base64.urlsafe_b64decode(body + "=" * (-len(body) % 4)))
+        forged = base64.urlsafe_b64encode(json.dumps({**state, "offset": -2}).encode()).decode().rstrip("=")
+        
+        response = client.get("/knowledge/search", params={"q": "headache", "limit": 2,
+                                                           "cursor": f"{forged}.{signature}"})
+        assert response.status_code == 400
+    
+    @pytest.mark.parametrize("offset", [-2, 10 ** 9, True])
+    def test_cursor_offset_bounds(self, client, paged_kb, offset):
+        """Even a validly signed cursor must carry an offset within the configured range"""
+        from backend.scraper import MedicalKnowledgeBase
+        from backend.cache import TieredCache
+        from backend.utils import encode_cursor
+        cursor = encode_cursor({"key": TieredCache.make_key("knowledge_search", "headache", None, "keyword"),
+                                "offset": offset, "version": paged_kb.version})
+        
+        with patch.object(MedicalKnowledgeBase, "search_faqs") as search_faqs:
+            response = client.get("/knowledge/search", params={"q": "headache", "limit": 2, "cursor": cursor})
+        
+        assert response.status_code == 400
+        search_faqs.assert_not_called()
+    
+    def test_paging_stops_at_max_offset(self, client, paged_kb):
+        """No cursor is issued past KNOWLEDGE_SEARCH_MAX_OFFSET"""
+        from backend.utils import Config
+        
+        with patch.object(Config, "KNOWLEDGE_SEARCH_MAX_OFFSET", 2):
+            first = client.get("/knowledge/search", params={"q": "headache", "limit": 2}).json()["data"]
+            second = client.get("/knowledge/search", params={"q": "headache", "limit": 2,
+                                                             "cursor": first["next_cursor"]}).json()["data"]
+        
+        assert len(second["results"]) == 2
+        assert second["next_cursor"] is None
+    
+    def test_export_streams_ndjson(self, client, paged_kb):
+        """The export endpoint streams the corpus as NDJSON, optionally by category"""
+        from backend.utils import Config
+        
+        with patch.object(Config, "KNOWLEDGE_EXPORT_CHUNK_SIZE", 2):
+            response = client.get("/knowledge/export", params={"category": "pain_management"})
+        
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        records = [json.loads(line) for line in response.text.splitlines()]
+        assert len(records) == 3
+        assert all(record["category"] == "pain_management" for record in records)
+
+class TestSpellingCorrection:
+    """Test typo-tolerant search"""
+    
+    def test_corrects_common_misspellings(self):
+        """Misspelled words are corrected to the closest, most frequent vocabulary word"""
+        from backend.spelling import SpellingCorrector
+        corrector = SpellingCorrector()
+        corrector.add_words(["diabetes", "headache", "insomnia", "fever"], weight=100)
+        corrector.add_text("Diabetics should monitor blood sugar")
+        
+        assert corrector.correct("diabetis symptoms") == "diabetes symptoms"
+        assert corrector.correct("bad hedache") == "bad headache"
+        assert corrector.correct("insomnai") == "insomnia"
+        assert corrector.correct("Feaver") == "fever"
+    
+    def test_leaves_short_and_unknown_words(self):
+        """Short words and words with no close match are left untouched"""
+        from backend.spelling import SpellingCorrector
+        corrector = SpellingCorrector()
+        corrector.add_words(["heart", "headache"])
+        
+        assert corrector.correct("heat") == "heat"
+        assert corrector.correct("Should I worry?") == "Should I worry?"
+    
+    def test_edit_distance(self):
+        """Transpositions count as a single edit"""
+        from backend.spelling import edit_distance
+        
+        assert edit_distance("fever", "fever", 2) == 0
+        assert edit_distance("insomnai", "insomnia", 2) == 1
+        assert edit_distance("flu", "influenza", 2) == 3
+    
+    def test_keyword_search_falls_back_to_corrected_query(self):
+        """Keyword search retries with corrected terms when nothing matches"""
+        from backend.scraper import MedicalKnowledgeBase
+        kb = MedicalKnowledgeBase()
+        kb.set_faqs([{"question": "What are the symptoms of diabetes?", "answer": "Thirst and fatigue.",
+                      "source": "Test", "category": "chronic_condition"}])
+        
+        results = kb.search_faqs("diabetis")
+        
+        assert len(results) == 1
+        assert results[0]["category"] == "chronic_condition"
+    
+    def test_ingested_words_join_vocabulary(self):
+        """FAQs added after the vocabulary is built are still used for corrections"""
+        from backend.scraper import MedicalKnowledgeBase
+        kb = MedicalKnowledgeBase()
+        kb.set_faqs([])
+        kb.get_spelling_corrector()
+        
+        kb.add_faqs([{"question": "What is gastritis?", "answer": "Stomach lining inflammation.",
+                      "source": "Test", "category": "general_health"}])
+        
+        assert kb.correct_query("gastritus") == "gastritis"
+
+    def test_correct_words_are_not_rewritten(self):
+        """With the real vocabulary, ordinary words are not "corrected" into medical terms before categorization"""
+        from unittest.mock import MagicMock
+        from backend.gpt_router import gpt_router
+        from backend.scraper import initialize_knowledge_base
+        from backend.utils import categorize_question
+        initialize_knowledge_base()
+        
+        completion = MagicMock()
+        completion.choices = [MagicMock()]
+        completion.choices[0].message.content = "Answer"
+        for question in ["I heard that honey helps", "I never get sick", "I tried everything", "chess"]:
+            with patch.object(gpt_router, "client") as mock_client:
+                mock_client.chat.completions.create.return_value = completion
+                result = asyncio.run(gpt_router.generate_medical_response(question))
+                messages = mock_client.chat.completions.create.call_args.kwargs["messages"]
+            
+            assert result["category"] == categorize_question(question)
+            assert messages[-1]["content"].endswith(question)
+    
+    def test_matching_search_is_not_corrected(self):
+        """Queries that match as typed are searched unchanged"""
+        from backend.scraper import knowledge_base, initialize_knowledge_base
+        initialize_knowledge_base()
+        
+        with patch.object(knowledge_base, "correct_query", side_effect=AssertionError("corrected")):
+            assert knowledge_base.search_faqs("honey helps with my sleep", mode="keyword")
+
+class TestQuestionSuggestions:
+    """Test question autocomplete"""
+    
+    def test_matches_word_prefixes(self):
+        """A prefix matches the start of any word in a question"""
+        from backend.suggest import SuggestionIndex
+        index = SuggestionIndex().build(["What are the symptoms of diabetes?", "How can I sleep better?"], [])
+        
+        suggestions = index.suggest("diab")
+        
+        assert [s["text"] for s in suggestions] == ["What are the symptoms of diabetes?"]
+        assert suggestions[0]["type"] == "question"
+        assert index.suggest("d") == []
+    
+    def test_ranks_by_popularity(self):
+        """Questions that are asked more often are suggested first"""
+        from backend.suggest import SuggestionIndex
+        index = SuggestionIndex(cache_ttl=0).build(["What causes headache?", "What causes heartburn?"], [])
+        
+        index.record_query("what causes heartburn?")
+        
+        suggestions = index.suggest("what causes")
+        assert suggestions[0]["text"] == "What causes heartburn?"
+        assert suggestions[0]["popularity"] == 2
+    
+    def test_limit_caps_results(self):
+        """No more than the requested number of suggestions is returned"""
+        from backend.suggest import SuggestionIndex
+        index = SuggestionIndex().build([f"What is condition {i}?" for i in range(30)], ["wheezing"])
+        
+        assert len(index.suggest("wh", limit=5)) == 5
+    
+    def test_ingested_questions_are_suggested(self):
+        """FAQs added after the index is built become suggestions"""
+        from backend.scraper import MedicalKnowledgeBase
+        kb = MedicalKnowledgeBase()
+        kb.set_faqs([])
+        kb.get_suggestion_index()
+        
+        kb.add_faqs([{"question": "What is gastritis?", "answer": "Stomach lining inflammation.",
+                      "source": "Test", "category": "general_health"}])
+        
+        assert kb.get_suggestion_index().suggest("gastr")[0]["text"] == "What is gastritis?"
+    
+    def test_suggest_endpoint(self, client):
+        """Test the autocomplete endpoint"""
+        response = client.get("/knowledge/suggest", params={"q": "diab", "limit": 3})
+        
+        assert response.status_code == 200
+        data = response.json()
+        assert data["success"] is True
+        assert data["data"]["query"] == "diab"
+        assert len(data["data"]["suggestions"]) <= 3
+        
+        assert client.get("/knowledge/suggest", params={"q": "diab", "limit": 0}).status_code == 400
+
+class TestSearchResultCache:
+    """Test the versioned knowledge search result cache"""
+    
+    def setup_method(self):
+        from backend.scraper import MedicalKnowledgeBase
+        self.kb = MedicalKnowledgeBase()
+        self.kb.set_faqs([{"question": "What are the symptoms of diabetes?", "answer": "Thirst and fatigue.",
+                           "source": "Test", "category": "chronic_condition"}])
+    
+    def test_repeated_queries_hit_cache(self):
+        """Queries differing only in case and whitespace share a cache entry"""
+        first = self.kb.search_faqs("Diabetes  symptoms")
+        second = self.kb.search_faqs("diabetes symptoms")
+        
+        assert first == second
+        stats = self.kb.search_cache.get_stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["hit_ratio"] == 0.5
+    
+    def test_cached_results_are_copies(self):
+        """Callers modifying results do not corrupt the cache"""
+        self.kb.search_faqs("diabetes")[0]["answer"] = "changed"
+        
+        assert self.kb.search_faqs("diabetes")[0]["answer"] == "Thirst and fatigue."
+    
+    def test_ingestion_invalidates_results(self):
+        """Results computed before FAQs are added are not served afterwards"""
+        assert len(self.kb.search_faqs("diabetes")) == 1
+        
+        self.kb.add_faqs([{"question": "How is diabetes treated?", "answer": "Diet and insulin.",
+                           "source": "Test", "category": "chronic_condition"}])
+        
+        assert len(self.kb.search_faqs("diabetes")) == 2
+    
+    def test_stale_version_is_not_served(self):
+        """Entries tagged with an older version are dropped on lookup"""
+        from backend.cache import VersionedLRUCache
+        cache = VersionedLRUCache(max_entries=2)
+        cache.set("a", 1, ["old"])
+        
+        assert cache.get("a", 2) is None
+        assert cache.get_stats()["stale"] == 1
+    
+    def test_lru_eviction(self):
+        """The least recently used entry is evicted when the cache is full"""
+        from backend.cache import VersionedLRUCache
+        cache = VersionedLRUCache(max_entries=2)
+        cache.set("a", 1, 1)
+        cache.set("b", 1, 2)
+        cache.get("a", 1)
+        cache.set("c", 1, 3)
+        
+        assert cache.get("b", 1) is None
+        assert cache.get("a", 1) == 1
+        assert cache.get_stats()["evictions"] == 1
+
+class TestHedgedRequests:
+    """Test hedged, deadline-aware upstream calls"""
+    
+    def slow_then_fast(self, slow_seconds=0.5):
+        """Blocking call whose first invocation is slow and later ones are fast"""
+        import threading, time
+        calls = []
+        lock = threading.Lock()
+        
+        def call():
+            with lock:
+                calls.append(len(calls) + 1)
+                attempt = len(calls)
+            time.sleep(slow_seconds if attempt == 1 else 0.01)
+            return f"attempt {attempt}"
+        return call, calls
+    
+    def test_slow_call_is_hedged(self):
+        """A second attempt is started after the hedge delay and the faster one wins"""
+        from backend.hedging import RequestHedger
+        hedger = RequestHedger(enabled=True, budget=1.0, initial_delay=0.05)
+        func, calls = self.slow_then_fast()
+        
+        result = asyncio.run(hedger.call(func))
+        
+        assert result == "attempt 2"
+        assert len(calls) == 2
+        stats = hedger.get_stats()
+        assert stats["hedged"] == 1
+        assert stats["hedge_wins"] == 1
+    
+    def test_fast_call_is_not_hedged(self):
+        """Calls finishing before the hedge delay run once"""
+        from backend.hedging import RequestHedger
+        hedger = RequestHedger(enabled=True, budget=1.0, initial_delay=1.0)
+        
+        assert asyncio.run(hedger.call(lambda: "done")) == "done"
+        assert hedger.get_stats()["hedged"] == 0
+    
+    def test_hedge_budget_is_respected(self):
+        """No hedge is sent once the budget is used up"""
+        from backend.hedging import RequestHedger
+        hedger = RequestHedger(enabled=True, budget=0.0, initial_delay=0.05)
+        func, calls = self.slow_then_fast(slow_seconds=0.2)
+        
+        assert asyncio.run(hedger.call(func)) == "attempt 1"
+        assert len(calls) == 1
+        assert hedger.get_stats()["budget_exhausted"] == 1
+    
+    def test_deadline_abandons_call(self):
+        """Waiting stops once the request deadline has passed"""
+        from backend.hedging import RequestHedger, DeadlineExceeded, deadline
+        hedger = RequestHedger(enabled=False)
+        func, _ = self.slow_then_fast()
+        
+        async def scenario():
+            with deadline(0.05):
+                await hedger.call(func)
+        
+        with pytest.raises(DeadlineExceeded):
+            asyncio.run(scenario())
+        assert hedger.get_stats()["deadline_exceeded"] == 1
+    
+    def test_losing_attempt_is_bounded_and_reported(self):
+        """Attempts get the time left as a timeout, and a losing attempt's late result is still reported"""
+        from backend.hedging import RequestHedger, deadline
+        hedger = RequestHedger(enabled=True, budget=1.0, initial_delay=0.05)
+        func, _ = self.slow_then_fast(slow_seconds=0.2)
+        timeouts, discarded = [], []
+        
+        def call(timeout):
+            timeouts.append(timeout)
+            return func()
+        
+        async def scenario():
+            with deadline(5):
+                result = await hedger.call(call, timeout_argument="timeout",
+                                           on_discarded=lambda result, seconds: discarded.append(result))
+            await asyncio.sleep(0.3)
+            return result
+        
+        assert asyncio.run(scenario()) == "attempt 2"
+        assert len(timeouts) == 2
+        assert all(0 < timeout <= 5 for timeout in timeouts)
+        assert discarded == ["attempt 1"]
+        assert hedger.get_stats()["discarded"] == 1
+    
+    def test_hedge_delay_adapts_to_latency(self):
+        """The hedge delay follows the rolling p95 latency once enough calls are seen"""
+        from backend.hedging import RequestHedger, LatencyTracker
+        hedger = RequestHedger(initial_delay=8.0, min_delay=0.5, tracker=LatencyTracker(window=100, min_samples=10))
+        assert hedger.hedge_delay() == 8.0
+        
+        for i in range(100):
+            hedger.tracker.record(1.0 + i / 100)
+        
+        assert hedger.hedge_delay() == pytest.approx(1.95)
+    
+    def test_expired_deadline_returns_fallback_response(self):
+        """The medical response falls back without calling the LLM when the deadline has passed"""
+        from backend.gpt_router import gpt_router
+        from backend.hedging import deadline
+        
+        async def scenario():
+            with deadline(0):
+                return await gpt_router.generate_medical_response("How can I improve my sleep?")
+        
+        with patch.object(gpt_router, "client") as mock_client:
+            result = asyncio.run(scenario())
+        
+        assert result["category"] == "error"
+        mock_client.chat.completions.create.assert_not_called()
+
+class TestModelRouting:
+    """Test category-aware model routing"""
+    
+    def test_simple_categories_use_fast_model(self):
+        """Lifestyle and general questions go to the fast model, clinical ones to the configured model"""
+        from backend.routing import default_routes
+        from backend.utils import Config, settings
+        routes = default_routes()
+        
+        assert routes["lifestyle"].model == Config.LLM_FAST_MODEL
+        assert routes["general_health"].model == Config.LLM_FAST_MODEL
+        assert routes["mental_health"].model == settings.openai_model
+        assert routes["chronic_condition"].max_tokens > routes["general_health"].max_tokens
+    
+    def test_unknown_category_uses_default_route(self):
+        """Categories without a route fall back to the default one"""
+        from backend.routing import ModelRouter, ModelRoute
+        router = ModelRouter({"general_health": ModelRoute("small", 300, 0.5)})
+        
+        assert router.route("emergency").model == "small"
+    
+    def test_route_stats(self):
+        """Latency, tokens and errors are recorded per route"""
+        from types import SimpleNamespace
+        from backend.routing import ModelRouter, ModelRoute
+        router = ModelRouter({"general_health": ModelRoute("small", 300, 0.5)})
+        
+        router.record("general_health", 0.2, SimpleNamespace(prompt_tokens=100, completion_tokens=50))
+        router.record("general_health", 0.4, SimpleNamespace(prompt_tokens=200, completion_tokens=70))
+        router.record("general_health", 1.0, error=True)
+        
+        stats = router.get_stats()["general_health"]
+        assert stats["calls"] == 3
+        assert stats["errors"] == 1
+        assert stats["latency_ms_p95"] == 400.0
+        assert stats["avg_prompt_tokens"] == 150.0
+        assert stats["avg_completion_tokens"] == 60.0
+    
+    def test_request_uses_category_route(self):
+        """The completion request uses the model, budget and temperature of the question's category"""
+        from unittest.mock import MagicMock
+        from backend.gpt_router import gpt_router
+        from backend.routing import model_router
+        
+        completion = MagicMock()
+        completion.choices = [MagicMock()]
+        completion.choices[0].message.content = "Stay hydrated"
+        with patch.object(gpt_router, "client") as mock_client, \
+             patch.object(gpt_router, "retrieve_passages", return_value=[]):
+            mock_client.chat.completions.create.return_value = completion
+            asyncio.run(gpt_router.generate_medical_response("I feel anxious about my exams"))
+            kwargs = mock_client.chat.completions.create.call_args.kwargs
+        
+        route = model_router.route("mental_health")
+        assert kwargs["model"] == route.model
+        assert kwargs["max_tokens"] == route.max_tokens
+        assert kwargs["temperature"] == route.temperature
+        assert model_router.get_stats()["mental_health"]["calls"] >= 1
+
+class TestUsageAccounting:
+    """Test LLM token usage and cost accounting"""
+    
+    def test_usage_is_attributed_to_endpoint_and_user(self):
+        """Calls are aggregated per category, endpoint, model and user"""
+        from backend.usage import UsageAccountant
+        accountant = UsageAccountant(store_path="unused.jsonl", prices={"gpt-4o": [0.0025, 0.01]})
+        
+        with accountant.attribute("/ask", "user-1") as request_usage:
+            accountant.record("gpt-4o", "mental_health", 1000, 500, 1.5)
+        accountant.record("gpt-4o", "lifestyle", 200, 100, 0.5)
+        
+        assert request_usage.to_dict()["cost_usd"] == pytest.approx(0.0075)
+        stats = accountant.get_stats()
+        assert stats["by_category"]["mental_health"]["prompt_tokens"] == 1000
+        assert stats["by_endpoint"]["/ask"]["calls"] == 1
+        assert stats["by_endpoint"]["internal"]["calls"] == 1
+        assert stats["by_model"]["gpt-4o"]["completion_tokens"] == 600
+        assert list(stats["top_users"]) == ["user-1", "anonymous"]
+    
+    def test_dated_model_uses_base_price(self):
+        """Model snapshots are priced like their base model; unknown models cost nothing"""
+        from backend.usage import UsageAccountant
+        accountant = UsageAccountant(prices={"gpt-4o": [0.0025, 0.01], "gpt-4o-mini": [0.00015, 0.0006]})
+        
+        assert accountant.cost("gpt-4o-mini-2024-07-18", 1000, 0) == pytest.approx(0.00015)
+        assert accountant.cost("other-model", 1000, 1000) == 0
+    
+    def test_users_are_bounded(self):
+        """Users beyond the limit are folded into a shared bucket"""
+        from backend.usage import UsageAccountant
+        accountant = UsageAccountant(max_users=2, prices={})
+        
+        for user_id in ("a", "b", "c", "d"):
+            with accountant.attribute("/ask", user_id):
+                accountant.record("gpt-4o", "general_health", 10, 10, 0.1)
+        
+        stats = accountant.get_stats()
+        assert stats["tracked_users"] == 3
+        assert stats["top_users"]["other"]["calls"] == 2
+    
+    def test_flush_appends_pending_usage(self, tmp_path):
+        """Each flush writes the usage recorded since the previous one"""
+        from backend.usage import UsageAccountant
+        store = tmp_path / "usage.jsonl"
+        accountant = UsageAccountant(store_path=str(store), prices={})
+        
+        accountant.record("gpt-4o", "general_health", 10, 5, 0.1)
+        assert accountant.flush() == 1
+        assert accountant.flush() == 0
+        accountant.record("gpt-4o", "general_health", 20, 5, 0.1)
+        accountant.flush()
+        
+        lines = [json.loads(line) for line in store.read_text().splitlines()]
+        assert [line["model"]["gpt-4o"]["prompt_tokens"] for line in lines] == [10, 20]
+    
+    def test_ask_reports_request_usage(self, client):
+        """The /ask response reports the LLM usage of the request"""
+        from types import SimpleNamespace
+        from unittest.mock import MagicMock
+        from backend.gpt_router import gpt_router
+        from backend.usage import usage_accountant
+        
+        completion = MagicMock()
+        completion.choices = [MagicMock()]
+        completion.choices[0].message.content = "Try a regular sleep schedule."
+        completion.usage = SimpleNamespace(prompt_tokens=300, completion_tokens=120, total_tokens=420)
+        with patch.object(gpt_router, "client") as mock_client, \
+             patch.object(gpt_router, "answer_from_knowledge_base", return_value=None), \
+             patch("backend.gpt_router.response_cache.get", return_value=None):
+            mock_client.chat.completions.create.return_value = completion
+            response = client.post("/ask", json={"question": "Why do I keep waking up at 3am?",
+                                                 "user_id": "usage-test-user"})
+        
+        assert response.status_code == 200
+        usage = response.json()["data"]["request_metadata"]["llm_usage"]
+        assert usage["calls"] == 1
+        assert usage["prompt_tokens"] == 300
+        assert usage_accountant.get_stats()["by_endpoint"]["/ask"]["calls"] >= 1
+
+class TestCacheWarming:
+    """Test the offline response cache warming job"""
+    
+    def make_router(self):
+        from unittest.mock import MagicMock, AsyncMock
+        router = MagicMock()
+        router.answer_from_knowledge_base.return_value = None
+        router.generate_medical_response = AsyncMock(side_effect=lambda question: {
+            "response": f"Answer to {question}", "category": "general_health"
+        })
+        return router
+    
+    def test_warms_uncached_questions(self):
+        """Each distinct question is generated once and stored in the cache"""
+        from backend.cache import TieredCache, LocalBackend
+        from backend.warmup import CacheWarmer
+        cache = TieredCache("warmup-test", LocalBackend())
+        router = self.make_router()
+        warmer = CacheWarmer(router, cache, concurrency=2, rate_per_second=1000)
+        
+        report = asyncio.run(warmer.warm(["How can I sleep better?", "How can I sleep better?",
+                                          "What is a healthy diet?"]))
+        
+        assert report["generated"] == 2
+        assert router.generate_medical_response.await_count == 2
+        key = cache.make_key("medical_response", "What is a healthy diet?")
+        assert cache.get(key)["response"] == "Answer to What is a healthy diet?"
+        
+        report = asyncio.run(warmer.warm(["How can I sleep better?"]))
+        assert report["already_cached"] == 1
+    
+    def test_skips_emergencies_and_failures(self):
+        """Emergency questions are skipped and failed answers are not cached"""
+        from backend.cache import TieredCache, LocalBackend
+        from backend.warmup import CacheWarmer
+        cache = TieredCache("warmup-test-skip", LocalBackend())
+        router = self.make_router()
+        router.generate_medical_response.side_effect = lambda question: {"response": "", "category": "error"}
+        warmer = CacheWarmer(router, cache, rate_per_second=1000)
+        
+        report = asyncio.run(warmer.warm(["I have chest pain and difficulty breathing", "What causes acne?"]))
+        
+        assert report["skipped"] == 1
+        assert report["failed"] == 1
+        assert cache.get(cache.make_key("medical_response", "What causes acne?")) is None
+    
+    def test_query_log_most_frequent_first(self, tmp_path):
+        """Query log questions are ranked by frequency"""
+        from backend.warmup import load_query_log
+        log = tmp_path / "queries.jsonl"
+        log.write_text('{"question": "What causes acne?"}\nHow do I lower stress?\n'
+                       '{"question": "How do I lower stress?"}\n\n{"other": 1}\n')
+        
+        assert load_query_log(str(log)) == ["How do I lower stress?", "What causes acne?"]
+        assert load_query_log(str(log), top=1) == ["How do I lower stress?"]
+    
+    def test_cli_requires_output_without_redis(self):
+        """Without a shared Redis tier the warmed answers would be lost, so --output is required"""
+        from backend.warmup import main
+        
+        with patch("backend.scraper.initialize_knowledge_base") as initialize, \
+             pytest.raises(SystemExit) as exit_info:
+            main(["--no-faqs"])
+        
+        assert exit_info.value.code == 2
+        initialize.assert_not_called()
+    
+    def test_answer_store_round_trip(self, tmp_path):
+        """Saved answers can be loaded into another cache at startup"""
+        from backend.cache import TieredCache, LocalBackend
+        from backend.warmup import CacheWarmer, load_answer_store
+        warmer = CacheWarmer(self.make_router(), TieredCache("warmup-source", LocalBackend()), rate_per_second=1000)
+        asyncio.run(warmer.warm(["What is a healthy diet?"]))
+        store = tmp_path / "answers.jsonl"
+        warmer.save_answers(str(store))
+        
+        cache = TieredCache("warmup-target", LocalBackend())
+        assert load_answer_store(str(store), cache) == 1
+        assert cache.get(cache.make_key("medical_response", "What is a healthy diet?")) is not None
+
+class TestFollowUpPrefetch:
+    """Test speculative prefetch of follow-up answers"""
+    
+    def make_prefetcher(self, **kwargs):
+        from unittest.mock import MagicMock, AsyncMock
+        from backend.cache import TieredCache, LocalBackend
+        from backend.prefetch import FollowUpPrefetcher
+        router = MagicMock()
+        router.answer_from_knowledge_base.return_value = None
+        router.generate_medical_response = AsyncMock(side_effect=lambda question: {
+            "response": f"Answer to {question}", "category": "general_health"
+        })
+        cache = TieredCache(f"prefetch-test-{id(router)}", LocalBackend())
+        return FollowUpPrefetcher(router, cache, enabled=True, **kwargs), router, cache
+    
+    def test_follow_ups_are_cached(self):
+        """Follow-up answers are generated into the cache and later hits are counted"""
+        prefetcher, router, cache = self.make_prefetcher(rate_per_minute=60, burst=5)
+        follow_ups = ["Would you like some general wellness tips?", "Do you have other health concerns?"]
+        
+        asyncio.run(prefetcher.prefetch(follow_ups))
+        prefetcher.record_question("Would you like some general wellness tips?")
+        
+        assert router.generate_medical_response.await_count == 2
+        assert cache.get(cache.make_key("medical_response", follow_ups[1]))["response"] == f"Answer to {follow_ups[1]}"
+        stats = prefetcher.get_stats()
+        assert stats["generated"] == 2
+        assert stats["hits"] == 1
+    
+    def test_budget_limits_prefetches(self):
+        """No more LLM calls are made than the budget allows"""
+        prefetcher, router, _ = self.make_prefetcher(rate_per_minute=1, burst=1)
+        
+        asyncio.run(prefetcher.prefetch(["First follow-up question?", "Second follow-up question?"]))
+        
+        assert router.generate_medical_response.await_count == 1
+        assert prefetcher.get_stats()["skipped_budget"] == 1
+    
+    def test_no_prefetch_when_busy(self):
+        """Nothing is generated while real traffic needs the capacity"""
+        prefetcher, router, _ = self.make_prefetcher(is_idle=lambda: False)
+        
+        asyncio.run(prefetcher.prefetch(["Would you like some general wellness tips?"]))
+        
+        router.generate_medical_response.assert_not_awaited()
+        assert prefetcher.get_stats()["skipped_busy"] == 1
+    
+    def test_schedule_starts_detached_task(self):
+        """Only successful answers with follow-ups start a prefetch, traced apart from the scheduling request"""
+        from backend.tracing import tracer
+        from backend.utils import request_id_var
+        prefetcher, router, _ = self.make_prefetcher(max_per_request=2, rate_per_minute=60, burst=5)
+        request_ids = []
+        router.generate_medical_response.side_effect = lambda question: (
+            request_ids.append(request_id_var.get()) or {"response": "Answer", "category": "lifestyle"})
+        
+        async def scenario():
+            with tracer.trace("POST /ask", "scheduling-request"):
+                prefetcher.schedule({"category": "error", "follow_up_questions": ["a?"]})
+                prefetcher.schedule({"category": "lifestyle", "follow_up_questions": ["a?", "b?", "c?"]})
+            await asyncio.gather(*prefetcher._tasks)
+        
+        asyncio.run(scenario())
+        
+        assert router.generate_medical_response.await_count == 2
+        assert prefetcher.get_stats()["scheduled"] == 1
+        assert len(set(request_ids)) == 1 and "scheduling-request" not in request_ids
+    
+    def test_concurrency_is_limited(self):
+        """Prefetches beyond max_concurrent are skipped"""
+        prefetcher, router, _ = self.make_prefetcher(max_concurrent=1, rate_per_minute=60, burst=5)
+        
+        async def slow_answer(question):
+            await asyncio.sleep(0.01)
+            return {"response": "Answer", "category": "lifestyle"}
+        router.generate_medical_response.side_effect = slow_answer
+        
+        async def scenario():
+            await asyncio.gather(prefetcher.prefetch(["First follow-up question?"]),
+                                 prefetcher.prefetch(["Second follow-up question?"]))
+        
+        asyncio.run(scenario())
+        
+        assert router.generate_medical_response.await_count == 1
+        assert prefetcher.get_stats()["skipped_busy"] == 1
+
+class TestQueryLog:
+    """Test the batched production query log"""
+    
+    def test_records_are_written_in_batches(self, tmp_path):
+        """Records are buffered until a batch is flushed"""
+        from backend.querylog import QueryLog
+        path = tmp_path / "queries.jsonl"
+        query_log = QueryLog(path=str(path), batch_size=2, flush_interval=60)
+        
+        async def run_writer():
+            writer = asyncio.create_task(query_log.run())
+            await asyncio.sleep(0)
+            query_log.record({"question": "first?"})
+            await asyncio.sleep(0.05)
+            assert not path.exists()
+            query_log.record({"question": "second?"})
+            for _ in range(50):
+                await asyncio.sleep(0.01)
+                if query_log.get_stats()["written"]:
+                    break
+            writer.cancel()
+        
+        asyncio.run(run_writer())
+        
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        assert [line["question"] for line in lines] == ["first?", "second?"]
+        assert query_log.get_stats()["batches"] == 1
+    
+    def test_log_is_rotated(self, tmp_path):
+        """A full file is rotated and only the configured backups are kept"""
+        from backend.querylog import QueryLog
+        path = tmp_path / "queries.jsonl"
+        query_log = QueryLog(path=str(path), max_bytes=100, backups=2)
+        
+        for index in range(4):
+            query_log.record({"question": f"question number {index} " + "x" * 40})
+            query_log.flush()
+        
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["queries.jsonl", "queries.jsonl.1", "queries.jsonl.2"]
+        assert "number 3" in path.read_text()
+        assert query_log.get_stats()["rotations"] == 3
+    
+    def test_workers_write_their_own_files(self, tmp_path):
+        """Forked workers log to per-process files, so one never rotates another's file"""
+        from backend.querylog import QueryLog
+        query_log = QueryLog(path=str(tmp_path / "queries.jsonl"))
+        
+        query_log.split_per_process()
+        query_log.record({"question": "q?"})
+        query_log.flush()
+        
+        assert [p.name for p in tmp_path.iterdir()] == [f"queries.{os.getpid()}.jsonl"]
+    
+    def test_buffer_is_bounded(self):
+        """The oldest records are dropped when the writer falls behind"""
+        from backend.querylog import QueryLog
+        query_log = QueryLog(path="unused.jsonl", max_buffered=3)
+        
+        for index in range(5):
+            query_log.record({"question": f"q{index}"})
+        
+        assert [entry["question"] for entry in query_log._buffer] == ["q2", "q3", "q4"]
+        assert query_log.get_stats()["dropped"] == 2
+    
+    def test_answer_outcome(self):
+        """Answers are classified by where they came from"""
+        from backend.querylog import answer_outcome
+        
+        assert answer_outcome({"medical_response": {"category": "emergency", "fast_lane": True}}, []) == "emergency"
+        assert answer_outcome({"medical_response": {"category": "lifestyle", "knowledge_match": {}}}, []) == "knowledge_base"
+        assert answer_outcome({"medical_response": {"category": "lifestyle"}}, ["triage", "llm"]) == "llm"
+        assert answer_outcome({"medical_response": {"category": "lifestyle"}}, ["triage", "cache"]) == "cache_hit"
+        assert answer_outcome({}, []) == "error"
+    
+    def test_ask_is_logged(self, client, tmp_path):
+        """Answered questions are logged with their category and stage timings, without the user ID"""
+        from unittest.mock import MagicMock
+        from backend.gpt_router import gpt_router
+        from backend.querylog import query_log, user_key
+        path = tmp_path / "queries.jsonl"
+        
+        completion = MagicMock()
+        completion.choices = [MagicMock()]
+        completion.choices[0].message.content = "Common symptoms include thirst and fatigue."
+        with patch.object(query_log, "path", str(path)), \
+             patch.object(gpt_router, "client") as mock_client, \
+             patch.object(gpt_router, "answer_from_knowledge_base", return_value=None), \
+             patch("backend.gpt_router.response_cache.get", return_value=None):
+            mock_client.chat.completions.create.return_value = completion
+            response = client.post("/ask", json={"question": "What are the symptoms of diabetes?",
+                                                 "include_cbt": False, "user_id": "query-log-user"})
+            query_log.flush()
+        
+        assert response.status_code == 200
+        entry = json.loads(path.read_text().splitlines()[-1])
+        assert entry["question"] == "What are the symptoms of diabetes?"
+        assert entry["include_cbt"] is False
+        assert entry["has_user_id"] is True
+        assert entry["user_key"] == user_key("query-log-user")
+        assert "query-log-user" not in path.read_text()
+        assert entry["outcome"] == "llm"
+        assert {"triage", "llm"} <= set(entry["stages_ms"])
+
+class TestTextIndex:
+    """Test the keyword text index and its parallel build"""
+    
+    FAQS = [
+        {"question": "What causes back pain?", "answer": "Poor posture and painful muscle strain.",
+         "category": "pain_management", "keywords": ["pain"]},
+        {"question": "How do I manage diabetes?", "answer": "Monitor blood sugar and eat well.",
+         "category": "chronic_condition", "keywords": ["diabetes"]},
+        {"question": "Can I get the flu twice?", "answer": "Yes, different strains circulate each season.",
+         "category": "acute_illness"},
+        {"question": "How much sleep do adults need?", "answer": "Seven to nine hours a night.",
+         "category": "lifestyle", "keywords": ["sleep"]}
+    ]
+    
+    def test_parallel_build_matches_serial(self):
+        """Shards built in worker processes merge into the same postings, reporting progress"""
+        from backend.indexing import build_text_index
+        faqs = self.FAQS * 5
+        progress = []
+        
+        serial = build_text_index(faqs, workers=1)
+        parallel = build_text_index(faqs, workers=2, shard_size=3, parallel_min_docs=0,
+                                    progress=lambda indexed, total: progress.append((indexed, total)))
+        
+        assert parallel.tokens == serial.tokens
+        assert parallel.keywords == serial.keywords
+        assert list(parallel.tokens["pain?"]) == [0, 4, 8, 12, 16]
+        assert progress[-1] == (20, 20)
+        assert len(progress) == 7
+    
+    def test_indexed_search_matches_full_scan(self):
+        """Searching index candidates gives exactly the results of scoring every FAQ"""
+        from backend.scraper import MedicalKnowledgeBase
+        kb = MedicalKnowledgeBase(search_cache_entries=0)
+        kb.set_faqs(self.FAQS)
+        
+        queries = ("pain", "painful back", "flu", "diabetes and sleep", "how do i", "strains")
+        indexed = [kb.search_faqs(query) for query in queries]
+        with patch("backend.indexing.TextIndex.candidates", return_value=None):
+            assert [kb.search_faqs(query) for query in queries] == indexed
+        assert kb.shards["pain_management"].text_index.candidates("diabetes") == []
+    
+    def test_added_faqs_are_indexed(self):
+        """Ingested FAQs extend a copy of the index"""
+        from backend.scraper import MedicalKnowledgeBase
+        kb = MedicalKnowledgeBase(search_cache_entries=0)
+        kb.set_faqs(self.FAQS[:2])
+        previous = kb.shards["pain_management"].text_index
+        
+        kb.add_faqs(self.FAQS[2:] + [{"question": "Why does my knee pain get worse?", "answer": "Overuse.",
+                                      "category": "pain_management"}])
+        
+        assert kb.shards["pain_management"].text_index.doc_count == 2
+        assert previous.doc_count == 1
+        assert kb.search_faqs("flu")[0]["question"] == "Can I get the flu twice?"
+        assert kb.shards["pain_management"].positions == [0, 4]
+    
+    def test_load_reuses_cached_index(self, tmp_path):
+        """A second load of the same file skips the build"""
+        from backend.scraper import MedicalKnowledgeBase
+        faq_file = tmp_path / "faqs.json"
+        faq_file.write_text(json.dumps(self.FAQS))
+        
+        first = MedicalKnowledgeBase(index_cache_dir=str(tmp_path / "index"))
+        assert first.load_faqs(str(faq_file))
+        second = MedicalKnowledgeBase(index_cache_dir=str(tmp_path / "index"))
+        with patch("backend.scraper.build_text_index") as build:
+            assert second.load_faqs(str(faq_file))
+        
+        build.assert_not_called()
+        assert first.get_stats()["text_indexes"]["lifestyle"]["source"] == "built"
+        assert second.get_stats()["text_indexes"]["lifestyle"]["source"] == "cache"
+        assert second.search_faqs("diabetes")[0]["question"] == "How do I manage diabetes?"
+
+class TestCategoryShards:
+    """Test the category-sharded knowledge base"""
+    
+    FAQS = [
+        {"question": "How do I sleep better?", "answer": "Keep a regular sleep schedule.", "category": "lifestyle"},
+        {"question": "Why do I have back pain?", "answer": "Often from posture; sleep position matters.",
+         "category": "pain_management"},
+        {"question": "What helps with poor sleep?", "answer": "Limit caffeine and screens.", "category": "lifestyle"},
+        {"question": "Is sleep linked to anxiety?", "answer": "Poor sleep and anxiety feed each other.",
+         "category": "mental_health"}
+    ]
+    
+    def make_kb(self, **kwargs):
+        from backend.scraper import MedicalKnowledgeBase
+        kb = MedicalKnowledgeBase(search_cache_entries=0, **kwargs)
+        kb.set_faqs([dict(faq) for faq in self.FAQS])
+        return kb
+    
+    def test_category_search_touches_one_shard(self):
+        """A category filter only searches that category's shard"""
+        from backend.scraper import CategoryShard
+        kb = self.make_kb()
+        
+        with patch.object(CategoryShard, "search", autospec=True, side_effect=CategoryShard.search) as search:
+            results = kb.search_faqs("sleep", category="lifestyle")
+        
+        assert [call.args[0].category for call in search.call_args_list] == ["lifestyle"]
+        assert {result["category"] for result in results} == {"lifestyle"}
+    
+    def test_scatter_gather_keeps_corpus_order(self):
+        """Merged shard results rank like one scan over the corpus, with or without a thread pool"""
+        kb = self.make_kb()
+        threaded = self.make_kb(search_threads=2)
+        
+        results = kb.search_faqs("sleep", limit=3)
+        
+        assert [result["question"] for result in results] == [
+            "How do I sleep better?", "Is sleep linked to anxiety?", "What helps with poor sleep?"
+        ]
+        assert threaded.search_faqs("sleep", limit=3) == results
+    
+    def test_reload_category_keeps_other_shards(self):
+        """Reloading a category rebuilds only its shard"""
+        kb = self.make_kb()
+        other_index = kb.shards["pain_management"].text_index
+        version = kb.version
+        
+        loaded = kb.reload_category("lifestyle", [
+            {"question": "How much water should I drink?", "answer": "About two liters a day.", "category": "lifestyle"},
+            {"question": "Unrelated question?", "answer": "Skipped.", "category": "acute_illness"}
+        ])
+        
+        assert loaded == 1
+        assert kb.shards["pain_management"].text_index is other_index
+        assert [faq["question"] for faq in kb.get_category_faqs("lifestyle")] == ["How much water should I drink?"]
+        assert kb.search_faqs("water")[0]["question"] == "How much water should I drink?"
+        assert kb.search_faqs("sleep", category="lifestyle") == []
+        assert kb.version == version + 1
+        assert kb.get_stats()["category_breakdown"] == {"pain_management": 1, "mental_health": 1, "lifestyle": 1}
+    
+    def test_reload_rebuilds_derived_indexes_before_swapping(self):
+        """Searches keep the old corpus-wide indexes until replacements are built, then get them ready-made"""
+        from backend.retrieval import DENSE_RETRIEVAL_AVAILABLE
+        from backend.scraper import MedicalKnowledgeBase
+        if not DENSE_RETRIEVAL_AVAILABLE:
+            pytest.skip("Dense retrieval dependencies not installed")
+        kb = self.make_kb()
+        old_dense = kb.get_dense_index()
+        old_spelling = kb.get_spelling_corrector()
+        old_suggestions = kb.get_suggestion_index()
+        seen_during_build = []
+        
+        def build_dense(faqs):
+            seen_during_build.append((kb.dense_index, kb.spelling, kb.suggestions))
+            return MedicalKnowledgeBase._build_dense_index(faqs)
+        
+        with patch.object(kb, "_build_dense_index", side_effect=build_dense):
+            kb.reload_category("lifestyle", [
+                {"question": "How much water should I drink?", "answer": "About two liters a day.",
+                 "category": "lifestyle"}
+            ])
+        
+        assert seen_during_build == [(old_dense, old_spelling, old_suggestions)]
+        assert kb.dense_index is not old_dense and len(kb.dense_index) == 3
+        assert kb.spelling is not old_spelling and kb.spelling is not None
+        assert kb.suggestions is not old_suggestions
+        assert [entry["text"] for entry in kb.suggestions.suggest("wat")] == ["How much water should I drink?"]
+    
+    def test_reload_endpoint(self, client, admin_headers):
+        """The admin endpoint reloads one category"""
+        from backend.scraper import knowledge_base
+        
+        with patch.object(knowledge_base, "load_category", return_value=3) as load_category:
+            response = client.post("/admin/knowledge/reload", params={"category": "lifestyle"},
+                                   headers=admin_headers)
+        
+        assert response.json()["data"]["loaded"] == 3
+        load_category.assert_called_once_with("lifestyle")
+    
+    def test_reload_requires_admin_token(self, client, admin_headers):
+        """Without the admin token no category is replaced"""
+        from backend.scraper import knowledge_base
+        
+        with patch.object(knowledge_base, "load_category") as load_category:
+            missing = client.post("/admin/knowledge/reload", params={"category": "lifestyle"})
+            wrong = client.post("/admin/knowledge/reload", params={"category": "lifestyle"},
+                                headers={"X-Admin-Token": "guess"})
+        
+        assert (missing.status_code, wrong.status_code) == (401, 403)
+        load_category.assert_not_called()
+
+class TestProductionLauncher:
+    """Test the preloading, forking production launcher"""
+    
+    def test_falls_back_without_uvloop_and_httptools(self):
+        """The pure-Python event loop and parser are used when the fast ones are missing"""
+        from backend.server import fastest_loop_and_parser
+        
+        with patch.dict(sys.modules, {"uvloop": None, "httptools": None}):
+            assert fastest_loop_and_parser() == ("asyncio", "h11")
+    
+    def test_engines_load_once(self):
+        """Workers skip loading when the master already preloaded the engines"""
+        import backend.app as app_module
+        
+        with patch.object(app_module, "_engines_loaded", False), \
+             patch.object(app_module, "initialize_knowledge_base") as initialize:
+            app_module.load_engines()
+            app_module.load_engines()
+        
+        initialize.assert_called_once()
+    
+    def test_dead_workers_are_replaced(self):
+        """A worker that exits is replaced until the master is asked to stop"""
+        import signal
+        from backend.server import WorkerSupervisor
+        supervisor = WorkerSupervisor(app=None, sock=None, workers=2, restart_delay=0)
+        
+        exits = [(101, 256), None, (103, 0)]
+        
+        def wait():
+            exit = exits.pop(0)
+            if exit is None:
+                supervisor._stop(signal.SIGTERM, None)
+                exit = (102, 0)
+            return exit
+        
+        with patch("backend.server.signal.signal"), \
+             patch("backend.server.os.fork", side_effect=[101, 102, 103]) as fork, \
+             patch("backend.server.os.wait", side_effect=wait), \
+             patch("backend.server.os.kill") as kill:
+            assert supervisor.run() == 0
+        
+        assert fork.call_count == 3
+        assert sorted(call.args[0] for call in kill.call_args_list) == [102, 103]
+    
+    def test_admission_limits_split_between_workers(self):
+        """Each worker enforces its share so the configured limits hold across the server"""
+        from backend.admission import AdmissionController, EndpointClass
+        controller = AdmissionController(
+            {"llm": EndpointClass("llm", max_in_flight=16, max_queue=32, queue_timeout=5,
+                                  rate_per_second=0.5, burst=5)},
+            routes=(("/ask", "llm"),)
+        )
+        
+        controller.partition(4)
+        
+        llm = controller.endpoint_classes["llm"]
+        assert (llm.max_in_flight, llm.max_queue, llm.burst) == (4, 8, 2)
+        assert llm.rate_per_second == pytest.approx(0.125)
+
 # Integration tests
 class TestIntegration:
     """Integration tests for full workflows"""